@@ -0,0 +1,128 @@
+from typing import *
+
+import os
+import time
+import logging
+
+
+class LoomProjectAuth(object):
+	"""
+	The parsed auth.txt file of a project, and the authorization
+	decisions made with it so far.
+
+	Each line of auth.txt has the format `username, password, flags`,
+	where a "w" flag grants write access. A "*" user grants read access
+	to everyone.
+	"""
+	__slots__ = [
+		"stat",
+		"users",
+		"broken",
+		"checked",
+		"decisions",
+	]
+
+	# bound the decisions that are remembered, so that
+	# guessing passwords cannot grow the table indefinitely
+	max_decisions = 1024
+
+	def __init__(self, stat: Tuple[int, int, int] = None) -> None:
+		"""
+		Args:
+			stat:	(mtime, size, inode) of auth.txt, or None if the project has no auth.txt
+		"""
+		self.stat = stat
+		self.users = {}  # type: Dict[str, Tuple[str, str]]
+		self.broken = False
+		self.checked = 0.0
+		self.decisions = {}  # type: Dict[Tuple[str, str, str], bool]
+
+	def load(self, authfile: str) -> None:
+		try:
+			with open(authfile) as f:
+				lines = [x.split(", ") for x in f.read().splitlines()]
+				self.users = {x[0]: (x[1], x[2]) for x in lines}
+		except Exception:
+			logging.warn("Broken authfile")
+			self.broken = True
+
+	def authorize(self, username: str, password: str, mode: str = "read") -> bool:
+		key = (username, password, mode)
+		decision = self.decisions.get(key)
+		if decision is None:
+			decision = self.decide(username, password, mode)
+			if len(self.decisions) >= self.max_decisions:
+				self.decisions.clear()
+			self.decisions[key] = decision
+		return decision
+
+	def decide(self, username: str, password: str, mode: str = "read") -> bool:
+		if self.stat is None:
+			return mode == "read"
+		if self.broken:
+			return False
+		users = self.users
+		if mode == "read":
+			if "*" in users:
+				return True
+			if username in users and users[username][0] == password:
+				return True
+		else:
+			if username in users and users[username][0] == password and users[username][1] == "w":
+				return True
+		return False
+
+
+class LoomAuthTable(object):
+	"""
+	Keeps the auth.txt files of all projects parsed in memory, so that
+	authorizing a request is a dictionary lookup.
+
+	An auth.txt file is only parsed again when its mtime, size or inode
+	changed (or when it was added or removed), and this is checked at
+	most once per check_interval seconds per project. Changes to
+	auth.txt therefore take effect within check_interval seconds.
+	"""
+	__slots__ = [
+		"dataset_path",
+		"check_interval",
+		"projects",
+	]
+
+	def __init__(self, dataset_path: str, check_interval: float = 1.0) -> None:
+		self.dataset_path = dataset_path
+		self.check_interval = check_interval
+		self.projects = {}  # type: Dict[str, LoomProjectAuth]
+
+	def authorize(self, project: str, username: str, password: str, mode: str = "read") -> bool:
+		"""
+		Check authorization for the specific project and credentials
+		(see LoomDatasets.authorize). Assumes the project exists.
+		"""
+		return self.project_auth(project).authorize(username, password, mode)
+
+	def project_auth(self, project: str) -> LoomProjectAuth:
+		"""
+		Returns the (up-to-date) parsed auth.txt of a project
+		"""
+		auth = self.projects.get(project)
+		now = time.monotonic()
+		if auth is not None and now - auth.checked < self.check_interval:
+			return auth
+		authfile = os.path.join(self.dataset_path, project, "auth.txt")
+		stat = self._stat(authfile)
+		if auth is None or auth.stat != stat:
+			logging.debug("Loading authorization for project %s", project)
+			auth = LoomProjectAuth(stat)
+			if stat is not None:
+				auth.load(authfile)
+			self.projects[project] = auth
+		auth.checked = now
+		return auth
+
+	def _stat(self, authfile: str) -> Tuple[int, int, int]:
+		try:
+			stat = os.stat(authfile)
+		except OSError:
+			return None
+		return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
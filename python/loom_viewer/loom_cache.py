@@ -0,0 +1,99 @@
+from typing import *
+
+from collections import OrderedDict
+
+
+class LoomLRUCache(object):
+	"""
+	An in-memory least-recently-used cache, bounded by the total
+	size in bytes of the cached values rather than the number of entries.
+
+	Values are expected to be bytes (or str), unless an explicit size
+	is passed to `put`.
+
+	Keys are tuples whose first item is the absolute path of the loom
+	file they were derived from, so that all entries of a loom file
+	can be dropped with `invalidate` when it changes.
+	"""
+	__slots__ = [
+		"max_bytes",
+		"size",
+		"entries",
+		"hits",
+		"misses",
+		"evictions",
+	]
+
+	def __init__(self, max_bytes: int) -> None:
+		self.max_bytes = max_bytes
+		self.size = 0
+		self.entries = OrderedDict()  # type: OrderedDict
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self) -> int:
+		return len(self.entries)
+
+	def __contains__(self, key: Any) -> bool:
+		return key in self.entries
+
+	def get(self, key: Any) -> Any:
+		"""
+		Returns the cached value for key and marks it as recently
+		used, or None if it is not cached.
+		"""
+		entry = self.entries.get(key)
+		if entry is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.entries.move_to_end(key)
+		return entry[0]
+
+	def put(self, key: Any, value: Any, nbytes: int = None) -> None:
+		"""
+		Cache value under key, evicting the least recently used
+		entries until the cache fits within max_bytes again.
+		Values larger than max_bytes are not cached at all.
+		"""
+		if nbytes is None:
+			nbytes = len(value)
+		self.remove(key)
+		if nbytes > self.max_bytes:
+			return
+		self.entries[key] = (value, nbytes)
+		self.size += nbytes
+		while self.size > self.max_bytes:
+			_, (_, evicted_bytes) = self.entries.popitem(last=False)
+			self.size -= evicted_bytes
+			self.evictions += 1
+
+	def remove(self, key: Any) -> None:
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			self.size -= entry[1]
+
+	def invalidate(self, file_path: str) -> None:
+		"""
+		Remove all entries derived from the loom file at file_path
+		"""
+		for key in [key for key in self.entries if key[0] == file_path]:
+			self.remove(key)
+
+	def clear(self) -> None:
+		self.entries.clear()
+		self.size = 0
+
+	def stats(self) -> Dict[str, int]:
+		"""
+		Returns the hit, miss and eviction counters and current size
+		"""
+		return {
+			"entries": len(self.entries),
+			"bytes": self.size,
+			"max_bytes": self.max_bytes,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+		}
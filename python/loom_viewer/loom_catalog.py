@@ -0,0 +1,441 @@
+from typing import *
+
+import os
+import sys
+import errno
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+import gevent
+import gevent.socket
+
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+IN_ADDED = IN_CREATE | IN_MOVED_TO
+IN_REMOVED = IN_DELETE | IN_MOVED_FROM
+IN_CHANGED = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE
+IN_WATCH_MASK = IN_ADDED | IN_REMOVED | IN_CHANGED | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+inotify_event = struct.Struct("iIII")
+
+
+class LoomInotify(object):
+	"""
+	Minimal ctypes wrapper around the Linux inotify API.
+	`LoomInotify.create()` returns None on platforms without inotify.
+	"""
+	__slots__ = [
+		"libc",
+		"fd",
+	]
+
+	def __init__(self, libc: Any, fd: int) -> None:
+		self.libc = libc
+		self.fd = fd
+
+	@classmethod
+	def create(cls) -> Any:
+		if not sys.platform.startswith("linux"):
+			return None
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+			fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		except (OSError, AttributeError) as e:
+			logging.debug("inotify is not available: %s", e)
+			return None
+		if fd < 0:
+			logging.debug("inotify is not available: %s", os.strerror(ctypes.get_errno()))
+			return None
+		return cls(libc, fd)
+
+	def add_watch(self, path: str, mask: int = IN_WATCH_MASK) -> int:
+		"""
+		Returns the watch descriptor, or -1 if the path could not be watched
+		"""
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+		if wd < 0:
+			logging.debug("Could not watch %s: %s", path, os.strerror(ctypes.get_errno()))
+		return wd
+
+	def read(self) -> List[Tuple[int, int, str]]:
+		"""
+		Waits for events without blocking the gevent hub.
+
+		Returns:
+			A list of (watch descriptor, mask, name) tuples.
+		"""
+		while True:
+			try:
+				data = os.read(self.fd, 64 * 1024)
+				break
+			except BlockingIOError:
+				gevent.socket.wait_read(self.fd)
+		events = []
+		offset = 0
+		while offset + inotify_event.size <= len(data):
+			wd, mask, cookie, length = inotify_event.unpack_from(data, offset)
+			offset += inotify_event.size
+			name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+			offset += length
+			events.append((wd, mask, name))
+		return events
+
+	def close(self) -> None:
+		os.close(self.fd)
+
+
+class LoomCatalogEntry(object):
+	"""
+	A loom file in LoomCatalog, with its metadata as it appears in the dataset list
+	"""
+	__slots__ = [
+		"project",
+		"filename",
+		"file_path",
+		"mtime",
+		"metadata",
+	]
+
+	def __init__(self, project: str, filename: str, file_path: str, mtime: int) -> None:
+		self.project = project
+		self.filename = filename
+		self.file_path = file_path
+		self.mtime = mtime
+		# JSON string, or None if it has to be (re)generated
+		self.metadata = None  # type: str
+
+
+class LoomCatalog(object):
+	"""
+	Keeps track of the projects and loom files in the dataset folder,
+	so that listing them does not require walking the dataset folder.
+
+	Changes are picked up with inotify where available. Otherwise, or
+	when the dataset folder is on network storage where inotify does
+	not see changes made by other machines, the folders are polled:
+	a project is only listed again if the mtime of its folder changed.
+	Added, removed and modified loom files are handled; `on_removed`
+	is called with the absolute path of loom files that disappeared.
+
+	The JSON dataset list is built from the stored metadata of each
+	loom file, and kept per set of authorized projects until anything
+	in the catalog changes (see `version`).
+
+	The catalog is started lazily, by the process that serves requests
+	(file descriptors and greenlets must not be shared with forked
+	worker processes).
+	"""
+	__slots__ = [
+		"dataset_path",
+		"poll_interval",
+		"on_removed",
+		"version",
+		"projects",
+		"project_mtimes",
+		"root_mtime",
+		"responses",
+		"_inotify",
+		"_watches",
+		"_greenlets",
+		"_pid",
+	]
+
+	# with inotify, the folders are still polled at this (longer)
+	# interval, for changes made on other machines
+	inotify_poll_interval = 300
+
+	def __init__(self, dataset_path: str, poll_interval: float = 5, on_removed: Callable[[str], None] = None) -> None:
+		self.dataset_path = dataset_path
+		self.poll_interval = poll_interval
+		self.on_removed = on_removed
+		# incremented on every change to the catalog
+		self.version = 0
+		self.projects = {}  # type: Dict[str, Dict[str, LoomCatalogEntry]]
+		self.project_mtimes = {}  # type: Dict[str, int]
+		self.root_mtime = None  # type: int
+		# prebuilt dataset lists per set of authorized projects, as (version, JSON string)
+		self.responses = {}  # type: Dict[FrozenSet[str], Tuple[int, str]]
+		self._inotify = None  # type: LoomInotify
+		self._watches = {}  # type: Dict[int, str]
+		self._greenlets = []  # type: List[gevent.Greenlet]
+		self._pid = None  # type: int
+
+	def running(self) -> bool:
+		return self._pid == os.getpid()
+
+	def start(self) -> None:
+		"""
+		Scan the dataset folder and start watching it for changes,
+		unless that already happened in this process.
+		"""
+		if self.running():
+			return
+		if self._pid is not None:
+			# inherited from the process we were forked from
+			self.stop()
+		self._pid = os.getpid()
+		self._inotify = LoomInotify.create()
+		if self._inotify is not None:
+			self._watch(self.dataset_path, "")
+		self.rescan(force=True)
+		if self._inotify is not None:
+			logging.debug("Watching %s with inotify", self.dataset_path)
+			self._greenlets.append(gevent.spawn(self._watch_events))
+			self._greenlets.append(gevent.spawn(self._poll, self.inotify_poll_interval))
+		else:
+			logging.debug("Polling %s every %s seconds", self.dataset_path, self.poll_interval)
+			self._greenlets.append(gevent.spawn(self._poll, self.poll_interval))
+
+	def stop(self) -> None:
+		for greenlet in self._greenlets:
+			greenlet.kill(block=False)
+		self._greenlets = []
+		if self._inotify is not None:
+			self._inotify.close()
+			self._inotify = None
+		self._watches = {}
+		self._pid = None
+
+	def files(self) -> Set[Tuple[str, str, str]]:
+		"""
+		Returns a set of (project, filename, absolute file path) tuples of all loom files
+		"""
+		return {(entry.project, entry.filename, entry.file_path) for entries in self.projects.values() for entry in entries.values()}
+
+	def project_names(self) -> Set[str]:
+		return set(self.projects.keys())
+
+	def metadata_list(self, authorized_projects: Set[str], metadata: Callable[[str, str], str]) -> str:
+		"""
+		Returns the JSON array of the metadata of all loom files in the
+		authorized projects, rebuilding it only if the catalog changed.
+
+		Args:
+			authorized_projects (set):	Projects to include
+			metadata:					Called as metadata(project, filename) for loom files
+										whose metadata is not known yet, or changed
+		"""
+		key = frozenset(authorized_projects)
+		version = self.version
+		response = self.responses.get(key)
+		if response is not None and response[0] == version:
+			return response[1]
+
+		complete = True
+		metadata_list = []
+		for project in sorted(key):
+			entries = self.projects.get(project, {})
+			for filename in sorted(entries.keys()):
+				entry = entries.get(filename)
+				if entry is None:
+					# removed while generating metadata of other files
+					continue
+				if entry.metadata is None:
+					entry.metadata = metadata(project, filename)
+					if entry.metadata is None:
+						complete = False
+						continue
+				metadata_list.append(entry.metadata)
+		response_json = "[%s]" % ",".join(metadata_list)
+		if complete:
+			if len(self.responses) >= 64:
+				self.responses.clear()
+			# if the catalog changed while generating metadata,
+			# this is rebuilt on the next request
+			self.responses[key] = (version, response_json)
+		return response_json
+
+	def rescan(self, force: bool = False) -> None:
+		"""
+		List the projects in the dataset folder, and the loom files of
+		every project whose folder changed (or of all projects, if forced).
+		In polling mode this also checks if loom files were modified.
+		"""
+		root_mtime = self._mtime(self.dataset_path)
+		added = set()  # type: Set[str]
+		if force or root_mtime != self.root_mtime:
+			self.root_mtime = root_mtime
+			projects = set(self._blocking(self._list_projects))
+			for project in list(self.projects.keys()):
+				if project not in projects:
+					self.remove_project(project)
+			added = projects - set(self.projects.keys())
+			for project in added:
+				self.add_project(project)
+		for project in list(self.projects.keys()):
+			if project in added:
+				continue
+			project_path = os.path.join(self.dataset_path, project)
+			if force or self._mtime(project_path) != self.project_mtimes.get(project):
+				self.scan_project(project)
+			elif self._inotify is None:
+				for entry in list(self.projects[project].values()):
+					self.update_file(project, entry.filename)
+
+	def add_project(self, project: str) -> None:
+		logging.debug("Adding project %s to catalog", project)
+		self.projects[project] = {}
+		project_path = os.path.join(self.dataset_path, project)
+		if self._inotify is not None:
+			self._watch(project_path, project)
+		self.scan_project(project)
+		self._changed()
+
+	def remove_project(self, project: str) -> None:
+		logging.debug("Removing project %s from catalog", project)
+		entries = self.projects.pop(project, {})
+		self.project_mtimes.pop(project, None)
+		for wd, watched in list(self._watches.items()):
+			if watched == project:
+				del self._watches[wd]
+		for entry in entries.values():
+			self._removed(entry)
+		self._changed()
+
+	def scan_project(self, project: str) -> None:
+		"""
+		List the loom files in a project folder, adding new
+		and removing deleted ones.
+		"""
+		if project not in self.projects:
+			return
+		project_path = os.path.join(self.dataset_path, project)
+		self.project_mtimes[project] = self._mtime(project_path)
+		try:
+			filenames = {filename for filename in self._blocking(os.listdir, project_path) if filename.endswith(".loom")}
+		except OSError:
+			filenames = set()
+		entries = self.projects[project]
+		for filename in list(entries.keys()):
+			if filename not in filenames:
+				self.remove_file(project, filename)
+		for filename in filenames:
+			self.update_file(project, filename)
+
+	def update_file(self, project: str, filename: str) -> None:
+		"""
+		Add a loom file, or mark its metadata as outdated if it was modified
+		"""
+		entries = self.projects.get(project)
+		if entries is None:
+			return
+		file_path = os.path.join(self.dataset_path, project, filename)
+		mtime = self._mtime(file_path)
+		if mtime is None:
+			self.remove_file(project, filename)
+			return
+		entry = entries.get(filename)
+		if entry is None:
+			logging.debug("Adding %s to catalog", file_path)
+			entries[filename] = LoomCatalogEntry(project, filename, file_path, mtime)
+			self._changed()
+		elif entry.mtime != mtime:
+			entry.mtime = mtime
+			entry.metadata = None
+			self._changed()
+
+	def remove_file(self, project: str, filename: str) -> None:
+		entry = self.projects.get(project, {}).pop(filename, None)
+		if entry is not None:
+			logging.debug("Removing %s from catalog", entry.file_path)
+			self._removed(entry)
+			self._changed()
+
+	def _changed(self) -> None:
+		self.version += 1
+
+	def _removed(self, entry: LoomCatalogEntry) -> None:
+		if self.on_removed is not None:
+			self.on_removed(entry.file_path)
+
+	def _list_projects(self) -> List[str]:
+		return [x for x in os.listdir(self.dataset_path) if os.path.isdir(os.path.join(self.dataset_path, x)) and not x.startswith(".")]
+
+	def _mtime(self, path: str) -> int:
+		try:
+			return self._blocking(os.stat, path).st_mtime_ns
+		except OSError:
+			return None
+
+	def _blocking(self, fn: Callable, *args: Any) -> Any:
+		"""
+		File system calls may block for a long time on network
+		storage, so they are run in the threadpool of the hub.
+		"""
+		return gevent.get_hub().threadpool.apply(fn, args)
+
+	def _watch(self, path: str, project: str) -> None:
+		wd = self._inotify.add_watch(path)
+		if wd >= 0:
+			self._watches[wd] = project
+
+	def _watch_events(self) -> None:
+		while True:
+			try:
+				events = self._inotify.read()
+			except OSError as e:
+				if e.errno == errno.EBADF:
+					return
+				raise
+			for wd, mask, name in events:
+				try:
+					self._handle_event(wd, mask, name)
+				except Exception as e:
+					logging.warning("Error while updating dataset catalog: %s", e)
+
+	def _handle_event(self, wd: int, mask: int, name: str) -> None:
+		if mask & IN_Q_OVERFLOW:
+			logging.debug("inotify queue overflowed, rescanning %s", self.dataset_path)
+			self.rescan(force=True)
+			return
+		project = self._watches.get(wd)
+		if project is None:
+			return
+		if mask & IN_IGNORED:
+			# watched folder was removed
+			del self._watches[wd]
+			return
+		if project == "":
+			# event in the dataset folder itself
+			if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+				logging.warning("Dataset folder %s was removed", self.dataset_path)
+				for removed in list(self.projects.keys()):
+					self.remove_project(removed)
+			elif mask & IN_ISDIR and not name.startswith("."):
+				if mask & IN_ADDED and name not in self.projects:
+					self.add_project(name)
+				elif mask & IN_REMOVED and name in self.projects:
+					self.remove_project(name)
+		elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+			self.remove_project(project)
+		elif name.endswith(".loom") and not mask & IN_ISDIR:
+			if mask & IN_REMOVED:
+				self.remove_file(project, name)
+			else:
+				self.update_file(project, name)
+
+	def _poll(self, interval: float) -> None:
+		while True:
+			gevent.sleep(interval)
+			try:
+				self.rescan()
+			except Exception as e:
+				logging.warning("Error while updating dataset catalog: %s", e)
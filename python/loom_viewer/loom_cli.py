@@ -37,6 +37,7 @@ import warnings
 import loompy
 from ._version import __version__
 from .loom_expand import LoomExpand
+from .loom_locks import LoomFileLock
 from .loom_datasets import def_dataset_dir, LoomDatasets
 from .loom_server import start_server
 
@@ -54,7 +55,9 @@ def tile_command(
 	filenames: List[str],
 	projects: List[str],
 	all_files: bool,
-	truncate: bool) -> None:
+	truncate: bool,
+	pack: bool = False,
+	migrate: bool = False) -> None:
 	# do not expand tiles more than once for any given filename
 	matches = set()  # type: Set[Tuple[str, str, str]]
 	filenamesNone = filenames is None
@@ -104,6 +107,14 @@ To replace old tiles with new ones, add the -t or --truncate flag
    loom tile FILE -t
 
 
+To store all tiles in a single pack file instead of one PNG file per tile,
+add the --pack flag. Previously generated PNG tiles can be moved into the
+pack file with --migrate:
+
+   loom tile FILE --pack
+   loom tile FILE --migrate
+
+
 To generate tiles only for one specific file, even if there are multiple files
 with the same name, use the absolute path:
 
@@ -128,8 +139,12 @@ while discarding any previously generated tiles:
 """)
 	else:
 		for project, filename, file_path in matches:
-			logging.info("Tiling {file_path}")
-			datasets.tile(project, file_path, truncate)
+			if migrate:
+				logging.info("Migrating tiles of %s to tile pack", file_path)
+				datasets.migrate_tiles(project, file_path)
+			else:
+				logging.info("Tiling {file_path}")
+				datasets.tile(project, file_path, truncate, pack)
 
 
 def expand_command(
@@ -157,7 +172,7 @@ See also:
 Currently, the following separate types of cache can be expanded with these flags:
 
     -m, --metadata     general metadata
-    -a, --attributes   row and column attributes
+    -a, --attributes   row and column attributes (and the search index of the row attributes)
     -r, --rows         rows (genes)
     -c, --cols         columns (cells, currently not used)
 
@@ -226,25 +241,38 @@ while discarding any previously generated tiles:
 			matches |= datasets.list.files_in_project(project)
 
 	for project, filename, file_path in matches:
+		# a server may be reading the same loom file
+		lock = LoomFileLock(file_path)
+		if not lock.acquire(timeout=60):
+			logging.warning("Could not lock %s, skipping it", file_path)
+			continue
+		expand = None
 		try:
-			expand = LoomExpand(project, filename, file_path)
+			expand = LoomExpand(project, filename, file_path, lambda expand: lock.release())
 			if not expand.closed:
 				if clear:
 					expand.clear_metadata()
 					expand.clear_attributes()
+					expand.clear_search_index()
 					expand.clear_rows()
 					expand.clear_columns()
+					expand.clear_binary_rows()
+					expand.clear_binary_columns()
+					expand.clear_group_summaries()
 				if metadata:
 					expand.metadata(truncate)
 				if attributes:
 					expand.attributes(truncate)
+					expand.search_index(truncate)
 				if rows:
 					expand.rows(truncate)
 				if cols:
 					expand.columns(truncate)
 				expand.close()
 		except Exception as e:
-			expand.close()
+			# if LoomExpand failed to open, it already released the lock
+			if expand is not None and not expand.closed:
+				expand.close()
 			raise e
 
 
@@ -290,6 +318,61 @@ def parse_args(def_dir: str) -> Any:
 		default=8003
 	)
 
+	server_parser.add_argument(
+		"--clone-rate-limit",
+		help="Maximum bandwidth in MB/s per download of a loom file (0 for no limit, the default)",
+		type=float,
+		default=0
+	)
+
+	server_parser.add_argument(
+		"--threads",
+		help="Number of threads for reading loom files (4 by default)",
+		type=int,
+		default=4
+	)
+
+	server_parser.add_argument(
+		"--workers",
+		help="Number of server processes sharing the port (1 by default, not supported on Windows)",
+		type=int,
+		default=1
+	)
+
+	server_parser.add_argument(
+		"--cache-size",
+		help="Memory in MB for caching expanded data and tiles, per server process (256 by default)",
+		type=float,
+		default=256
+	)
+
+	server_parser.add_argument(
+		"--metrics-allow",
+		help="Client address allowed to read /metrics, besides localhost (may be repeated)",
+		action="append",
+		default=[]
+	)
+
+	server_parser.add_argument(
+		"--profile-token",
+		help="Profile requests with an X-Loom-Profile header matching this token (returns a Server-Timing header)",
+		type=str,
+		default=None
+	)
+
+	server_parser.add_argument(
+		"--profile-all",
+		help="Profile all requests (for local debugging)",
+		action="store_true"
+	)
+
+	server_parser.add_argument(
+		"--profile-dir",
+		help="Save a cProfile (pstats file) of every profiled request in this folder",
+		type=str,
+		default=None
+	)
+
 	# loom tile
 	tile_parser = subparsers.add_parser("tile", help="Precompute heatmap tiles")
 
@@ -322,6 +405,18 @@ def parse_args(def_dir: str) -> Any:
 		action="store_true"
 	)
 
+	tile_parser.add_argument(
+		"--pack",
+		help="Store tiles in a single pack file instead of one PNG file per tile (false by default)",
+		action="store_true"
+	)
+
+	tile_parser.add_argument(
+		"--migrate",
+		help="Import previously generated PNG tiles into the pack file instead of generating tiles",
+		action="store_true"
+	)
+
 	# loom expand
 	expand_help = "Expands data to compressed json files. Processes all matching loom filenames in dataset_path, unless absolute path is passed"
 
@@ -377,7 +472,7 @@ def parse_args(def_dir: str) -> Any:
 	expand_parser.add_argument(
 		"-a",
 		"--attributes",
-		help="Expand attributes (false by default)",
+		help="Expand attributes and build the search index (false by default)",
 		action="store_true"
 	)
 
@@ -428,6 +523,22 @@ def main() -> None:
 		setattr(args, "port", 8003)
 	if 'show_browser' not in args:
 		setattr(args, "show_browser", True)
+	if 'clone_rate_limit' not in args:
+		setattr(args, "clone_rate_limit", 0)
+	if 'threads' not in args:
+		setattr(args, "threads", 4)
+	if 'workers' not in args:
+		setattr(args, "workers", 1)
+	if 'cache_size' not in args:
+		setattr(args, "cache_size", 256)
+	if 'metrics_allow' not in args:
+		setattr(args, "metrics_allow", [])
+	if 'profile_token' not in args:
+		setattr(args, "profile_token", None)
+	if 'profile_all' not in args:
+		setattr(args, "profile_all", False)
+	if 'profile_dir' not in args:
+		setattr(args, "profile_dir", None)
 
 	if args.debug:
 		logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s - %(module)s, %(lineno)d: %(message)s')
@@ -441,12 +552,12 @@ def main() -> None:
 		if args.command == "tile":
 			logging.warn("test")
 			datasets = LoomDatasets(args.dataset_path)
-			tile_command(datasets, args.file, args.project, args.all, args.truncate)
+			tile_command(datasets, args.file, args.project, args.all, args.truncate, args.pack, args.migrate)
 		elif args.command == "expand":
 			datasets = LoomDatasets(args.dataset_path)
 			expand_command(datasets, args.file, args.project, args.all, args.clear, args.metadata, args.attributes, args.rows, args.cols, args.truncate)
 		else:  # args.command == "server":
-			start_server(args.dataset_path, args.show_browser, args.port, args.debug)
+			start_server(args.dataset_path, args.show_browser, args.port, args.debug, args.clone_rate_limit, args.threads, args.workers, args.cache_size, args.metrics_allow, args.profile_token, args.profile_all, args.profile_dir)
 
 
 if __name__ == "__main__":
@@ -6,14 +6,40 @@ import logging
 
 import json
 
-from gevent.lock import BoundedSemaphore
+import gevent
+import numpy as np
 
 from loompy import LoomConnection
 
 from .loom_utils import load_gzipped_json_string
+from .loom_utils import iter_json_array
+from .loom_utils import LoomStream
+from .loom_utils import load_binary
+from .loom_utils import gunzip_string
+from .loom_utils import gzip_string
+from .loom_utils import binary_array
+from .loom_utils import BINARY_COLUMNS_IDX
+from .loom_utils import EMPTY_METADATA_ARRAY
+from .loom_cache import LoomLRUCache
+from .loom_tile_pack import LoomTilePack
+from .loom_workers import LoomWorkers
+from .loom_locks import LoomFileLock
+from .loom_pool import LoomConnectionPool
+from .loom_auth import LoomAuthTable
+from .loom_catalog import LoomCatalog
+from .loom_scatter import LoomScatterPyramid
+from .loom_search import LoomSearchIndex
+from .loom_flight import LoomSingleFlight
+from .loom_metrics import expansion_items, lock_wait_seconds, lock_timeouts, gauge_lines
+from .loom_profile import phase
 from .loom_utils import format_mtime
 
 from loom_viewer import LoomExpand, LoomTiles
+from .loom_tiles import dz_zoom_range, dz_tile_in_bounds
+from .loom_expand import marker_statistics
+from .loom_expand import load_correlations
+from .loom_expand import has_group_summaries
+from .loom_expand import iter_chunks
 
 
 #
@@ -27,6 +53,13 @@ def def_dataset_dir() -> str:
 		return def_dir
 
 
+def valid_columns(column_numbers: List[int], dimensions: Tuple[int, int]) -> List[int]:
+	"""
+	The column numbers that are in bounds, sorted and each included once
+	"""
+	return [i for i in sorted(set(column_numbers)) if 0 <= i < dimensions[1]]
+
+
 class LoomDatasetLists(object):
 	"""
 	An object that takes a root path to the dataset folder, and helps with listing projects and loom files inside of it
@@ -177,7 +210,9 @@ class LoomDatasetLists(object):
 
 class LoomDatasetConnections(object):
 	"""
-	An object for handling opening connections and expanders to the loom files in the local dataset directory in a concurrent setting (using semaphores)
+	An object for handling opening connections and expanders to the loom files in the local dataset directory in a concurrent setting (using locks that also hold across processes, see LoomFileLock)
+
+	Read-only connections are kept open between requests in a LoomConnectionPool.
 
 	Expanders are self-closing, but connections require a manual release.
 	"""
@@ -187,56 +222,74 @@ class LoomDatasetConnections(object):
 		"projects",
 		"files",
 		"dataset_locks",
+		"workers",
+		"pool",
 	]
 
-	def __init__(self, dataset_path: str = None) -> None:
+	def __init__(self, dataset_path: str = None, threads: int = 4, max_open_files: int = 32) -> None:
 		self.dataset_path = dataset_path
 		self.list = LoomDatasetLists(dataset_path)
 		self.projects = set()             # type: Set[str]
 		self.files = set()                # type: Set[Tuple[str, str, str]]
-		self.dataset_locks = {}           # type: Dict[str, BoundedSemaphore]
+		self.dataset_locks = {}           # type: Dict[str, LoomFileLock]
+		# blocking loompy calls are run in here, see LoomWorkers
+		self.workers = LoomWorkers(threads)
+		self.pool = LoomConnectionPool(self.workers, max_open_files)
 
-	def update_list(self) -> None:
+	def update_list(self, all_files: Set[Tuple[str, str, str]] = None) -> None:
 		"""
 		Scan dataset folder for new project folders
 		Scan project folders for new loom files.
 		Note that this does not handle deleted project folders or loom files,
 		LoomDatasets needs to be closed and re-opened for that.
+
+		Args:
+			all_files:	The (project, filename, absolute path) tuples of all loom files,
+						if already known (see LoomCatalog). Scans the dataset folder otherwise.
 		"""
 		ds_path = self.dataset_path
-		logging.debug("Adding expander semaphores for new loom files in %s", ds_path)
-		all_files = self.list.all_files()
+		logging.debug("Adding expander locks for new loom files in %s", ds_path)
+		if all_files is None:
+			all_files = self.list.all_files()
 		# if a tuple is in the new set,
 		# but not in the old one, it's a new file
 		new_files = all_files - self.files
 		for project, filename, file_path in new_files:
 			self.projects.add(project)
-			logging.debug("  semaphore added for %s", file_path)
-			self.dataset_locks[file_path] = BoundedSemaphore(value=1)
+			logging.debug("  lock added for %s", file_path)
+			self.dataset_locks[file_path] = LoomFileLock(file_path)
 		# Store updated set of all files
 		self.files = all_files
 
-	def acquire(self, project: str, filename: str, timeout: float=10) -> bool:
+	def acquire(self, project: str, filename: str, timeout: float=10, shared: bool=False) -> bool:
 		"""
-		Attempt to acquire lock for a given loom file.
+		Attempt to acquire lock for a given loom file, either shared
+		(for reading only) or exclusive (for writing to the loom file
+		or removing its cache).
 
 		Returns True if successfull, and False if not.
 		"""
 		absolute_path = self.list.absolute_file_path(project, filename)
 		if absolute_path is not "":
+			mode = "shared" if shared else "exclusive"
+			started_at = time.monotonic()
 			try:
 				lock = self.dataset_locks.get(absolute_path)
-				if lock is not None and lock.acquire(blocking=True, timeout=timeout):
+				with phase("lock_wait"):
+					acquired = lock is not None and lock.acquire(blocking=True, timeout=timeout, shared=shared)
+				if acquired:
+					lock_wait_seconds.observe(time.monotonic() - started_at, mode)
 					return True
 				elif lock is None:
 					logging.debug("    %s not among semaphores", absolute_path)
 				elif lock.locked():
 					logging.debug("    Lock not acquired")
+					lock_timeouts.inc(mode)
 			except TimeoutError as t:
 				# May happen when multiple acquires were called before
 				# timeout was reached. This is not a bug, so we just
 				# return None to indicate that acquisition has failed
-				pass
+				lock_timeouts.inc(mode)
 		return False
 
 	def release(self, project: str, filename: str) -> None:
@@ -253,7 +306,7 @@ class LoomDatasetConnections(object):
 
 	def locked(self, project: str, filename: str) -> bool:
 		"""
-		Return a boolean indicating whether a connection or expander can be acquired.
+		Return a boolean indicating whether a connection or expander is currently held.
 		"""
 		absolute_path = self.list.absolute_file_path(project, filename)
 		if absolute_path is not "":
@@ -264,12 +317,14 @@ class LoomDatasetConnections(object):
 
 	def connect(self, project: str, filename: str, mode: str="r+", timeout: float=10) -> LoomConnection:
 		"""
-		Try to connect to a local loom file. If returns None already connected.
+		Try to connect to a local loom file. Returns None if the lock could not be acquired in time.
 
-		Uses a semaphore to ensure there is never more than one connection
-		open to a loom file (as long as this is the only object that connects to the loom file)
+		Connections in 'r' mode share the lock with other readers,
+		other modes ensure there is never more than one connection
+		open to a loom file (as long as LoomFileLock is used to connect to the loom file)
 
-		Remember to call `release(project, filename)` after closing the connection!
+		Connections in 'r' mode come from the connection pool and must not be closed.
+		Remember to call `disconnect(project, filename, ds, mode)` after using the connection!
 
 		Args:
 			- project (string): 		Name of the project (e.g. "Midbrain")
@@ -278,38 +333,72 @@ class LoomDatasetConnections(object):
 		Returns:
 			A loom file connection, or None if file does not exist or was already connected.
 		"""
-		if self.acquire(project, filename, timeout):
+		if self.acquire(project, filename, timeout, shared=(mode == "r")):
 			absolute_path = self.list.absolute_file_path(project, filename)
-			return LoomConnection(absolute_path, mode)
+			try:
+				if mode == "r":
+					return self.pool.acquire(absolute_path)
+				self.pool.close(absolute_path)
+				return self.workers.apply(absolute_path, LoomConnection, absolute_path, mode)
+			except Exception as e:
+				self.release(project, filename)
+				raise e
 		return None
 
-	def acquire_expander(self, project: str, filename: str, timeout: float=10) -> LoomExpand:
+	def disconnect(self, project: str, filename: str, ds: LoomConnection, mode: str="r+") -> None:
+		"""
+		Close (or return to the pool) a connection obtained with `connect`
+		in the given mode, and release the lock of the loom file.
+		"""
+		absolute_path = self.list.absolute_file_path(project, filename)
+		try:
+			if mode == "r":
+				self.pool.release(absolute_path, ds)
+			else:
+				ds.close()
+		finally:
+			self.release(project, filename)
+
+	def acquire_expander(self, project: str, filename: str, timeout: float=10, exclusive: bool=False, mode: str='r') -> LoomExpand:
 		"""
 		Create LoomExpand object for a local loom file in the project subdirectory.
-		Uses a semaphore to ensure there is never more than one connection
-		open to a loom file (as long as this is the only object that connects to the loom file)
 
-		Will unlock the semaphore by itself when closed.
+		By default, the expander uses a read-only connection from the
+		connection pool, sharing the lock with other readers. Expanders
+		that remove cache files must be exclusive. Repairing the
+		timestamps of the loom file additionally requires 'r+' mode,
+		in which case the file is opened separately, after closing
+		the pooled connection to it.
+
+		Will unlock by itself when closed.
 
 		Args:
 			project (string): 		Name of the project (e.g. "Midbrain")
 			filename (string): 		Filename of the loom file (e.g. "Midbrain_20160701.loom")
 			timeout (float):				Time to wait for connection to become available in seconds, or None to wait indefinitely
+			exclusive (bool):			Whether exclusive access is needed
+			mode (str):					'r', or 'r+' to open the file for writing (implies exclusive)
 
 		Returns:
 			A LoomExpander instance, or None if loom file does not exist or access to it is not authorized.
 		"""
-		if self.acquire(project, filename, timeout):
+		exclusive = exclusive or mode != 'r'
+		if self.acquire(project, filename, timeout, shared=not exclusive):
 			absolute_path = self.list.absolute_file_path(project, filename)
-			expander = None
 			try:
-				expander = LoomExpand(project, filename, absolute_path, self._release_expander)
+				if mode == 'r':
+					ds = self.pool.acquire(absolute_path)
+					return LoomExpand(project, filename, absolute_path, self._release_expander, close_connection_on_exit=False, ds=ds)
+				self.pool.close(absolute_path)
+				# Opening the loom file blocks, so do it in the worker pool.
+				# The callback releases a gevent lock, so it may only be
+				# set once we are back in the hub.
+				expander = self.workers.apply(absolute_path, LoomExpand, project, filename, absolute_path, mode=mode)
+				expander.callback_on_close = self._release_expander
 				return expander
 			except Exception as e:
-				if expander is not None:
-					expander.close()
-				if self.locked(project, filename):
-					self.release(project, filename)
+				logging.debug("  Could not create expander for %s: %s", absolute_path, e)
+				self.release(project, filename)
 		return None
 
 	def _release_expander(self, expander: LoomExpand) -> None:
@@ -318,6 +407,8 @@ class LoomDatasetConnections(object):
 		This should never be called manually - it is called automatically from within the expander when the latter is closed.
 		"""
 		if not expander.closed:
+			if not expander.close_connection_on_exit:
+				self.pool.release(expander.file_path, expander.ds)
 			lock = self.dataset_locks[expander.file_path]
 			lock.release()
 
@@ -336,28 +427,59 @@ class LoomDatasets(object):
 		"files",
 		"dataset_last_mtime",
 		"dataset_last_mod",
-		"metadata_entries",
-		"attribute_entries",
-		"expansion_entries"
+		"expansion_entries",
+		"tile_ranges",
+		"cache",
+		"tile_packs",
+		"auth",
+		"catalog",
+		"catalog_version",
+		"workers",
+		"flights",
+		"prepared_caches",
 	]
 
-	def __init__(self, dataset_path: str = None) -> None:
+	def __init__(self, dataset_path: str = None, cache_size: int = 256 * 1024 * 1024, threads: int = 4, max_open_files: int = 32, watch: bool = False) -> None:
 		"""
 		Create a LoomDatasets object that will help with connecting to loom files
 		in the specified datasets folder
+
+		Args:
+			cache_size (int):		Memory budget in bytes for cached metadata, attributes, rows, columns and tiles
+			watch (bool):			Keep track of the loom files with a LoomCatalog, instead of
+									scanning the dataset folder for every dataset list
 		"""
 		self.dataset_path = dataset_path
-		self.connections = LoomDatasetConnections(dataset_path)
+		self.connections = LoomDatasetConnections(dataset_path, threads, max_open_files)
 		self.list = self.connections.list
+		self.workers = self.connections.workers
 
 		self.projects = set()             # type: Set[str]
 		self.files = set()                # type: Set[Tuple[str, str, str]]
 
 		self.dataset_last_mtime = {}      # type: Dict[str, str]
 		self.dataset_last_mod = {}        # type: Dict[str, str]
-		self.metadata_entries = {}        # type: Dict[str, Tuple[str, str]]
-		self.attribute_entries = {}       # type: Dict[str, Tuple[str, str]]
 		self.expansion_entries = {}       # type: Dict[str, LoomExpand]
+		# (last_mod, mins, maxes) per loom file, used to render tiles on demand
+		self.tile_ranges = {}             # type: Dict[str, Tuple[str, Any, Any]]
+		# Serialized metadata and attributes, gzipped rows and
+		# columns, binary rows and columns, and rendered tiles.
+		# Keys start with the absolute path of the loom file
+		# (see LoomLRUCache.invalidate)
+		self.cache = LoomLRUCache(cache_size)
+		self.tile_packs = {}              # type: Dict[str, LoomTilePack]
+		# parsed auth.txt files of the projects
+		self.auth = LoomAuthTable(dataset_path)
+		# started on the first dataset list request
+		self.catalog = None  # type: LoomCatalog
+		if watch:
+			self.catalog = LoomCatalog(self.list.dataset_path, on_removed=self.forget_file)
+		# version of the catalog that self.files was last updated to
+		self.catalog_version = -1
+		# expansions and renders in progress, keyed like the cache
+		self.flights = LoomSingleFlight()
+		# last_mod that the .rows and .cols folders were prepared for, per (file, kind)
+		self.prepared_caches = {}         # type: Dict[Tuple[str, str], str]
 
 		# Find all projects and loom files in the dataset folder
 		self.update_dataset_list()
@@ -368,7 +490,17 @@ class LoomDatasets(object):
 		Scan project folders for new loom files.
 		Note that this does not handle deleted project folders or loom files,
 		LoomDatasets needs to be closed and re-opened for that.
+
+		Once the catalog is running, the lists are taken from the catalog
+		instead, which does handle deletions.
 		"""
+		if self.catalog is not None and self.catalog.running():
+			all_files = self.catalog.files()
+			self.connections.update_list(all_files)
+			self.projects = {project for project, filename, file_path in all_files}
+			self.files = all_files
+			return
+
 		# update semaphores
 		self.connections.update_list()
 
@@ -379,6 +511,52 @@ class LoomDatasets(object):
 			self.projects.add(project)
 		self.files = all_files
 
+	def sync_catalog(self) -> None:
+		"""
+		Update the lists of projects and files if the catalog changed
+		"""
+		if self.catalog is not None and self.catalog.running() and self.catalog.version != self.catalog_version:
+			self.catalog_version = self.catalog.version
+			self.update_dataset_list()
+
+	def forget_file(self, file_path: str) -> None:
+		"""
+		Drop everything kept in memory about a loom file that was removed
+		"""
+		self.connections.pool.close(file_path)
+		self.cache.invalidate(file_path)
+		self.dataset_last_mtime.pop(file_path, None)
+		self.dataset_last_mod.pop(file_path, None)
+		self.tile_ranges.pop(file_path, None)
+		tile_pack = self.tile_packs.pop(file_path, None)
+		if tile_pack is not None:
+			# the pack itself is kept on disk: its header makes sure
+			# it is ignored if the file returns as another version
+			tile_pack.forget()
+		self.prepared_caches.pop((file_path, "row"), None)
+		self.prepared_caches.pop((file_path, "col"), None)
+
+	def metrics(self) -> List[str]:
+		"""
+		Returns the current state of the cache, connection pool,
+		worker pool and single-flight layer as Prometheus gauges
+		(see loom_metrics).
+		"""
+		lines = []  # type: List[str]
+		for name, value in self.cache.stats().items():
+			lines.extend(gauge_lines("loom_cache_%s" % name, "In-memory cache: %s" % name.replace("_", " "), (), {(): value}))
+		lines.extend(gauge_lines("loom_open_connections", "Loom files kept open in the connection pool", (), {(): len(self.connections.pool)}))
+		for name, value in self.flights.stats().items():
+			lines.extend(gauge_lines("loom_flights_%s" % name, "Single-flight expansions: %s" % name.replace("_", " "), (), {(): value}))
+		worker_stats = {}  # type: Dict[str, Dict[Tuple[str, str], float]]
+		for file_path, stats in self.workers.dataset_stats().items():
+			project, filename = os.path.basename(os.path.dirname(file_path)), os.path.basename(file_path)
+			for name, value in stats.items():
+				worker_stats.setdefault(name, {})[(project, filename)] = value
+		for name, values in sorted(worker_stats.items()):
+			lines.extend(gauge_lines("loom_worker_jobs_%s" % name, "Jobs of the worker pool per loom file: %s" % name.replace("_", " "), ("project", "filename"), values))
+		return lines
+
 	def last_mod(self, file_path: str) -> str:
 		"""
 		Returns the last time the content of the Loom file was modified.
@@ -393,23 +571,68 @@ class LoomDatasets(object):
 			- A LoomExpand connection, if the loom file was modified since the last time this function was called this was called. None otherwise.
 		"""
 		cached_mtime = self.dataset_last_mtime.get(file_path, "")
-		cached_mod = self.dataset_last_mod.get(file_path, "")
 		last_mtime = format_mtime(file_path)
 		if cached_mtime < last_mtime:
-			project, filename, _ = self.list.split_from_abspath(file_path)
-			expander = self.connections.acquire_expander(project, filename)
-			if expander is not None:
-				last_mod = expander.last_modified()
-				if last_mod is not None and cached_mod < last_mod:
-					# update last_mod
-					self.dataset_last_mod[file_path] = last_mod
-				# the expander might modify the mtime, meaning
-				# we need to cache that again after closing it
-				expander.close()
-				last_mtime = format_mtime(file_path)
-				self.dataset_last_mtime[file_path] = last_mtime
+			# all requests that arrive after the file changed need the new
+			# last_mod, but it only has to be read from the file once
+			with phase("last_mod"):
+				last_mod = self.flights.do((file_path, "last_mod", last_mtime), self._read_last_mod, file_path)
+			if last_mod is not None:
 				return last_mod
-		return cached_mod
+		return self.dataset_last_mod.get(file_path, "")
+
+	def _read_last_mod(self, file_path: str) -> str:
+		"""
+		Reads the last_mod of a loom file that changed on disk, see last_mod.
+		Returns None if the file could not be accessed.
+		"""
+		cached_mod = self.dataset_last_mod.get(file_path, "")
+		project, filename, _ = self.list.split_from_abspath(file_path)
+		expander = self.connections.acquire_expander(project, filename)
+		if expander is not None and not self.workers.apply(file_path, expander.has_timestamps):
+			# older loom file, reopen it in 'r+' mode so loompy can add timestamps
+			expander.close()
+			expander = self.connections.acquire_expander(project, filename, mode='r+')
+		if expander is None:
+			return None
+		last_mod = self.workers.apply(file_path, expander.last_modified)
+		if last_mod is not None and cached_mod < last_mod:
+			# update last_mod, and drop cache of the old content
+			self.dataset_last_mod[file_path] = last_mod
+			self.cache.invalidate(file_path)
+		# the expander might modify the mtime, meaning
+		# we need to cache that again after closing it
+		expander.close()
+		self.dataset_last_mtime[file_path] = format_mtime(file_path)
+		return last_mod
+
+	def apply_expander(self, project: str, filename: str, method: str, *args: Any, exclusive: bool = False) -> Any:
+		"""
+		Acquires an expander for the loom file, calls one of its
+		methods in the worker pool, and closes it again.
+
+		Returns:
+			The result of the method, or None if the expander could not be acquired.
+		"""
+		expander = self.connections.acquire_expander(project, filename, exclusive=exclusive)
+		if expander is None or expander.closed:
+			logging.debug("  Could not acquire expander")
+			return None
+		try:
+			return self.workers.apply(expander.file_path, getattr(expander, method), *args)
+		finally:
+			expander.close(True)
+
+	def dataset_last_mod(self, project: str, filename: str) -> str:
+		"""
+		Returns the last time the content of the loom file at project/filename
+		was modified (see `last_mod`), or an empty string if it does not exist.
+		Only opens the loom file if its mtime changed since the last call.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			return ""
+		return self.last_mod(absolute_file_path)
 
 	def authorize(self, project: str, username: str, password: str, mode: str ="read") -> bool:
 		"""
@@ -421,6 +644,8 @@ class LoomDatasets(object):
 		or if there is no auth.txt file in the project directory
 		and the requested access is read-only.
 
+		The auth.txt files are kept parsed in memory (see LoomAuthTable).
+
 		Args:
 			project (str):		Project name
 			username (str):	Username
@@ -435,42 +660,23 @@ class LoomDatasets(object):
 		# Basically, we only proceed to check if the provided
 		# project string matches the list of project directory names
 		# that we selected earlier ourselves.
-		if project not in self.projects:
-			logging.debug("Project does not exist!")
-			return False
-
-		users = {}  # type: Dict[str, Tuple[str, str]]
-		authfile = os.path.join(self.dataset_path, project, "auth.txt")
-		if not os.path.exists(authfile):
-			if mode == "read":
-				return True
-			else:
-				return False
-		else:
-			try:
-				with open(authfile) as f:
-					lines = [x.split(", ") for x in f.read().splitlines()]
-					users = {x[0]: (x[1], x[2]) for x in lines}
-			except Exception:
-				logging.warn("Broken authfile")
+		with phase("auth"):
+			self.sync_catalog()
+			if project not in self.projects:
+				logging.debug("Project does not exist!")
 				return False
-		if mode == "read":
-			if "*" in users:
-				return True
-			if username in users and users[username][0] == password:
-				return True
-		else:
-			if username in users and users[username][0] == password and users[username][1] == "w":
-				return True
-		return False
+			return self.auth.authorize(project, username, password, mode)
 
 	def authorized_projects(self, username: str, password: str, mode: str ="read") -> Set[str]:
 		"""
 		Returns a set of all projects that are authorized for access with
 		the given username and password
 		"""
-		projects = self.list.all_projects()
-		return {p for p in projects if self.authorize(p, username, password)}
+		if self.catalog is not None and self.catalog.running():
+			projects = self.catalog.project_names()
+		else:
+			projects = self.list.all_projects()
+		return {p for p in projects if self.authorize(p, username, password, mode)}
 
 	def JSON_metadata_list(self, username: str = None, password: str = None) -> str:
 		"""
@@ -484,6 +690,11 @@ class LoomDatasets(object):
 		Returns:
 			a JSON string listing metadata for all loom files authorized to see.
 		"""
+		if self.catalog is not None:
+			self.catalog.start()
+			self.sync_catalog()
+			return self.catalog.metadata_list(self.authorized_projects(username, password), self.JSON_metadata)
+
 		self.update_dataset_list()
 
 		dataset_path = self.dataset_path
@@ -526,27 +737,28 @@ class LoomDatasets(object):
 			logging.debug("  Invalid or inaccessible path to loom file")
 			return None
 
-		key = "%s/%s" % (project, filename)
+		key = (absolute_file_path, "metadata")
 		md_filename = "%s.file_md.json.gzip" % (absolute_file_path)
 
 		# See if metadata was already loaded before
-		metadata, cached_mod = self.metadata_entries.get(key, ("", ""))
+		metadata, cached_mod = self.cache.get(key) or ("", "")
 		# get timestamp of most recent time file content was modified
 		last_mod = self.last_mod(absolute_file_path)
 
 		if truncate:
 			logging.debug("  Truncate set, overwriting cache")
-			expander = self.connections.acquire_expander(project, filename)
+			expander = self.connections.acquire_expander(project, filename, exclusive=True)
 			if expander is None or expander.closed:
 				# Only happens in case of concurrent access and time-out
 				logging.debug("    connecting to loom file timed out, cancelling truncation")
 				return None
-			metadata, cached_mod = expander.metadata(True)
+			metadata, cached_mod = self.workers.apply(absolute_file_path, expander.metadata, True)
 			expander.close(True)
 			logging.debug("    cache replaced")
 		elif metadata is not "" and cached_mod == last_mod:
 			# If metadata is cached and up-to-date, return cache
-			logging.debug("  Loaded %s from cache", key)
+			logging.debug("  Loaded %s/%s from cache", project, filename)
+			expansion_items.inc("metadata", "memory")
 		else:
 			# if not truncating nor previously loaded,
 			# see if expanded and up-to-date JSON exists
@@ -555,20 +767,19 @@ class LoomDatasets(object):
 				metadata = load_gzipped_json_string(md_filename)
 				md_mod_filename = "%s.file_md.lastmod.gzip" % (absolute_file_path)
 				cached_mod = load_gzipped_json_string(md_mod_filename)
+				expansion_items.inc("metadata", "disk")
 			# If JSON does not exist or is out of date,
 			# generate/update metadata and attributes
 			if metadata is "" or cached_mod < last_mod:
 				logging.debug("  Invalid or outdated JSON cache, attempting expansion")
-				# expander may have been acquired through self.last_mod
-				expander = self.connections.acquire_expander(project, filename)
-				if expander is None or expander.closed:
-					logging.debug("  Could not acquire expander")
+				# concurrent requests share a single expansion
+				expanded = self.flights.do((absolute_file_path, "metadata", last_mod), self.apply_expander, project, filename, "metadata", False)
+				if expanded is None:
 					return None
-				metadata, last_mod = expander.metadata(False)
-				cached_mod = last_mod
-				expander.close(True)
+				expansion_items.inc("metadata", "expanded")
+				metadata, cached_mod = expanded
 
-		self.metadata_entries[key] = (metadata, cached_mod)
+		self.cache.put(key, (metadata, cached_mod), len(metadata))
 		return metadata
 
 	def JSON_attributes(self, project: str, filename: str, truncate: bool = False) -> str:
@@ -588,197 +799,1187 @@ class LoomDatasets(object):
 			logging.debug("  Invalid or inaccessible path to loom file")
 			return None
 
-		key = "%s/%s" % (project, filename)
+		key = (absolute_file_path, "attributes")
 		attrs_name = "%s.attrs.json.gzip" % (absolute_file_path)
 
 		# See if attributes were already loaded before
-		attributes, cached_mod = self.attribute_entries.get(key, ("", ""))
+		attributes, cached_mod = self.cache.get(key) or ("", "")
 		# get timestamp of most recent time file content was modified
 		last_mod = self.last_mod(absolute_file_path)
 
 		if truncate:
 			logging.debug("  Truncate set, overwriting cache")
-			expander = self.connections.acquire_expander(project, filename)
+			expander = self.connections.acquire_expander(project, filename, exclusive=True)
 			if expander is None or expander.closed:
 				# Only happens in case of concurrent access and time-out
 				logging.debug("    connecting to loom file timed out, cancelling truncation")
 				return None
-			attributes, cached_mod = expander.attributes(True)
+			attributes, cached_mod = self.workers.apply(absolute_file_path, expander.attributes, True)
 			expander.close(True)
 			logging.debug("    cache replaced")
 		elif attributes is not "" and cached_mod == last_mod:
 			# If attributes is cached and up-to-date, return cache
-			logging.debug("  Loaded %s from cache", key)
+			logging.debug("  Loaded %s/%s from cache", project, filename)
+			expansion_items.inc("attributes", "memory")
 		else:
 			# if not truncating nor previously loaded,
 			# see if expanded and up-to-date JSON exists
 			if os.path.isfile(attrs_name) and cached_mod == last_mod:
 				logging.debug("  Found previously extracted JSON file, loading")
 				attributes = load_gzipped_json_string(attrs_name)
+				expansion_items.inc("attributes", "disk")
 
 			# Otherwise, generate/update attributes and attributes
 			if attributes is "" or cached_mod < last_mod:
 				logging.debug("  Invalid or outdated JSON cache, attempting expansion")
-				expander = self.connections.acquire_expander(project, filename)
-				if expander is None or expander.closed:
-					logging.debug("  Could not acquire expander")
+				# concurrent requests share a single expansion
+				expanded = self.flights.do((absolute_file_path, "attributes", last_mod), self.apply_expander, project, filename, "attributes", False)
+				if expanded is None:
 					return None
-				attributes, last_mod = expander.attributes(False)
-				cached_mod = last_mod
-				expander.close(True)
+				expansion_items.inc("attributes", "expanded")
+				attributes, cached_mod = expanded
 
-		self.attribute_entries[key] = (attributes, cached_mod)
+		self.cache.put(key, (attributes, cached_mod), len(attributes))
 		return attributes
 
-	def JSON_rows(self, row_numbers: List[int], project: str, filename: str) -> str:
+	def iter_rows(self, row_numbers: List[int], project: str, filename: str, gzipped: bool = False) -> LoomStream:
 		"""
-		Generates expanded rows for a loom file.
+		Streams expanded rows for a loom file as the chunks of a JSON
+		array, yielding each row as soon as it is loaded or expanded.
 
 		Args:
 			row_numbers (list of integers):	List of the row numbers to expand.
 			project (string): 					Name of the project (e.g. "Midbrain")
 			filename (string): 					Filename of the loom file (e.g. "Midbrain_20160701.loom")
+			gzipped (bool):						Stream gzipped JSON (see `iter_json_array`), passing cached rows through as-is.
 
 		Returns:
-			a string of the JSON serialision of the selected row numbers for the loom file at project/filename.
+			a LoomStream of the JSON serialision of the selected row numbers for the loom file at project/filename,
+			or None if the loom file could not be accessed.
 		"""
-
 		absolute_file_path = self.list.absolute_file_path(project, filename)
-		if absolute_file_path is "":
+		if absolute_file_path == "":
 			logging.debug("Invalid or inaccessible path to loom file")
 			return None
 
 		# make sure all rows are included only once
-		row_numbers = list(set(row_numbers))
+		row_numbers = sorted(set(row_numbers))
 
-		if len(row_numbers) is 0:
-			return "[]"
+		row_dir = "%s.rows" % (absolute_file_path)
+		row_mod_filename = "%s.rows.lastmod.gzip" % absolute_file_path
+		row_mod = load_gzipped_json_string(row_mod_filename)
+		last_mod = self.last_mod(absolute_file_path)
 
-		row_numbers.sort()
-		retRows = ["["]
-		comma = ","
+		row_file_names = ["%s/%06d.json.gzip" % (row_dir, i) for i in row_numbers]
+		row_keys = [(absolute_file_path, "row", last_mod, i) for i in row_numbers]
+		if row_mod >= last_mod and all(key in self.cache or os.path.isfile(row_file_name) for key, row_file_name in zip(row_keys, row_file_names)):
+			logging.debug("%s.rows/ directory detected, loading expanded rows", filename)
+			rows = (self.cached_file(key, row_file_name) for key, row_file_name in zip(row_keys, row_file_names))
+			if not gzipped:
+				rows = (gunzip_string(row) for row in rows)
+			return LoomStream(iter_json_array(rows, gzipped))
 
-		unexpanded = []
+		return self.iter_expanded("row", row_numbers, project, filename, row_mod, gzipped)
 
-		row_dir = "%s.rows" % (absolute_file_path)
+	def iter_columns(self, column_numbers: List[int], project: str, filename: str, gzipped: bool = False) -> LoomStream:
+		"""
+		Streams expanded columns for a loom file as the chunks of a JSON array (see iter_rows).
 
-		row_mod_filename = "%s.rows.lastmod.gzip" % absolute_file_path
-		row_mod = load_gzipped_json_string(row_mod_filename)
+		Returns:
+			a LoomStream of the JSON serialision of the selected column numbers for the loom file at project/filename,
+			or None if the loom file could not be accessed.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			logging.debug("Invalid or inaccessible path to loom file")
+			return None
+
+		# make sure all columns are included only once
+		column_numbers = sorted(set(column_numbers))
+
+		col_dir = "%s.cols" % (absolute_file_path)
+		col_mod_filename = "%s.cols.lastmod.gzip" % absolute_file_path
+		col_mod = load_gzipped_json_string(col_mod_filename)
 		last_mod = self.last_mod(absolute_file_path)
-		expander = None
 
-		if row_mod < last_mod:
+		col_file_names = ["%s/%06d.json.gzip" % (col_dir, i) for i in column_numbers]
+		col_keys = [(absolute_file_path, "col", last_mod, i) for i in column_numbers]
+		if col_mod >= last_mod and all(key in self.cache or os.path.isfile(col_file_name) for key, col_file_name in zip(col_keys, col_file_names)):
+			logging.debug("%s.cols/ directory detected, loading expanded columns", filename)
+			columns = (self.cached_file(key, col_file_name) for key, col_file_name in zip(col_keys, col_file_names))
+			if not gzipped:
+				columns = (gunzip_string(column) for column in columns)
+			return LoomStream(iter_json_array(columns, gzipped))
+
+		return self.iter_expanded("col", column_numbers, project, filename, col_mod, gzipped)
+
+	def prepare_expansion(self, kind: str, project: str, filename: str, cache_mod: str, last_mod: str) -> bool:
+		"""
+		Clears the .rows (kind "row") or .cols (kind "col") folder of a
+		loom file if it is stale (see LoomExpand.prepare_cache).
+
+		Returns:
+			False if the loom file could not be accessed
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if cache_mod < last_mod and self.prepared_caches.get((absolute_file_path, kind)) != last_mod:
+			# clearing stale cache requires exclusive access,
+			# and only needs to happen once per modification
+			logging.debug("Preparing %s.%ss/ for expansion", absolute_file_path, kind)
+			if self.flights.do((absolute_file_path, "prepare_%ss" % kind, last_mod), self.apply_expander, project, filename, "prepare_cache", "%ss" % kind, exclusive=True) is None:
+				return False
+			self.prepared_caches[(absolute_file_path, kind)] = last_mod
+		return True
+
+	def expand_all(self, kind: str, project: str, filename: str, progress: Callable[[float], None] = None) -> bool:
+		"""
+		Expands all rows (kind "row") or columns (kind "col") of a loom
+		file into its .rows or .cols folder, 64 at a time, for background
+		jobs (see LoomJobQueue). Unlike iter_rows, this does not keep the
+		expanded rows in memory, so that it does not evict the cache.
+
+		Args:
+			progress:	Called with the fraction of rows done after each batch
+
+		Returns:
+			False if the loom file could not be accessed
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			return False
+		last_mod = self.last_mod(absolute_file_path)
+		cache_mod = load_gzipped_json_string("%s.%ss.lastmod.gzip" % (absolute_file_path, kind))
+		if not self.prepare_expansion(kind, project, filename, cache_mod, last_mod):
+			return False
+		dimensions = self.apply_expander(project, filename, "dimensions")
+		if dimensions is None:
+			return False
+		total = dimensions[0] if kind == "row" else dimensions[1]
+		cache_dir = "%s.%ss" % (absolute_file_path, kind)
+		method = "expand_rows" if kind == "row" else "expand_columns"
+		for start in range(0, total, 64):
+			missing = [i for i in range(start, min(start + 64, total)) if not os.path.isfile("%s/%06d.json.gzip" % (cache_dir, i))]
+			# the expander is acquired per batch, so that
+			# writers do not have to wait for the whole file
+			if len(missing) > 0 and self.apply_expander(project, filename, method, missing) is None:
+				return False
+			if progress is not None:
+				progress(min(start + 64, total) / total)
+		return True
+
+	def tile_all(self, project: str, filename: str, progress: Callable[[float], None] = None) -> bool:
+		"""
+		Renders all heatmap tiles of a loom file into its tile pack,
+		for background jobs (see LoomJobQueue). Tiles that are already
+		packed are skipped, so an interrupted job resumes where it stopped.
+
+		Args:
+			progress:	Called with the fraction of tiles done after each subtree
+
+		Returns:
+			False if the loom file could not be accessed, or the tiles could not be packed
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			return False
+		last_mod = self.last_mod(absolute_file_path)
+		dimensions = self.dimensions(project, filename)
+		if dimensions is None:
+			return False
+		(zmin, zmid, zmax) = dz_zoom_range(dimensions)
+		tile_pack = self.tile_pack(absolute_file_path)
+		# the loom file is held per subtree of up to 8x8 tiles at
+		# the middle zoom level (like expand_all does per batch),
+		# so that writers do not have to wait for the whole pyramid
+		z = max(zmin, zmid - 3)
+		span = 256 * 2**(zmid - z)
+		subtrees = [(x, y) for y in range(dimensions[0] // span + 1) for x in range(dimensions[1] // span + 1)]
+		for i, (x, y) in enumerate(subtrees):
+			if not tile_pack.has(z, x, y, last_mod) and not self.tile_subtree(project, filename, absolute_file_path, last_mod, x, y, z):
+				return False
+			if progress is not None:
+				progress((i + 1) / (len(subtrees) + 1))
+		# the zoomed out tiles on top are merged from the packed subtrees
+		if not tile_pack.has(zmin, 0, 0, last_mod) and not self.tile_subtree(project, filename, absolute_file_path, last_mod, 0, 0, zmin):
+			return False
+		# tiles are dropped when the loom file changed in the meantime
+		return tile_pack.has(zmin, 0, 0, last_mod)
+
+	def tile_subtree(self, project: str, filename: str, absolute_file_path: str, last_mod: str, x: int, y: int, z: int) -> bool:
+		"""
+		Renders the tile at x, y and z and all tiles it is composed of into
+		the tile pack, skipping tiles that are already packed (see tile_all).
+
+		Returns:
+			False if the loom file could not be accessed
+		"""
+		ranges = self.row_ranges(project, filename, absolute_file_path, last_mod)
+		if ranges is None:
+			return False
+		ds = self.connections.connect(project, filename, "r")
+		if ds is None:
+			return False
+		try:
+			tiles = LoomTiles(ds, ranges[0], ranges[1], tile_pack=self.tile_pack(absolute_file_path), last_mod=last_mod)
+			self.workers.apply(absolute_file_path, tiles.dz_get_zoom_tile, x, y, z)
+		finally:
+			self.connections.disconnect(project, filename, ds, "r")
+		return True
+
+	def row_ranges(self, project: str, filename: str, absolute_file_path: str, last_mod: str) -> Tuple[Any, Any]:
+		"""
+		Returns the mins and maxes of the rows of the matrix, which
+		are used to scale the values of every heatmap tile.
+
+		Computing them requires a pass over the whole matrix, so they
+		are computed once per version of the loom file, and concurrent
+		tile renders wait for that instead of starting their own pass.
+
+		Returns:
+			A (mins, maxes) tuple, or None if the loom file could not be accessed
+		"""
+		ranges_mod, mins, maxes = self.tile_ranges.get(absolute_file_path, ("", None, None))
+		if ranges_mod == last_mod:
+			return (mins, maxes)
+		key = (absolute_file_path, "tile_ranges", last_mod)
+		return self.flights.do(key, self.compute_row_ranges, project, filename, absolute_file_path, last_mod)
+
+	def compute_row_ranges(self, project: str, filename: str, absolute_file_path: str, last_mod: str) -> Tuple[Any, Any]:
+		"""
+		Computes the row ranges for row_ranges and keeps them in tile_ranges.
+		"""
+		ds = self.connections.connect(project, filename, "r")
+		if ds is None:
+			logging.debug("Could not connect to %s to compute row ranges", absolute_file_path)
+			return None
+		try:
+			tiles = LoomTiles(ds)
+			mins = self.workers.apply(absolute_file_path, tiles.mins)
+			maxes = self.workers.apply(absolute_file_path, tiles.maxes)
+		finally:
+			self.connections.disconnect(project, filename, ds, "r")
+		self.tile_ranges[absolute_file_path] = (last_mod, mins, maxes)
+		return (mins, maxes)
+
+	def is_expanded(self, kind: str, project: str, filename: str, args: List[int] = None) -> bool:
+		"""
+		Whether a request can be answered from the cache, without
+		expanding anything (see the Prefer: respond-async handling in loom_server).
+
+		Args:
+			kind (str):		"attributes", "row", "col", "tile", "correlation" or "markers"
+			args (list):	Row or column numbers, [z, x, y] for tiles, [row, method] for
+							correlations, or [attribute, group] for markers
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			# nothing to expand, let the request fail as usual
+			return True
+		last_mod = self.last_mod(absolute_file_path)
+		if kind == "attributes":
+			attributes, cached_mod = self.cache.get((absolute_file_path, "attributes")) or ("", "")
+			if attributes != "" and cached_mod == last_mod:
+				return True
+			attrs_mod = load_gzipped_json_string("%s.attrs.lastmod.gzip" % (absolute_file_path))
+			return attrs_mod >= last_mod and os.path.isfile("%s.attrs.json.gzip" % (absolute_file_path))
+		elif kind == "row" or kind == "col":
+			cache_mod = load_gzipped_json_string("%s.%ss.lastmod.gzip" % (absolute_file_path, kind))
+			return cache_mod >= last_mod and all(
+				(absolute_file_path, kind, last_mod, i) in self.cache or os.path.isfile("%s.%ss/%06d.json.gzip" % (absolute_file_path, kind, i))
+				for i in args
+			)
+		elif kind == "markers":
+			attribute = args[0]
+			if (absolute_file_path, "group_summaries", last_mod, attribute) in self.cache:
+				return True
+			# the group sizes are only known without the loom file if they are cached
+			groups = self.cache.get((absolute_file_path, "column_groups", last_mod, attribute))
+			return has_group_summaries(absolute_file_path, attribute, last_mod, groups[2] if groups is not None else None)
+		elif kind == "correlation":
+			row, method = args
+			return (
+				(absolute_file_path, "correlation", last_mod, row, method) in self.cache or
+				load_correlations(absolute_file_path, method, row, last_mod, 1000) is not None
+			)
+		elif kind == "tile":
+			z, x, y = args
+			return (
+				(absolute_file_path, "tile", last_mod, z, x, y) in self.cache or
+				self.tile_pack(absolute_file_path).has(z, x, y, last_mod) or
+				os.path.isfile("%s.tiles/z%02d/x%03d_y%03d.png" % (absolute_file_path, z, x, y))
+			)
+		return False
+
+	def iter_expanded(self, kind: str, numbers: List[int], project: str, filename: str, cache_mod: str, gzipped: bool = False) -> LoomStream:
+		"""
+		Streams rows (kind "row") or columns (kind "col") of which some
+		still have to be expanded, as the chunks of a JSON array.
+
+		Missing rows are expanded per 64-row HDF5 chunk and saved to the
+		cache. Rows that are already being expanded for a concurrent
+		request are not expanded again: the stream waits for
+		that expansion and shares its result (see LoomSingleFlight).
+
+		Args:
+			numbers (list of integers):	Sorted, unique row or column numbers
+			cache_mod (str):			Contents of the .rows.lastmod.gzip or .cols.lastmod.gzip file
+
+		Returns:
+			a LoomStream, or None if the loom file could not be accessed.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		last_mod = self.last_mod(absolute_file_path)
+		cache_dir = "%s.%ss" % (absolute_file_path, kind)
+
+		if not self.prepare_expansion(kind, project, filename, cache_mod, last_mod):
+			return None
+		dimensions = self.dimensions(project, filename)
+		if dimensions is None:
+			return None
+		# out of bounds rows are left out, instead of being expanded (to nothing) every time
+		chunks = list(iter_chunks(numbers, dimensions[0] if kind == "row" else dimensions[1]))
+		numbers = [i for chunk in chunks for i in chunk]
+
+		# Check that the expander can be acquired if this request will
+		# have to expand anything itself, so that a time-out can still be
+		# reported. It is released again right away: the expander is
+		# acquired per chunk in expand, and never held while the
+		# client downloads the expanded rows.
+		if any(
+			not (self.flights.in_flight((absolute_file_path, kind, last_mod, i)) or (absolute_file_path, kind, last_mod, i) in self.cache or os.path.isfile("%s/%06d.json.gzip" % (cache_dir, i)))
+			for i in numbers
+		):
+			logging.debug("Acquiring expander for uncached %ss", kind)
 			expander = self.connections.acquire_expander(project, filename)
 			if expander is None or expander.closed:
 				return None
-			expander.clear_rows()
+			expander.close(True)
 
-		if os.path.isdir(row_dir) and last_mod is row_mod:
-			logging.debug("%s.rows/ directory detected, loading expanded rows", filename)
+		def expand(numbers: List[int]) -> Dict[int, bytes]:
+			expanded = self.apply_expander(project, filename, "expand_rows" if kind == "row" else "expand_columns", numbers)
+			if expanded is None:
+				logging.debug("  Could not acquire expander, leaving out %ss %s", kind, numbers)
+				return {}
+			return expanded
+
+		def iter_items() -> Iterator[bytes]:
+			for chunk in chunks:
+				items = {}  # type: Dict[int, bytes]
+				leading = []  # type: List[int]
+				following = []  # type: List[int]
+				for i in chunk:
+					key = (absolute_file_path, kind, last_mod, i)
+					item = self.cache.get(key)
+					if item is not None:
+						expansion_items.inc(kind, "memory")
+					elif not self.flights.in_flight(key):
+						item = self.cached_file(key, "%s/%06d.json.gzip" % (cache_dir, i))
+						if len(item) == 0:
+							item = None
+					if item is not None:
+						items[i] = item
+					elif self.flights.begin(key):
+						leading.append(i)
+					else:
+						following.append(i)
+
+				if len(leading) > 0:
+					try:
+						expanded = expand(leading)
+					except BaseException as e:
+						for i in leading:
+							self.flights.fail((absolute_file_path, kind, last_mod, i), e)
+						raise
+					expansion_items.inc(kind, "expanded", amount=len(expanded))
+					for i in leading:
+						key = (absolute_file_path, kind, last_mod, i)
+						item = expanded.get(i)
+						if item is not None:
+							self.cache.put(key, item)
+							items[i] = item
+						self.flights.finish(key, item)
+
+				retry = []  # type: List[int]
+				for i in following:
+					item = self.flights.wait((absolute_file_path, kind, last_mod, i))
+					if item is not None:
+						expansion_items.inc(kind, "shared")
+					else:
+						# the expansion failed or finished before we could wait for it
+						item = self.cached_file((absolute_file_path, kind, last_mod, i), "%s/%06d.json.gzip" % (cache_dir, i))
+					if len(item or b"") > 0:
+						items[i] = item
+					else:
+						retry.append(i)
+				if len(retry) > 0:
+					expanded = expand(retry)
+					expansion_items.inc(kind, "expanded", amount=len(expanded))
+					items.update(expanded)
+
+				for i in sorted(items):
+					yield items[i] if gzipped else gunzip_string(items[i])
+
+		return LoomStream(iter_json_array(iter_items(), gzipped))
+
+	def gene_index(self, project: str, filename: str) -> Tuple[Dict[str, int], Dict[str, int]]:
+		"""
+		Returns dictionaries mapping gene names (and lowercase gene
+		names) to row numbers for a loom file, or None if the loom
+		file could not be accessed. Kept in the cache until the loom file changes.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			return None
+		last_mod = self.last_mod(absolute_file_path)
+		key = (absolute_file_path, "gene_index", last_mod)
+		index = self.cache.get(key)
+		if index is None:
+			names = self.flights.do(key, self.apply_expander, project, filename, "gene_names")
+			if names is None:
+				return None
+			genes = {}  # type: Dict[str, int]
+			genes_lowercase = {}  # type: Dict[str, int]
+			# first occurrence wins, like in the client
+			for i, name in enumerate(names):
+				genes.setdefault(name, i)
+				genes_lowercase.setdefault(name.lower(), i)
+			index = (genes, genes_lowercase)
+			# rough estimate of the memory used by both dictionaries
+			self.cache.put(key, index, sum(2 * (len(name) + 100) for name in names))
+		return index
+
+	def gene_rows(self, genes: List[str], project: str, filename: str) -> List[int]:
+		"""
+		Returns the row numbers of the given gene names (matched exactly,
+		otherwise case-insensitively). Unknown genes are left out.
+		"""
+		index = self.gene_index(project, filename)
+		if index is None:
+			return []
+		exact, lowercase = index
+		row_numbers = []
+		for gene in genes:
+			i = exact.get(gene)
+			if i is None:
+				i = lowercase.get(gene.lower())
+			if i is not None:
+				row_numbers.append(i)
+		return row_numbers
+
+	def search_index(self, project: str, filename: str) -> LoomSearchIndex:
+		"""
+		Returns the search index of the row attributes of a loom file
+		(see LoomExpand.search_index), or None if the loom file could
+		not be accessed. Kept in the cache until the loom file changes.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			return None
+		key = (absolute_file_path, "search_index", self.last_mod(absolute_file_path))
+		index = self.cache.get(key)
+		if index is None:
+			index = self.flights.do(key, self.apply_expander, project, filename, "search_index")
+			if index is None:
+				return None
+			self.cache.put(key, index, index.nbytes)
+		return index
+
+	def JSON_search(self, project: str, filename: str, query: str, limit: int = 20, attribute: str = None, fuzzy: bool = True) -> str:
+		"""
+		Finds rows of a loom file by the values of their string
+		attributes, for autocompletion (see LoomSearchIndex.search).
+
+		Returns:
+			a JSON object with the query and the matching rows:
+
+				{"query": "actb", "results": [{"row": 42, "attribute": "Gene", "value": "Actb", "match": "exact"}, ...]}
+
+			or None if the loom file could not be accessed.
+		"""
+		index = self.search_index(project, filename)
+		if index is None:
+			return None
+		with phase("search"):
+			results = index.search(query, limit, attribute, fuzzy)
+		return json.dumps({"query": query, "results": results})
+
+	def column_index(self, project: str, filename: str, attribute: str) -> Dict[str, Any]:
+		"""
+		Returns a dictionary of the values of a column attribute to
+		sorted arrays of the columns with that value (see
+		LoomExpand.column_attribute_index), or None if there is no
+		such attribute. Kept in the cache until the loom file changes.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			return None
+		last_mod = self.last_mod(absolute_file_path)
+		key = (absolute_file_path, "column_index", last_mod, attribute)
+		index = self.cache.get(key)
+		if index is None:
+			index = self.flights.do(key, self.apply_expander, project, filename, "column_attribute_index", attribute)
+			if index is None:
+				return None
+			self.cache.put(key, index, sum(columns.nbytes + len(value) + 100 for value, columns in index.items()))
+		return index
+
+	def column_groups(self, project: str, filename: str, attribute: str) -> Tuple[List[str], Any, Any]:
+		"""
+		Returns the groups of columns by the values of a column attribute
+		(see LoomExpand.column_groups), or None if there is no such
+		attribute. Kept in the cache until the loom file changes.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			return None
+		last_mod = self.last_mod(absolute_file_path)
+		key = (absolute_file_path, "column_groups", last_mod, attribute)
+		groups = self.cache.get(key)
+		if groups is None:
+			groups = self.flights.do(key, self.apply_expander, project, filename, "column_groups", attribute)
+			if groups is None:
+				return None
+			names, inverse, counts = groups
+			self.cache.put(key, groups, inverse.nbytes + counts.nbytes + sum(len(name) + 50 for name in names))
+		return groups
+
+	def group_summaries(self, project: str, filename: str, attribute: str) -> Tuple[Any, Any, Any]:
+		"""
+		Returns the sums, sums of squares and non-zero counts of every
+		row per group of columns by a column attribute (see
+		LoomExpand.group_summaries), or None if there is no such
+		attribute. Kept in the cache until the loom file changes.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			return None
+		groups = self.column_groups(project, filename, attribute)
+		if groups is None:
+			return None
+		names, inverse, counts = groups
+		key = (absolute_file_path, "group_summaries", self.last_mod(absolute_file_path), attribute)
+		summaries = self.cache.get(key)
+		if summaries is None:
+			summaries = self.flights.do(key, self.apply_expander, project, filename, "group_summaries", attribute, inverse, counts)
+			if summaries is None:
+				return None
+			self.cache.put(key, summaries, sum(summary.nbytes for summary in summaries))
+		return summaries
+
+	def JSON_markers(self, project: str, filename: str, attribute: str, group: str, n: int = 100) -> str:
+		"""
+		Ranks the rows that distinguish a group of columns (those with
+		the given value of a column attribute) from all other columns
+		by Welch's t statistic (see `marker_statistics` in loom_expand).
+		Only the first query per attribute reads the matrix.
+
+		Returns:
+			a JSON object with the group, its size and the n highest
+			ranked rows, leaving out rows without variance:
+
+				{"attribute": "Clusters", "group": "3", "size": 120, "results": [{"row": 42,
+				"t": 25.1, "log2FoldChange": 2.3, "mean": 4.2, "meanRest": 0.5, "nonzero": 0.9, "nonzeroRest": 0.2}, ...]}
+
+			or None if the loom file could not be accessed or has no such attribute or group.
+		"""
+		groups = self.column_groups(project, filename, attribute)
+		if groups is None:
+			return None
+		names, inverse, counts = groups
+		if group not in names:
+			return None
+		summaries = self.group_summaries(project, filename, attribute)
+		if summaries is None:
+			return None
+		sums, sums_of_squares, nonzero = summaries
+		g = names.index(group)
+		with phase("markers"):
+			statistics = marker_statistics(sums, sums_of_squares, nonzero, counts, g)
+			t = statistics["t"]
+			ranked = np.flatnonzero(np.isfinite(t))
+			ranked = ranked[np.argsort(-t[ranked], kind="stable")][:n]
+			results = []  # type: List[Dict[str, Any]]
+			for i in ranked.tolist():
+				result = {name: float(values[i]) for name, values in statistics.items()}
+				result["row"] = i
+				results.append(result)
+		return json.dumps({
+			"attribute": attribute,
+			"group": group,
+			"size": int(counts[g]),
+			"results": results,
+		})
+
+	def JSON_row_groups(self, row_numbers: List[int], attribute: str, project: str, filename: str, quantiles: Tuple[float, ...] = (0.25, 0.5, 0.75)) -> str:
+		"""
+		Aggregates rows per group of columns with the same value of a
+		column attribute: the mean, fraction of non-zero values and
+		quantiles of every row per group (see `group_statistics` in
+		loom_expand). The statistics of each row are cached per
+		attribute and quantiles until the loom file changes.
+
+		Returns:
+			a JSON object with the attribute, the names and sizes of the
+			groups, and the statistics per row (same order as the groups):
 
+				{"attribute": "Class", "groups": [...], "counts": [...], "quantiles": [0.25, 0.5, 0.75],
+				"rows": [{"idx": 0, "mean": [...], "nonzero": [...], "0.25": [...], "0.5": [...], "0.75": [...]}, ...]}
+
+			or None if the loom file could not be accessed or has no such attribute.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			logging.debug("Invalid or inaccessible path to loom file")
+			return None
+		groups = self.column_groups(project, filename, attribute)
+		if groups is None:
+			return None
+		names, inverse, counts = groups
+		last_mod = self.last_mod(absolute_file_path)
+		quantiles = tuple(quantiles)
+
+		row_numbers = sorted(set(row_numbers))
+		rows = {}  # type: Dict[int, str]
+		missing = []  # type: List[int]
 		for i in row_numbers:
-			row_file_name = "%s/%06d.json.gzip" % (row_dir, i)
-			if os.path.exists(row_file_name):
-				retRows.append(load_gzipped_json_string(row_file_name))
-				retRows.append(comma)
+			row = self.cache.get((absolute_file_path, "row_groups", last_mod, attribute, quantiles, i))
+			if row is None:
+				missing.append(i)
 			else:
-				unexpanded.append(i)
+				rows[i] = row
+		if len(missing) > 0:
+			key = (absolute_file_path, "row_groups", last_mod, attribute, quantiles, tuple(missing))
+			aggregated = self.flights.do(key, self.apply_expander, project, filename, "aggregate_rows", missing, inverse, counts, quantiles)
+			if aggregated is None:
+				return None
+			for i, statistics in aggregated.items():
+				statistics["idx"] = i
+				row = json.dumps(statistics)
+				self.cache.put((absolute_file_path, "row_groups", last_mod, attribute, quantiles, i), row)
+				rows[i] = row
+
+		return '{"attribute": %s, "groups": %s, "counts": %s, "quantiles": %s, "rows": [%s]}' % (
+			json.dumps(attribute),
+			json.dumps(names),
+			json.dumps(counts.tolist()),
+			json.dumps(list(quantiles)),
+			",".join(rows[i] for i in row_numbers if i in rows),
+		)
+
+	def dimensions(self, project: str, filename: str) -> Tuple[int, int]:
+		"""
+		Returns the number of rows and columns of a loom file, or None
+		if it could not be accessed. Kept in the cache until the loom file changes.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			return None
+		key = (absolute_file_path, "dimensions", self.last_mod(absolute_file_path))
+		dimensions = self.cache.get(key)
+		if dimensions is None:
+			dimensions = self.flights.do(key, self.apply_expander, project, filename, "dimensions")
+			if dimensions is None:
+				return None
+			self.cache.put(key, dimensions, 100)
+		return dimensions
 
-		if len(unexpanded) is 0:
-			retRows[len(retRows) - 1] = "]"
-		elif len(unexpanded) > 0:
-			logging.debug("Acquiring expander for uncached rows")
-			if expander is None or expander.closed:
-				expander = self.connections.acquire_expander(project, filename)
-			if expander is None or expander.closed:
+	def scatter_pyramid(self, project: str, filename: str, x_attribute: str, y_attribute: str) -> LoomScatterPyramid:
+		"""
+		Returns the binned cells of an embedding (see LoomScatterPyramid),
+		or None if either attribute does not exist or is not numeric.
+		Kept in the cache until the loom file changes.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			return None
+		last_mod = self.last_mod(absolute_file_path)
+		key = (absolute_file_path, "scatter_pyramid", last_mod, x_attribute, y_attribute)
+		pyramid = self.cache.get(key)
+		if pyramid is None:
+			pyramid = self.flights.do(key, self.apply_expander, project, filename, "scatter_pyramid", x_attribute, y_attribute)
+			if pyramid is None:
 				return None
-			logging.debug("Expanding for uncached rows")
-			expanded_rows, _ = expander.selected_rows(unexpanded)
-			logging.debug("Closing expander")
-			expander.close(True)
-			if len(row_numbers) is len(unexpanded):
-				# all rows were newly expanded
-				return expanded_rows
-			# remember, expanded_rows is a string already!
-			retRows.append(expanded_rows[1:])
-		retRows_json = "".join(retRows)
-		return retRows_json
+			self.cache.put(key, pyramid, pyramid.nbytes)
+		return pyramid
 
-	def JSON_columns(self, column_numbers: List[int], project: str, filename: str) -> str:
+	def JSON_scatter(self, project: str, filename: str, x_attribute: str, y_attribute: str, bins: int, viewport: Tuple[float, float, float, float] = None, row: int = None, attribute: str = None) -> str:
 		"""
-		Generates expanded columns for a loom file.
+		Bins the cells of a loom file over two column attributes
+		(see LoomScatterPyramid.aggregate), optionally with the mean
+		of a row or of a numeric column attribute per bin.
 
 		Args:
-			column_numbers (list of integers):	List of the row numbers to expand.
+			x_attribute, y_attribute (str):		Column attributes to use as coordinates (e.g. "_tSNE1", "_tSNE2")
+			bins (int):							Number of bins per axis
+			viewport (tuple):					(xmin, ymin, xmax, ymax), or None for all cells
+			row (int):							Row to average per bin
+			attribute (str):					Numeric column attribute to average per bin (if no row is given)
+
+		Returns:
+			The JSON serialisation of the binned cells, or None if the loom
+			file, the attributes or the row could not be accessed.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			logging.debug("Invalid or inaccessible path to loom file")
+			return None
+		last_mod = self.last_mod(absolute_file_path)
+		key = (absolute_file_path, "scatter", last_mod, x_attribute, y_attribute, bins, viewport, row, attribute)
+		scatter = self.cache.get(key)
+		if scatter is not None:
+			return scatter
+
+		pyramid = self.scatter_pyramid(project, filename, x_attribute, y_attribute)
+		if pyramid is None:
+			return None
+		values = None
+		if row is not None:
+			dimensions = self.dimensions(project, filename)
+			if dimensions is None or row < 0 or row >= dimensions[0]:
+				return None
+			rows = self.apply_expander(project, filename, "read_rows", [row])
+			if rows is None:
+				return None
+			values = rows[row]
+		elif attribute is not None:
+			values = self.apply_expander(project, filename, "numeric_column_attribute", attribute)
+			if values is None:
+				return None
+		scatter = self.workers.apply(absolute_file_path, pyramid.aggregate, bins, viewport, values)
+		scatter["x"] = x_attribute
+		scatter["y"] = y_attribute
+		scatter = json.dumps(scatter)
+		self.cache.put(key, scatter)
+		return scatter
+
+	def JSON_correlation(self, project: str, filename: str, row: int, method: str = "pearson", n: int = 100) -> str:
+		"""
+		Finds the rows most correlated with a row (see
+		LoomExpand.correlate_row). The 1000 most correlated rows are
+		saved per row and method, and the norms of all rows are cached
+		per method, until the loom file changes.
+
+		Args:
+			method (str):	"pearson" or "spearman"
+			n (int):		Number of rows to return, at most 1000
+
+		Returns:
+			a JSON object with the row, the method and the most correlated rows:
+
+				{"row": 42, "method": "pearson", "results": [{"row": 7, "r": 0.93}, ...]}
+
+			or None if the loom file could not be accessed or the row is out of bounds.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			logging.debug("Invalid or inaccessible path to loom file")
+			return None
+		last_mod = self.last_mod(absolute_file_path)
+		key = (absolute_file_path, "correlation", last_mod, row, method)
+		top = self.cache.get(key)
+		if top is None:
+			top = load_correlations(absolute_file_path, method, row, last_mod, 1000)
+			if top is not None:
+				self.cache.put(key, top, 100 * len(top))
+		if top is None:
+			norms_key = (absolute_file_path, "row_norms", last_mod, method)
+			norms = self.cache.get(norms_key)
+			correlated = self.flights.do(key, self.apply_expander, project, filename, "correlate_row", row, method, 1000, norms)
+			if correlated is None:
+				return None
+			top, norms = correlated
+			self.cache.put(norms_key, norms, norms.nbytes)
+			self.cache.put(key, top, 100 * len(top))
+		return json.dumps({
+			"row": row,
+			"method": method,
+			"results": [{"row": i, "r": r} for i, r in top[:n]],
+		})
+
+	def select_columns(self, project: str, filename: str, column_numbers: List[int] = None, column_range: Tuple[int, int] = None, filters: Dict[str, List[str]] = None) -> List[int]:
+		"""
+		Selects columns of a loom file by number, by range and by the
+		values of column attributes. All given criteria must match.
+
+		Args:
+			column_numbers (list of integers):	Column numbers
+			column_range (tuple):				Half-open range (start, end) of column numbers
+			filters (dict):						Column attribute name to accepted values (e.g. {"Class": ["Neurons"]}),
+												compared to the values as strings
+
+		Returns:
+			The sorted column numbers, or None if no criteria were given (meaning all columns).
+			If the loom file could not be accessed, nothing is selected.
+
+		Raises:
+			ValueError if a filter is on a column attribute that does not exist.
+		"""
+		selection = None  # type: np.ndarray
+		if column_numbers is not None:
+			selection = np.unique(np.asarray(column_numbers, dtype=np.int64))
+		for attribute, values in (filters or {}).items():
+			index = self.column_index(project, filename, attribute)
+			if index is None:
+				if self.dimensions(project, filename) is None:
+					return []
+				raise ValueError("Unknown column attribute %s" % attribute)
+			matched = [index[value] for value in values if value in index]
+			matched = np.unique(np.concatenate(matched)) if len(matched) > 0 else np.empty(0, dtype=np.int64)
+			selection = matched if selection is None else np.intersect1d(selection, matched, assume_unique=True)
+		if column_range is not None:
+			start, end = column_range
+			if selection is None:
+				dimensions = self.dimensions(project, filename)
+				if dimensions is None:
+					return []
+				selection = np.arange(max(start, 0), min(end, dimensions[1]))
+			else:
+				selection = selection[(selection >= start) & (selection < end)]
+		if selection is None:
+			return None
+		return selection.tolist()
+
+	def iter_rows_columns(self, row_numbers: List[int], column_numbers: List[int], project: str, filename: str, gzipped: bool = False) -> LoomStream:
+		"""
+		Streams rows restricted to a subset of columns as the chunks of
+		a JSON array (see iter_rows). These are read from the loom file
+		per HDF5 chunk and are not cached. The loom file is acquired per
+		chunk, and not held while the client downloads the rows.
+
+		The array starts with the selected columns (sorted, each included
+		once, out of bounds columns left out), followed by the rows:
+
+			[{"columns": [1, 5, 9]}, {"idx": 42, "data": [0, 3, 1]}, ...]
+
+		Returns:
+			a LoomStream, or None if the loom file could not be accessed.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			logging.debug("Invalid or inaccessible path to loom file")
+			return None
+		dimensions = self.dimensions(project, filename)
+		if dimensions is None:
+			return None
+		column_numbers = valid_columns(column_numbers, dimensions)
+		columns = json.dumps({"columns": column_numbers})
+		if len(column_numbers) == 0:
+			# nothing to read, and metadata_array cannot summarise an empty row
+			items = [columns] + [json.dumps({"idx": i, "data": EMPTY_METADATA_ARRAY}) for chunk in iter_chunks(row_numbers, dimensions[0]) for i in chunk]
+			if gzipped:
+				items = [gzip_string(item) for item in items]
+			return LoomStream(iter_json_array(items, gzipped))
+
+		def iter_items() -> Iterator[AnyStr]:
+			yield gzip_string(columns) if gzipped else columns
+			for chunk in iter_chunks(row_numbers, dimensions[0]):
+				rows = self.apply_expander(project, filename, "rows_columns", chunk, column_numbers, gzipped)
+				if rows is None:
+					logging.debug("  Could not acquire expander, leaving out rows %s", chunk)
+					continue
+				yield from rows
+
+		return LoomStream(iter_json_array(iter_items(), gzipped))
+
+	def binary_rows_columns(self, row_numbers: List[int], column_numbers: List[int], project: str, filename: str) -> bytes:
+		"""
+		Like iter_rows_columns, but returns the rows as concatenated
+		binary records (see `binary_array` in loom_utils), after a
+		record with the selected columns as data and BINARY_COLUMNS_IDX as idx.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			logging.debug("Invalid or inaccessible path to loom file")
+			return None
+		dimensions = self.dimensions(project, filename)
+		if dimensions is None:
+			return None
+		column_numbers = valid_columns(column_numbers, dimensions)
+		if len(column_numbers) == 0:
+			# nothing to read from the loom file
+			rows = b"".join(binary_array(i, np.empty(0)) for chunk in iter_chunks(row_numbers, dimensions[0]) for i in chunk)
+		else:
+			rows = self.apply_expander(project, filename, "selected_rows_columns_binary", row_numbers, column_numbers)
+		if rows is None:
+			return None
+		return binary_array(BINARY_COLUMNS_IDX, np.array(column_numbers, dtype=np.int64)) + rows
+
+	def cached_file(self, key: Tuple, file_path: str) -> bytes:
+		"""
+		Returns the contents of a cache file, keeping it in memory
+		for subsequent requests. The key must start with the absolute
+		path of the loom file, and include its last_mod.
+		Returns empty bytes if the file does not exist.
+		"""
+		data = self.cache.get(key)
+		if data is None:
+			with phase("cache_read"):
+				data = load_binary(file_path)
+			if len(data) > 0:
+				self.cache.put(key, data)
+				expansion_items.inc(key[1], "disk")
+		else:
+			expansion_items.inc(key[1], "memory")
+		return data
+
+	def gzipped_attributes(self, project: str, filename: str) -> bytes:
+		"""
+		Like JSON_attributes, but returns the gzipped cache file as-is,
+		so that it can be served with `Content-Encoding: gzip`
+		instead of being decompressed and compressed again.
+
+		Returns:
+			the gzipped JSON serialisation of the attributes for the loom file at project/filename.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			logging.debug("  Invalid or inaccessible path to loom file")
+			return None
+
+		attrs_name = "%s.attrs.json.gzip" % (absolute_file_path)
+		last_mod = self.last_mod(absolute_file_path)
+		key = (absolute_file_path, "attributes_gzip", last_mod)
+		attributes = self.cache.get(key)
+		if attributes is None:
+			# validates the cache file, and expands it if necessary
+			if self.JSON_attributes(project, filename) is None:
+				return None
+			attributes = load_binary(attrs_name)
+			self.cache.put(key, attributes)
+		return attributes
+
+	def binary_rows(self, row_numbers: List[int], project: str, filename: str) -> bytes:
+		"""
+		Generates expanded rows for a loom file in the binary format
+		(see `binary_array` in loom_utils).
+
+		Args:
+			row_numbers (list of integers):	List of the row numbers to expand.
 			project (string): 					Name of the project (e.g. "Midbrain")
 			filename (string): 					Filename of the loom file (e.g. "Midbrain_20160701.loom")
 
 		Returns:
-			a string of the JSON serialision of the selected column numbers for the loom file at project/filename.
+			the concatenated binary records of the selected row numbers for the loom file at project/filename.
 		"""
-
 		absolute_file_path = self.list.absolute_file_path(project, filename)
-		if absolute_file_path is "":
+		if absolute_file_path == "":
 			logging.debug("Invalid or inaccessible path to loom file")
 			return None
 
-		# make sure all columns are included only once
-		column_numbers = list(set(column_numbers))
+		# make sure all rows are included only once
+		row_numbers = sorted(set(row_numbers))
 
-		if len(column_numbers) is 0:
-			return "[]"
+		if len(row_numbers) == 0:
+			return b""
 
-		column_numbers.sort()
-		retCols = ["["]
-		comma = ","
+		row_dir = "%s.rows_bin" % (absolute_file_path)
+		row_mod_filename = "%s.rows_bin.lastmod.gzip" % absolute_file_path
+		row_mod = load_gzipped_json_string(row_mod_filename)
+		last_mod = self.last_mod(absolute_file_path)
 
+		retRows = []
 		unexpanded = []
+		if row_mod < last_mod:
+			# stale cache, selected_rows_binary will clear it
+			unexpanded = row_numbers
+		else:
+			for i in row_numbers:
+				row = self.cached_file((absolute_file_path, "row_bin", last_mod, i), "%s/%06d.bin" % (row_dir, i))
+				if len(row) == 0:
+					unexpanded.append(i)
+				else:
+					retRows.append(row)
+
+		if len(unexpanded) > 0:
+			logging.debug("Acquiring expander for uncached binary rows")
+			# clearing stale cache requires exclusive access
+			stale = row_mod < last_mod and os.path.isdir(row_dir)
+			# identical concurrent requests share a single expansion
+			key = (absolute_file_path, "row_bin", last_mod, tuple(unexpanded))
+			expanded = self.flights.do(key, self.apply_expander, project, filename, "selected_rows_binary", unexpanded, exclusive=stale)
+			if expanded is None:
+				return None
+			expanded_rows, _ = expanded
+			expansion_items.inc("row_bin", "expanded", amount=len(unexpanded))
+			retRows.append(expanded_rows)
 
-		col_dir = "%s.cols" % (absolute_file_path)
+		return b"".join(retRows)
 
-		col_mod_filename = "%s.cols.lastmod.gzip" % absolute_file_path
+	def binary_columns(self, column_numbers: List[int], project: str, filename: str) -> bytes:
+		"""
+		Generates expanded columns for a loom file in the binary format
+		(see `binary_array` in loom_utils).
+
+		Args:
+			column_numbers (list of integers):	List of the column numbers to expand.
+			project (string): 					Name of the project (e.g. "Midbrain")
+			filename (string): 					Filename of the loom file (e.g. "Midbrain_20160701.loom")
+
+		Returns:
+			the concatenated binary records of the selected column numbers for the loom file at project/filename.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			logging.debug("Invalid or inaccessible path to loom file")
+			return None
+
+		# make sure all columns are included only once
+		column_numbers = sorted(set(column_numbers))
+
+		if len(column_numbers) == 0:
+			return b""
+
+		col_dir = "%s.cols_bin" % (absolute_file_path)
+		col_mod_filename = "%s.cols_bin.lastmod.gzip" % absolute_file_path
 		col_mod = load_gzipped_json_string(col_mod_filename)
 		last_mod = self.last_mod(absolute_file_path)
-		expander = None
 
+		retCols = []
+		unexpanded = []
 		if col_mod < last_mod:
-			expander = self.connections.acquire_expander(project, filename)
-			if expander is None or expander.closed:
+			# stale cache, selected_columns_binary will clear it
+			unexpanded = column_numbers
+		else:
+			for i in column_numbers:
+				column = self.cached_file((absolute_file_path, "col_bin", last_mod, i), "%s/%06d.bin" % (col_dir, i))
+				if len(column) == 0:
+					unexpanded.append(i)
+				else:
+					retCols.append(column)
+
+		if len(unexpanded) > 0:
+			logging.debug("Acquiring expander for uncached binary columns")
+			# clearing stale cache requires exclusive access
+			stale = col_mod < last_mod and os.path.isdir(col_dir)
+			# identical concurrent requests share a single expansion
+			key = (absolute_file_path, "col_bin", last_mod, tuple(unexpanded))
+			expanded = self.flights.do(key, self.apply_expander, project, filename, "selected_columns_binary", unexpanded, exclusive=stale)
+			if expanded is None:
 				return None
-			expander.clear_rows()
+			expanded_cols, _ = expanded
+			expansion_items.inc("col_bin", "expanded", amount=len(unexpanded))
+			retCols.append(expanded_cols)
 
-		if os.path.isdir(col_dir) and last_mod is col_mod:
-			logging.debug("%s.cols/ directory detected, loading expanded columns", filename)
+		return b"".join(retCols)
 
-		for i in column_numbers:
-			col_file_name = "%s/%06d.json.gzip" % (col_dir, i)
-			if os.path.exists(col_file_name):
-				retCols.append(load_gzipped_json_string(col_file_name))
-				retCols.append(comma)
-			else:
-				unexpanded.append(i)
+	def tile_pack(self, absolute_file_path: str) -> LoomTilePack:
+		tile_pack = self.tile_packs.get(absolute_file_path)
+		if tile_pack is None:
+			tile_pack = LoomTilePack(absolute_file_path)
+			self.tile_packs[absolute_file_path] = tile_pack
+		return tile_pack
 
-		if len(unexpanded) is 0:
-			retCols[len(retCols) - 1] = "]"
-		elif len(unexpanded) > 0:
-			logging.debug("Acquiring expander for uncached columns")
-			if expander is None or expander.closed:
-				expander = self.connections.acquire_expander(project, filename)
-			if expander is None or expander.closed:
-				return None
-			logging.debug("Expanding for uncached rows")
-			expanded_cols, _ = expander.selected_columns(unexpanded)
-			logging.debug("Closing expander")
-			expander.close(True)
-			if len(column_numbers) is len(unexpanded):
-				# all columns were newly expanded
-				return expanded_cols
-			# remember, expanded_cols is a string already!
-			retCols.append(expanded_cols[1:])
+	def packed_tile(self, project: str, filename: str, z: int, x: int, y: int) -> bytes:
+		"""
+		Returns the PNG bytes of a tile from the tile pack of the loom
+		file, or None if it was not packed (for the current version
+		of the loom file).
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			return None
+		png = self.tile_pack(absolute_file_path).get(z, x, y, self.last_mod(absolute_file_path))
+		if png is not None:
+			expansion_items.inc("tile", "disk")
+		return png
+
+	def tile_png(self, project: str, filename: str, z: int, x: int, y: int) -> bytes:
+		"""
+		Returns a heatmap tile from memory, the .tiles folder or the tile
+		pack, or renders it on demand when it was not pre-generated with
+		`loom tile`. Recently used tiles are kept in memory, and each
+		rendered tile is appended to the tile pack of the loom file.
 
-		return "".join(retCols)
+		Args:
+			project (string): 		Name of the project (e.g. "Midbrain")
+			filename (string): 		Filename of the loom file (e.g. "Midbrain_20160701.loom")
+			z, x, y (int):			Zoom level and position of the tile
 
-	def tile(self, project: str, filename: str, truncate: bool = False) -> None:
+		Returns:
+			The PNG image as bytes, or None if the tile is out of bounds
+			or the loom file could not be accessed.
+		"""
+		absolute_file_path = self.list.absolute_file_path(project, filename)
+		if absolute_file_path == "":
+			logging.debug("Invalid or inaccessible path to loom file")
+			return None
+
+		last_mod = self.last_mod(absolute_file_path)
+		key = (absolute_file_path, "tile", last_mod, z, x, y)
+		png = self.cache.get(key)
+		if png is not None:
+			expansion_items.inc("tile", "memory")
+			return png
+		tile_path = "%s.tiles/z%02d/x%03d_y%03d.png" % (absolute_file_path, z, x, y)
+		if os.path.isfile(tile_path):
+			with open(tile_path, "rb") as f:
+				png = f.read()
+		else:
+			png = self.tile_pack(absolute_file_path).get(z, x, y, last_mod)
+		if png is not None:
+			expansion_items.inc("tile", "disk")
+			self.cache.put(key, png)
+			return png
+		# a tile is typically requested by several clients viewing the
+		# same heatmap at once, so render it only once
+		return self.flights.do(key, self.render_tile, project, filename, absolute_file_path, last_mod, z, x, y)
+
+	def render_tile(self, project: str, filename: str, absolute_file_path: str, last_mod: str, z: int, x: int, y: int) -> bytes:
+		"""
+		Renders a tile for tile_png, caches it and adds it to the tile pack.
+
+		Tiles at the middle zoom level (where pixels correspond to values)
+		are read from the matrix. Zoomed out tiles are merged from the
+		four tiles of the next zoom level, which are fetched (or rendered)
+		with tile_png first. That way every tile of the pyramid is rendered
+		at most once per version of the loom file, and the loom file is
+		only held while rendering a single tile.
+		"""
+		dimensions = self.dimensions(project, filename)
+		if dimensions is None or not dz_tile_in_bounds(dimensions, x, y, z):
+			return None
+		(zmin, zmid, zmax) = dz_zoom_range(dimensions)
+		children = None  # type: List[bytes]
+		if z < zmid:
+			children = []
+			for (child_x, child_y) in ((x * 2, y * 2), (x * 2 + 1, y * 2), (x * 2, y * 2 + 1), (x * 2 + 1, y * 2 + 1)):
+				if not dz_tile_in_bounds(dimensions, child_x, child_y, z + 1):
+					# merged as an empty tile
+					children.append(None)
+					continue
+				png = self.tile_png(project, filename, z + 1, child_x, child_y)
+				if png is None:
+					return None
+				children.append(png)
+
+		ranges = (None, None)  # type: Tuple[Any, Any]
+		if children is None:
+			ranges = self.row_ranges(project, filename, absolute_file_path, last_mod)
+			if ranges is None:
+				return None
+
+		key = (absolute_file_path, "tile", last_mod, z, x, y)
+		ds = self.connections.connect(project, filename, "r")
+		if ds is None:
+			logging.debug("Could not connect to %s to render tile", absolute_file_path)
+			return None
+		try:
+			tiles = LoomTiles(ds, ranges[0], ranges[1])
+			if children is not None:
+				png = self.workers.apply(absolute_file_path, tiles.dz_merge_tile_png, x, y, z, children)
+			else:
+				png = self.workers.apply(absolute_file_path, tiles.dz_tile_png, x, y, z)
+		finally:
+			self.connections.disconnect(project, filename, ds, "r")
+
+		if png is not None:
+			expansion_items.inc("tile", "expanded")
+			self.cache.put(key, png)
+			# appending locks the pack file, which must not block the hub
+			gevent.spawn(self.workers.apply, absolute_file_path, self.tile_pack(absolute_file_path).put, z, x, y, png, last_mod)
+		return png
+
+	def tile(self, project: str, filename: str, truncate: bool = False, pack: bool = False) -> None:
 		absolute_path = self.list.absolute_file_path(project, filename)
 		ds = None
 		if absolute_path is not "":
@@ -786,7 +1987,7 @@ class LoomDatasets(object):
 				lock = self.connections.dataset_locks.get(absolute_path)
 				if lock is not None and lock.acquire(blocking=True, timeout=10):
 					ds = LoomConnection(absolute_path, 'r')
-					tiles = LoomTiles(ds)
+					tiles = LoomTiles(ds, tile_pack=self.tile_pack(absolute_path) if pack else None, verbose=True)
 					tiles.prepare_heatmap(truncate)
 					ds.close()
 					lock.release()
@@ -797,3 +1998,22 @@ class LoomDatasets(object):
 					ds.close()
 					lock.release()
 				pass
+
+	def migrate_tiles(self, project: str, filename: str) -> int:
+		"""
+		Import the PNG tiles in the .tiles folder of a loom file into its tile pack.
+
+		Returns:
+			The number of imported tiles.
+		"""
+		absolute_path = self.list.absolute_file_path(project, filename)
+		if absolute_path == "":
+			return 0
+		# the tiles are assumed to be rendered from the current version of the loom file
+		ds = LoomConnection(absolute_path, 'r')
+		try:
+			last_mod = ds.last_modified()
+		finally:
+			ds.close()
+		return self.tile_pack(absolute_path).import_tile_dir("%s.tiles/" % (absolute_path), last_mod)
+
@@ -0,0 +1,210 @@
+from typing import *
+
+import os
+import time
+import calendar
+import logging
+
+import flask
+import gevent
+import gevent.socket
+import gevent.pywsgi as wsgi
+
+from wsgiref.handlers import format_date_time
+
+from .loom_metrics import record_request
+
+
+class LoomRateLimiter(object):
+	"""
+	Keeps the average throughput of a single transfer below
+	rate_limit bytes per second by sleeping the current greenlet.
+	A rate_limit of zero or None disables throttling.
+	"""
+	__slots__ = [
+		"rate_limit",
+		"started",
+		"transferred",
+	]
+
+	def __init__(self, rate_limit: float = None) -> None:
+		self.rate_limit = rate_limit
+		self.started = time.monotonic()
+		self.transferred = 0
+
+	def block_size(self, default: int) -> int:
+		"""
+		Size of the blocks to transfer, small enough
+		to throttle about ten times per second.
+		"""
+		if not self.rate_limit:
+			return default
+		return int(min(default, max(16 * 1024, self.rate_limit / 10)))
+
+	def throttle(self, nbytes: int) -> None:
+		self.transferred += nbytes
+		if self.rate_limit:
+			ahead = self.transferred / self.rate_limit - (time.monotonic() - self.started)
+			if ahead > 0:
+				gevent.sleep(ahead)
+
+
+class LoomFileWrapper(object):
+	"""
+	WSGI response body for a byte range of a file.
+
+	When served by LoomWSGIHandler the range is copied from the file
+	to the socket by the kernel with os.sendfile. Otherwise it is
+	iterated over in blocks like any other response body.
+	"""
+	__slots__ = [
+		"file",
+		"offset",
+		"length",
+		"rate_limit",
+		"block_size",
+	]
+
+	def __init__(self, file: Any, offset: int, length: int, rate_limit: float = None, block_size: int = 1024 * 1024) -> None:
+		self.file = file
+		self.offset = offset
+		self.length = length
+		self.rate_limit = rate_limit
+		self.block_size = block_size
+
+	def __iter__(self) -> Iterator[bytes]:
+		limiter = LoomRateLimiter(self.rate_limit)
+		block_size = limiter.block_size(self.block_size)
+		self.file.seek(self.offset)
+		remaining = self.length
+		while remaining > 0:
+			data = self.file.read(min(block_size, remaining))
+			if not data:
+				break
+			remaining -= len(data)
+			yield data
+			limiter.throttle(len(data))
+
+	def close(self) -> None:
+		self.file.close()
+
+	def sendfile(self, sock: Any) -> int:
+		"""
+		Copy the range of the file to a (non-blocking gevent) socket
+		with os.sendfile, without passing the data through Python.
+
+		Returns:
+			The number of bytes sent.
+		"""
+		limiter = LoomRateLimiter(self.rate_limit)
+		block_size = limiter.block_size(self.block_size)
+		out_fd = sock.fileno()
+		in_fd = self.file.fileno()
+		sent = 0
+		while sent < self.length:
+			try:
+				count = os.sendfile(out_fd, in_fd, self.offset + sent, min(block_size, self.length - sent))
+			except BlockingIOError:
+				gevent.socket.wait_write(out_fd, timeout=sock.gettimeout())
+				continue
+			if count == 0:
+				# file was truncated while we were sending it
+				break
+			sent += count
+			limiter.throttle(count)
+		return sent
+
+
+class LoomWSGIHandler(wsgi.WSGIHandler):
+	"""
+	gevent WSGI handler that sends LoomFileWrapper responses
+	with os.sendfile where possible, and records the latency
+	and size of all responses (see loom_metrics).
+	"""
+
+	def process_result(self) -> None:
+		result = self.result
+		if (
+			isinstance(result, LoomFileWrapper) and
+			hasattr(os, "sendfile") and
+			# sendfile bypasses TLS, so only use it on plain sockets
+			not hasattr(self.socket, "getpeercert")
+		):
+			# send the headers first
+			self.write(b"")
+			sent = result.sendfile(self.socket)
+			self.response_length += sent
+			if sent < result.length:
+				logging.warning("Sent %d out of %d bytes of %s", sent, result.length, result.file.name)
+				self.close_connection = True
+		else:
+			super().process_result()
+
+	def log_request(self) -> None:
+		# called once the response was sent (or failed)
+		time_finish = self.time_finish or time.time()
+		record_request(self.environ, self.code, self.response_length, time_finish - self.time_start)
+		super().log_request()
+
+
+def send_file_range(file_path: str, request: Any, mimetype: str, rate_limit: float = None) -> Any:
+	"""
+	Serve a (potentially very large) file, supporting resumable
+	downloads through Range and If-Range requests.
+
+	Args:
+		file_path (str):		Absolute path to the file
+		request:				The flask request
+		mimetype (str):			Mimetype of the file
+		rate_limit (float):		Maximum bytes per second for this download, None for no limit
+
+	Returns:
+		A flask Response with status 200, 206 or 416.
+	"""
+	stat = os.stat(file_path)
+	size = stat.st_size
+	etag = "%x-%x" % (stat.st_mtime_ns, size)
+	last_modified = int(stat.st_mtime)
+
+	start, stop = 0, size
+	status = 200
+	byte_range = request.range
+	if (
+		byte_range is not None and
+		# multipart/byteranges responses are not supported,
+		# so requests for multiple ranges get the whole file
+		byte_range.units == "bytes" and len(byte_range.ranges) == 1 and
+		if_range_matches(request, etag, last_modified)
+	):
+		byte_range = byte_range.range_for_length(size)
+		if byte_range is None:
+			response = flask.Response(status=416)
+			response.headers["Content-Range"] = "bytes */%d" % size
+			return response
+		start, stop = byte_range
+		status = 206
+
+	body = LoomFileWrapper(open(file_path, "rb"), start, stop - start, rate_limit)
+	response = flask.Response(body, status=status, mimetype=mimetype, direct_passthrough=True)
+	response.headers["Content-Length"] = str(stop - start)
+	response.headers["Accept-Ranges"] = "bytes"
+	response.headers["Last-Modified"] = format_date_time(last_modified)
+	response.headers["Content-Disposition"] = "attachment; filename=\"%s\"" % os.path.basename(file_path)
+	response.set_etag(etag)
+	if status == 206:
+		response.headers["Content-Range"] = "bytes %d-%d/%d" % (start, stop - 1, size)
+	return response
+
+
+def if_range_matches(request: Any, etag: str, last_modified: int) -> bool:
+	"""
+	Whether the Range header of the request should be honoured:
+	either there is no If-Range header, or it matches the current
+	version of the file (otherwise the whole file is sent).
+	"""
+	if_range = request.if_range
+	if if_range.etag is not None:
+		return if_range.etag == etag
+	if if_range.date is not None:
+		return calendar.timegm(if_range.date.utctimetuple()) == last_modified
+	return True
@@ -1,21 +1,217 @@
 from typing import *
 
+import io
 import os
 import errno
 import logging
 from shutil import rmtree
+from urllib.parse import quote
 
 import json
 
+import numpy as np
 import loompy
 
 from .loom_utils import np_to_list, metadata_array
+from .loom_utils import binary_array
+from .loom_utils import load_binary
+from .loom_utils import save_binary
 from .loom_utils import format_mtime
 from .loom_utils import load_gzipped_json_string
+from .loom_utils import gzip_string
 from .loom_utils import load_gzipped_json
 from .loom_utils import save_gzipped_json
 from .loom_utils import save_gzipped_json_string
+from .loom_utils import save_atomic
 from .loom_tiles import LoomTiles
+from .loom_scatter import LoomScatterPyramid
+from .loom_search import LoomSearchIndex
+from .loom_metrics import hdf5_read_seconds
+from .loom_profile import phase
+
+
+def iter_chunks(numbers: List[int], _max: int, chunk_size: int = 64) -> Iterator[List[int]]:
+	"""
+	Groups the numbers in range(_max) (sorted, and each included only
+	once) by the chunk of chunk_size they fall in. 64 is the default
+	HDF5 chunk size of loom files.
+	"""
+	chunk = []  # type: List[int]
+	for i in sorted(set(numbers)):
+		# ignore out of bounds values
+		if isinstance(i, int) and i >= 0 and i < _max:
+			if len(chunk) > 0 and chunk[0] // chunk_size != i // chunk_size:
+				yield chunk
+				chunk = []
+			chunk.append(i)
+	if len(chunk) > 0:
+		yield chunk
+
+
+def group_statistics(row: Any, inverse: Any, counts: Any, quantiles: Tuple[float, ...]) -> Dict[str, Any]:
+	"""
+	Computes the mean, fraction of non-zero values and quantiles
+	(linearly interpolated, like numpy.percentile) of a row per group
+	of columns, in a constant number of vectorized passes.
+
+	Args:
+		row:			The values of the row
+		inverse:		The group number of every column
+		counts:			The number of columns per group (none may be zero)
+		quantiles:		Quantiles to compute, between 0 and 1
+
+	Returns:
+		A dictionary with lists of one value per group
+		for "mean", "nonzero" and every quantile.
+	"""
+	row = np.asarray(row, dtype=np.float64)
+	n_groups = len(counts)
+	mean = np.bincount(inverse, weights=row, minlength=n_groups) / counts
+	nonzero = np.bincount(inverse, weights=row != 0, minlength=n_groups) / counts
+	# sort by group, then by value, so each group is a sorted slice
+	sorted_row = row[np.lexsort((row, inverse))]
+	starts = np.cumsum(counts) - counts
+	statistics = {
+		"mean": mean.tolist(),
+		"nonzero": nonzero.tolist(),
+	}
+	for q in quantiles:
+		position = starts + q * (counts - 1)
+		lower = np.floor(position).astype(np.int64)
+		upper = np.ceil(position).astype(np.int64)
+		fraction = position - lower
+		statistics[repr(q)] = (sorted_row[lower] * (1 - fraction) + sorted_row[upper] * fraction).tolist()
+	return statistics
+
+
+def marker_statistics(sums: Any, sums_of_squares: Any, nonzero: Any, counts: Any, group: int) -> Dict[str, Any]:
+	"""
+	Compares every row between one group of columns and all other
+	columns, from the per-group summaries of group_summaries.
+
+	Args:
+		sums, sums_of_squares, nonzero:		Arrays of rows by groups
+		counts:								The number of columns per group
+		group:								The group to compare with the rest
+
+	Returns:
+		A dictionary with arrays of one value per row: the mean and
+		fraction of non-zero values in the group ("mean", "nonzero")
+		and in the rest ("meanRest", "nonzeroRest"), the log2 fold
+		change of the means (with a pseudocount of 1), and Welch's
+		t statistic ("t", NaN for rows without variance).
+	"""
+	n1 = float(counts[group])
+	n2 = float(counts.sum()) - n1
+	sum1 = sums[:, group]
+	sum2 = sums.sum(axis=1) - sum1
+	squares1 = sums_of_squares[:, group]
+	squares2 = sums_of_squares.sum(axis=1) - squares1
+	mean1 = sum1 / n1
+	with np.errstate(divide="ignore", invalid="ignore"):
+		mean2 = sum2 / n2
+		# sample variances, clipped to avoid rounding errors below zero
+		variance1 = np.maximum(squares1 - n1 * mean1 * mean1, 0) / (n1 - 1)
+		variance2 = np.maximum(squares2 - n2 * mean2 * mean2, 0) / (n2 - 1)
+		t = (mean1 - mean2) / np.sqrt(variance1 / n1 + variance2 / n2)
+		nonzero2 = (nonzero.sum(axis=1) - nonzero[:, group]) / n2
+		fold_change = np.log2((mean1 + 1) / (mean2 + 1))
+	return {
+		"mean": mean1,
+		"meanRest": mean2,
+		"nonzero": nonzero[:, group] / n1,
+		"nonzeroRest": nonzero2,
+		"log2FoldChange": fold_change,
+		"t": t,
+	}
+
+
+# Upper bound on the memory used for a block of rows read from the matrix
+# (and the arrays computed from it) by correlate_row and group_summaries
+BLOCK_BYTES = 128 * 1024 * 1024
+
+
+def block_rows(columns: int, copies: int) -> int:
+	"""
+	Number of rows to read from the matrix at a time, so that `copies`
+	float64 arrays of a block of rows fit in BLOCK_BYTES. That is one
+	64-row HDF5 chunk, unless the matrix is too wide for that.
+	"""
+	return int(max(1, min(64, BLOCK_BYTES // max(1, columns * 8 * copies))))
+
+
+def summaries_path(file_path: str, attribute: str) -> str:
+	"""
+	Where LoomExpand.group_summaries saves the summaries per group of a column attribute
+	"""
+	return "%s.groups/%s.npz" % (file_path, quote(attribute, safe=""))
+
+
+def has_group_summaries(file_path: str, attribute: str, last_mod: str, counts: Any = None) -> bool:
+	"""
+	Whether LoomExpand.group_summaries saved the summaries per group of
+	a column attribute for the loom file as of last_mod (the timestamp of
+	the latest change to any data in it), and for the given group sizes.
+	"""
+	summaries_filename = summaries_path(file_path, attribute)
+	if not os.path.isfile(summaries_filename):
+		return False
+	try:
+		with np.load(summaries_filename) as saved:
+			return (
+				"file_last_mod" in saved.files and str(saved["file_last_mod"]) == last_mod and
+				(counts is None or np.array_equal(saved["counts"], counts))
+			)
+	except (OSError, ValueError, KeyError) as e:
+		logging.warning("Could not load %s: %s", summaries_filename, e)
+		return False
+
+
+def correlations_path(file_path: str, method: str, row: int) -> str:
+	"""
+	Where LoomExpand.correlate_row saves the most correlated rows of a row
+	"""
+	return "%s.correlations/%s/%06d.json.gzip" % (file_path, method, row)
+
+
+def load_correlations(file_path: str, method: str, row: int, last_mod: str, n: int) -> List[Tuple[int, float]]:
+	"""
+	Loads the n most correlated rows saved by LoomExpand.correlate_row.
+
+	Returns:
+		A list of (row number, correlation) tuples, or None if they were not
+		saved for the loom file as of last_mod, or fewer than n were saved.
+	"""
+	try:
+		saved = load_gzipped_json(correlations_path(file_path, method, row))
+	except (OSError, ValueError) as e:
+		logging.warning("Could not load correlations of row %d: %s", row, e)
+		return None
+	if saved is None or saved.get("lastMod") != last_mod or saved.get("n", 0) < n:
+		return None
+	return [(int(i), float(r)) for i, r in saved["results"]]
+
+
+def rank_rows(block: Any) -> Any:
+	"""
+	Ranks the values of every row of a block (starting at 1), with
+	tied values getting their average rank, like scipy.stats.rankdata.
+	"""
+	rows, n = block.shape
+	order = np.argsort(block, axis=1, kind="mergesort")
+	row_index = np.arange(rows)[:, None]
+	sorted_block = block[row_index, order]
+	positions = np.broadcast_to(np.arange(n), (rows, n))
+	# first and last position of every run of tied values
+	first = np.ones((rows, n), dtype=bool)
+	first[:, 1:] = sorted_block[:, 1:] != sorted_block[:, :-1]
+	last = np.ones((rows, n), dtype=bool)
+	last[:, :-1] = first[:, 1:]
+	start = np.maximum.accumulate(np.where(first, positions, 0), axis=1)
+	end = np.minimum.accumulate(np.where(last, positions, n)[:, ::-1], axis=1)[:, ::-1]
+	ranks = np.empty((rows, n), dtype=np.float64)
+	ranks[row_index, order] = (start + end) / 2 + 1
+	return ranks
 
 
 class LoomExpand(object):
@@ -33,19 +229,28 @@ class LoomExpand(object):
 		"ds"
 	]
 
-	def __init__(self, project: str, filename: str, file_path: str, callback_on_close: Callable = None, close_connection_on_exit: bool = True) -> None:
+	def __init__(self, project: str, filename: str, file_path: str, callback_on_close: Callable = None, close_connection_on_exit: bool = True, mode: str = 'r+', ds: loompy.LoomConnection = None) -> None:
+		"""
+		Args:
+			mode (str):		Mode to open the loom file with. 'r+' lets loompy
+							add missing timestamps to older loom files,
+							'r' allows other readers to open it concurrently
+							(see LoomDatasetConnections).
+			ds:				An already open connection to the loom file to use
+							(for example from LoomConnectionPool), instead of opening it.
+							Combine with close_connection_on_exit=False to keep it open.
+		"""
 		self.project = project
 		self.filename = filename
 		self.file_path = file_path
 		self.close_connection_on_exit = close_connection_on_exit
 		self.callback_on_close = callback_on_close
 		self._closed = False
-		self.ds = None
+		self.ds = ds
+		if ds is not None:
+			return
 		try:
-			# TODO: when loompy library is updated with a default
-			# Unix timestamp for missing time fields, this should
-			# be set back to 'r' for safety reasons
-			self.ds = loompy.connect(file_path, 'r+')
+			self.ds = loompy.connect(file_path, mode)
 		except Exception as e:
 			logging.warning("Could not open loom file at %s, closing LoomExpand object", file_path)
 			if self.ds is not None:
@@ -80,6 +285,16 @@ class LoomExpand(object):
 	def closed(self) -> bool:
 		return self._closed
 
+	def has_timestamps(self) -> bool:
+		"""
+		Whether the loom file stores when it was last modified. Older
+		loom files do not, and need to be opened in 'r+' mode once so
+		that loompy can add the timestamps.
+		"""
+		if not self._closed:
+			return "last_modified" in self.ds.attrs
+		return False
+
 	def last_modified(self) -> str:
 		"""
 		As of version 2.0.2, loompy keeps track of changes to
@@ -244,6 +459,53 @@ class LoomExpand(object):
 			return (attrs_json, last_mod)
 		return None
 
+	def clear_search_index(self) -> None:
+		if not self._closed:
+			search_filename = "%s.search.json.gzip" % (self.file_path)
+			if os.path.isfile(search_filename):
+				logging.debug("  Removing previously built %s", search_filename)
+				os.remove(search_filename)
+			search_mod_filename = "%s.search.lastmod.gzip" % (self.file_path)
+			if os.path.isfile(search_mod_filename):
+				os.remove(search_mod_filename)
+
+	def search_index(self, truncate: bool = False) -> LoomSearchIndex:
+		"""
+		Builds the search index of the string row attributes (see
+		LoomSearchIndex), and saves it as a GZipped JSON file next to
+		the attributes, to be reused until the row attributes change.
+
+		Returns the index, or None if the loom file is closed.
+		"""
+		if self._closed:
+			return None
+		search_filename = "%s.search.json.gzip" % (self.file_path)
+		search_mod_filename = "%s.search.lastmod.gzip" % (self.file_path)
+		last_mod = self.ds.row_attrs.last_modified()
+
+		if os.path.isfile(search_filename):
+			logging.debug("  Found previously built search index")
+			if truncate:
+				self.clear_search_index()
+			else:
+				search_mod = load_gzipped_json_string(search_mod_filename)
+				data = load_gzipped_json(search_filename) if search_mod == last_mod else None
+				if data is not None:
+					logging.debug("  Search index up to date")
+					return LoomSearchIndex.from_dict(data)
+				self.clear_search_index()
+
+		logging.debug("Building search index (stored as %s)", search_filename)
+		row_attrs = {}  # type: Dict[str, List[str]]
+		for key, arr in self.ds.ra.items():
+			arr = np.asarray(arr)
+			if arr.dtype.kind in "USO":
+				row_attrs[key] = arr.tolist()
+		index = LoomSearchIndex.build(row_attrs)
+		save_gzipped_json(search_filename, index.to_dict())
+		save_gzipped_json_string(search_mod_filename, last_mod)
+		return index
+
 	def clear_rows(self) -> None:
 		if not self._closed:
 			row_dir = "%s.rows" % (self.file_path)
@@ -257,11 +519,11 @@ class LoomExpand(object):
 	def rows(self, truncate: bool = False) -> str:
 		"""
 		Expands all rows. Will skip expansion if row subfolder exists,
-		truncate is not set, and if the layer had not changed since
+		truncate is not set, and if the loom file had not changed since
 		the last expansion.
 
 		Returns:
-			- A timestamp string of the last modification date of the layer
+			- A timestamp string of the last modification date of the loom file
 		"""
 		if not self._closed:
 			row_dir = "%s.rows" % (self.file_path)
@@ -269,7 +531,8 @@ class LoomExpand(object):
 
 			row_mod_filename = "%s.rows.lastmod.gzip" % (self.file_path)
 			row_mod = load_gzipped_json_string(row_mod_filename)
-			last_mod = self.ds.layers.last_modified()
+			# the same timestamp as prepare_cache
+			last_mod = self.last_modified()
 
 			# If truncate is set, or cache is stale,
 			# remove previously expanded rows
@@ -313,28 +576,420 @@ class LoomExpand(object):
 			return last_mod
 		return None
 
-	def selected_rows(self, row_numbers: List[int]) -> Tuple[str, str]:
+	def dimensions(self) -> Tuple[int, int]:
+		"""
+		Returns the number of rows and columns of the loom file
+		"""
+		return self.ds.shape
+
+	def iter_row_chunks(self, row_numbers: List[int]) -> Iterator[List[int]]:
+		"""
+		Groups the valid row numbers (sorted, and each included
+		only once) by the 64-row HDF5 chunk they are stored in,
+		so that each chunk can be read with a single call.
+		"""
+		return iter_chunks(row_numbers, self.ds.shape[0])
+
+	def iter_column_chunks(self, column_numbers: List[int]) -> Iterator[List[int]]:
+		"""
+		Like iter_row_chunks, for column numbers
+		"""
+		return iter_chunks(column_numbers, self.ds.shape[1])
+
+	def prepare_cache(self, kind: str) -> str:
+		"""
+		Prepares the .rows or .cols cache folder (kind is "rows" or
+		"cols") for expanding rows or columns into it: removes it if
+		it is stale, and records the last modification date of the
+		loom file the cache is expanded from (compared to
+		LoomDatasets.last_mod, which is also for the whole file).
+
+		Returns:
+			The recorded last modification date, or None if the expander is closed.
+		"""
+		if self._closed:
+			return None
+		cache_dir = "%s.%s" % (self.file_path, kind)
+		mod_filename = "%s.%s.lastmod.gzip" % (self.file_path, kind)
+		cache_mod = load_gzipped_json_string(mod_filename)
+		last_mod = self.last_modified()
+		if cache_mod != last_mod:
+			if os.path.isdir(cache_dir):
+				if kind == "rows":
+					self.clear_rows()
+				else:
+					self.clear_columns()
+			save_gzipped_json_string(mod_filename, last_mod)
+		os.makedirs(cache_dir, exist_ok=True)
+		return last_mod
+
+	def expand_rows(self, row_numbers: List[int]) -> Dict[int, bytes]:
+		"""
+		Reads the given rows from the loom file per HDF5 chunk, and
+		saves them as gzipped JSON in the .rows cache folder (which
+		should have been prepared with `prepare_cache("rows")`).
+
+		Returns:
+			A dictionary of row number to gzipped JSON. Out of bounds rows are left out.
+		"""
+		expanded = {}  # type: Dict[int, bytes]
+		if self._closed:
+			return expanded
+		row_dir = "%s.rows" % (self.file_path)
+		os.makedirs(row_dir, exist_ok=True)
+		for chunk in self.iter_row_chunks(row_numbers):
+			rows = self.read_rows(chunk)
+			for i in chunk:
+				expanded[i] = self.save_expanded(row_dir, i, rows.pop(i))
+		return expanded
+
+	def expand_columns(self, column_numbers: List[int]) -> Dict[int, bytes]:
+		"""
+		Like expand_rows, for columns (saved in the .cols cache folder).
+		"""
+		expanded = {}  # type: Dict[int, bytes]
+		if self._closed:
+			return expanded
+		col_dir = "%s.cols" % (self.file_path)
+		os.makedirs(col_dir, exist_ok=True)
+		for chunk in self.iter_column_chunks(column_numbers):
+			with hdf5_read_seconds.time("columns"), phase("hdf5_read"):
+				columns = self.ds[:, chunk]
+			for j, i in enumerate(chunk):
+				expanded[i] = self.save_expanded(col_dir, i, columns[:, j])
+		return expanded
+
+	def save_expanded(self, cache_dir: str, i: int, data: Any) -> bytes:
+		"""
+		Serializes row or column i to gzipped JSON, and saves it in
+		cache_dir (the .rows or .cols folder).
+
+		Returns:
+			The gzipped JSON
+		"""
+		with phase("metadata_array"):
+			data = metadata_array(data)
+		with phase("json_dumps"):
+			item = json.dumps({"idx": i, "data": data})
+		with phase("gzip"):
+			item = gzip_string(item)
+		with phase("cache_write"):
+			save_binary("%s/%06d.json.gzip" % (cache_dir, i), item)
+		return item
+
+	def read_rows(self, row_numbers: List[int]) -> Dict[int, Any]:
+		"""
+		Reads sorted row numbers (typically from iter_row_chunks)
+		from the loom file in one call.
+
+		Returns:
+			A dictionary of row number to row
+		"""
+		if len(row_numbers) == 0:
+			return {}
+		with hdf5_read_seconds.time("rows"), phase("hdf5_read"):
+			if len(row_numbers) == 1:
+				i = row_numbers[0]
+				return {i: self.ds[i, :]}
+			rows = self.ds[row_numbers, :]
+		return {i: rows[j] for j, i in enumerate(row_numbers)}
+
+	def iter_rows_columns(self, row_numbers: List[int], column_numbers: List[int], gzipped: bool = False) -> Iterator[AnyStr]:
+		"""
+		Yields the JSON string of each selected row, restricted to the
+		selected columns (sorted, and each included only once). These
+		are read from the loom file directly, and not cached.
+
+		If gzipped is True, yields gzipped JSON instead.
+		"""
+		if self._closed:
+			return
+		colMax = self.ds.shape[1]
+		column_numbers = [i for i in sorted(set(column_numbers)) if isinstance(i, int) and i >= 0 and i < colMax]
+		for chunk in self.iter_row_chunks(row_numbers):
+			rows = self.read_rows(chunk)
+			for i in chunk:
+				row = json.dumps({"idx": i, "data": metadata_array(rows[i][column_numbers])})
+				yield gzip_string(row) if gzipped else row
+
+	def rows_columns(self, row_numbers: List[int], column_numbers: List[int], gzipped: bool = False) -> List[AnyStr]:
+		"""
+		List version of iter_rows_columns, for reading one HDF5 chunk of rows at a time.
+		"""
+		return list(self.iter_rows_columns(row_numbers, column_numbers, gzipped))
+
+	def selected_rows_columns_binary(self, row_numbers: List[int], column_numbers: List[int]) -> bytes:
+		"""
+		Returns the selected rows, restricted to the selected columns
+		(sorted, and each included only once), as concatenated binary
+		records (see `binary_array`). Not cached.
 		"""
-		Returns a JSON string with the selected rows, generating
-		gzipped JSON files from the loom file if necesary.
+		if self._closed:
+			return None
+		colMax = self.ds.shape[1]
+		column_numbers = [i for i in sorted(set(column_numbers)) if isinstance(i, int) and i >= 0 and i < colMax]
+		retRows = []
+		for chunk in self.iter_row_chunks(row_numbers):
+			rows = self.read_rows(chunk)
+			for i in chunk:
+				retRows.append(binary_array(i, rows[i][column_numbers]))
+		return b"".join(retRows)
+
+	def gene_names(self) -> List[str]:
+		"""
+		Returns the gene name of every row, from the first row attribute
+		named like a gene attribute (matched case-insensitively,
+		in the same order as the client), or an empty list.
+		"""
+		if self._closed:
+			return []
+		gene_keys = ["gene", "genes", "genename", "gene_name", "genenames", "gene_names"]
+		row_attrs = {key.lower(): key for key in self.ds.ra.keys()}
+		for gene_key in gene_keys:
+			if gene_key in row_attrs:
+				return [str(name) for name in self.ds.ra[row_attrs[gene_key]]]
+		return []
+
+	def column_attribute_index(self, attribute: str) -> Dict[str, Any]:
+		"""
+		Groups the columns by the values of a column attribute.
+
+		Returns:
+			A dictionary of attribute value (as a string) to a sorted
+			numpy array of the column numbers with that value,
+			or None if there is no such column attribute.
+		"""
+		groups = self.column_groups(attribute)
+		if groups is None:
+			return None
+		names, inverse, counts = groups
+		# column numbers sorted by value, then split per value
+		order = np.argsort(inverse, kind="stable")
+		return dict(zip(names, np.split(order, np.cumsum(counts)[:-1])))
+
+	def numeric_column_attribute(self, attribute: str) -> Any:
+		"""
+		Returns the values of a numeric column attribute as a numpy
+		array, or None if there is no such numeric attribute.
+		"""
+		if self._closed or attribute not in self.ds.ca.keys():
+			return None
+		values = np.asarray(self.ds.ca[attribute])
+		if not np.issubdtype(values.dtype, np.number):
+			return None
+		return values
+
+	def scatter_pyramid(self, x_attribute: str, y_attribute: str) -> LoomScatterPyramid:
+		"""
+		Bins the columns over two numeric column attributes (see
+		LoomScatterPyramid), or returns None if either does not exist.
+		"""
+		x = self.numeric_column_attribute(x_attribute)
+		y = self.numeric_column_attribute(y_attribute)
+		if x is None or y is None:
+			return None
+		return LoomScatterPyramid(x, y)
+
+	def column_groups(self, attribute: str) -> Tuple[List[str], Any, Any]:
+		"""
+		Groups the columns by the values of a column attribute.
+
+		Returns:
+			A tuple of the sorted distinct values (as strings), the group
+			number of each column, and the number of columns per group,
+			or None if there is no such column attribute.
+		"""
+		if self._closed or attribute not in self.ds.ca.keys():
+			return None
+		values = np.asarray(self.ds.ca[attribute]).astype(str)
+		uniques, inverse = np.unique(values, return_inverse=True)
+		counts = np.bincount(inverse, minlength=len(uniques))
+		return ([str(value) for value in uniques], inverse, counts)
+
+	def clear_group_summaries(self) -> None:
+		if not self._closed:
+			summaries_dir = "%s.groups" % (self.file_path)
+			if os.path.isdir(summaries_dir):
+				logging.debug("  Removing previously computed %s", summaries_dir)
+				rmtree(summaries_dir)
+
+	def group_summaries(self, attribute: str, inverse: Any, counts: Any) -> Tuple[Any, Any, Any]:
+		"""
+		Sums, sums of squares and non-zero counts of every row per
+		group of columns (see column_groups), computed in one pass over
+		the matrix in blocks of up to 64 rows (see block_rows), and saved in a .npz file per
+		attribute to be reused until the matrix or column attributes change.
+
+		Returns:
+			A tuple of three arrays of rows by groups, or None if the loom file is closed.
+		"""
+		if self._closed:
+			return None
+		summaries_filename = summaries_path(self.file_path, attribute)
+		summaries_dir = os.path.dirname(summaries_filename)
+		last_mod = max(self.ds.layers.last_modified(), self.ds.col_attrs.last_modified())
+
+		if os.path.isfile(summaries_filename):
+			try:
+				with np.load(summaries_filename) as saved:
+					if str(saved["last_mod"]) == last_mod and np.array_equal(saved["counts"], counts):
+						logging.debug("  Group summaries up to date")
+						return (saved["sums"], saved["sums_of_squares"], saved["nonzero"])
+			except (OSError, ValueError, KeyError) as e:
+				logging.warning("Could not load %s: %s", summaries_filename, e)
+
+		logging.debug("Summarizing rows per %s (stored as %s)", attribute, summaries_filename)
+		total_rows = self.ds.shape[0]
+		n_groups = len(counts)
+		# sort the columns by group, so every group is a slice of a block
+		order = np.argsort(inverse, kind="stable")
+		starts = np.cumsum(counts) - counts
+		sums = np.zeros((total_rows, n_groups))
+		sums_of_squares = np.zeros((total_rows, n_groups))
+		nonzero = np.zeros((total_rows, n_groups), dtype=np.int32)
+		# the block as read, sorted by group, squared, and compared to zero
+		step = block_rows(self.ds.shape[1], 4)
+		for ix in range(0, total_rows, step):
+			with hdf5_read_seconds.time("rows"), phase("hdf5_read"):
+				block = self.ds[ix:ix + step, :]
+			with phase("summarize"):
+				block = np.asarray(block, dtype=np.float64)[:, order]
+				sums[ix:ix + step] = np.add.reduceat(block, starts, axis=1)
+				sums_of_squares[ix:ix + step] = np.add.reduceat(block * block, starts, axis=1)
+				nonzero[ix:ix + step] = np.add.reduceat(block != 0, starts, axis=1, dtype=np.int32)
+
+		try:
+			os.makedirs(summaries_dir, exist_ok=True)
+			saved = io.BytesIO()
+			# file_last_mod lets has_group_summaries check this file without opening the loom file
+			np.savez(saved, last_mod=np.array(last_mod), file_last_mod=np.array(self.last_modified()), counts=counts, sums=sums, sums_of_squares=sums_of_squares, nonzero=nonzero)
+			save_atomic(summaries_filename, saved.getvalue())
+		except OSError as e:
+			logging.warning("Could not save %s: %s", summaries_filename, e)
+		return (sums, sums_of_squares, nonzero)
+
+	def aggregate_rows(self, row_numbers: List[int], inverse: Any, counts: Any, quantiles: Tuple[float, ...]) -> Dict[int, Dict[str, Any]]:
+		"""
+		Computes per-group statistics of the given rows (see
+		`group_statistics`), with the groups from column_groups.
+
+		Returns:
+			A dictionary of row number to statistics. Out of bounds rows are left out.
+		"""
+		aggregated = {}  # type: Dict[int, Dict[str, Any]]
+		if self._closed:
+			return aggregated
+		for chunk in self.iter_row_chunks(row_numbers):
+			rows = self.read_rows(chunk)
+			for i in chunk:
+				with phase("aggregate"):
+					aggregated[i] = group_statistics(rows.pop(i), inverse, counts, quantiles)
+		return aggregated
+
+	def correlate_row(self, row: int, method: str = "pearson", n: int = 1000, norms: Any = None) -> Tuple[List[Tuple[int, float]], Any]:
+		"""
+		Correlates a row with every other row, reading the matrix
+		in blocks of 64 rows (the HDF5 chunk size of loom files),
+		or fewer for very wide matrices (see block_rows).
+
+		Since the target row y is centered, the correlation with a row x
+		is x . (y - mean(y)) / (|x - mean(x)| |y - mean(y)|), so the other
+		rows need no centering: one matrix-vector product per block and
+		the norms of the centered rows, which only depend on the matrix
+		and are computed during the first pass.
+
+		Args:
+			method (str):		"pearson", or "spearman" to correlate the ranks of the values
+			n (int):			Number of most correlated rows to return
+			norms (array):		Norms of the centered (ranked) rows from a previous call
+
+		Returns:
+			The n most correlated rows as (row number, correlation) tuples,
+			from most to least correlated, and the norms of all rows.
+			Rows without variance are left out. None if the row is out of bounds.
+			The correlated rows are also saved (see load_correlations).
+		"""
+		if self._closed or row < 0 or row >= self.ds.shape[0]:
+			return None
+		total_rows, total_cols = self.ds.shape
+		target = np.asarray(self.read_rows([row])[row], dtype=np.float64)
+		if method == "spearman":
+			target = rank_rows(target[None, :])[0]
+		target -= target.mean()
+		target_norm = np.sqrt(target.dot(target))
+
+		compute_norms = norms is None
+		if compute_norms:
+			norms = np.zeros(total_rows)
+		correlations = np.full(total_rows, np.nan)
+		# rank_rows holds about ten arrays the size of the block
+		step = block_rows(total_cols, 12 if method == "spearman" else 3)
+		for ix in range(0, total_rows, step):
+			with hdf5_read_seconds.time("rows"), phase("hdf5_read"):
+				block = self.ds[ix:ix + step, :]
+			with phase("correlate"):
+				block = np.asarray(block, dtype=np.float64)
+				if method == "spearman":
+					block = rank_rows(block)
+				if compute_norms:
+					centered = block - block.mean(axis=1)[:, None]
+					norms[ix:ix + step] = np.sqrt(np.einsum("ij,ij->i", centered, centered))
+					del centered
+				correlations[ix:ix + step] = block.dot(target)
+
+		with np.errstate(divide="ignore", invalid="ignore"):
+			correlations /= norms * target_norm
+		np.clip(correlations, -1.0, 1.0, out=correlations)
+		correlations[row] = np.nan
+		correlations[~np.isfinite(correlations)] = -np.inf
+		count = max(1, min(n, total_rows))
+		top = np.argpartition(-correlations, count - 1)[:count] if count < total_rows else np.arange(total_rows)
+		top = top[np.argsort(-correlations[top], kind="stable")]
+		top = [(int(i), float(correlations[i])) for i in top if correlations[i] > -np.inf]
+
+		# saved per row, to be reused by other server worker processes until the loom file changes.
+		# The requested n is saved (not the clamped count), since load_correlations compares against it
+		correlations_filename = correlations_path(self.file_path, method, row)
+		try:
+			os.makedirs(os.path.dirname(correlations_filename), exist_ok=True)
+			save_gzipped_json(correlations_filename, {"lastMod": self.last_modified(), "n": n, "results": top})
+		except OSError as e:
+			logging.warning("Could not save %s: %s", correlations_filename, e)
+		return (top, norms)
+
+	def clear_binary_rows(self) -> None:
+		if not self._closed:
+			row_dir = "%s.rows_bin" % (self.file_path)
+			if os.path.isdir(row_dir):
+				logging.debug("  Removing previously expanded %s", row_dir)
+				rmtree(row_dir)
+			row_mod_filename = "%s.rows_bin.lastmod.gzip" % (self.file_path)
+			if os.path.isfile(row_mod_filename):
+				os.remove(row_mod_filename)
+
+	def selected_rows_binary(self, row_numbers: List[int]) -> Tuple[bytes, str]:
+		"""
+		Returns the selected rows as concatenated binary records
+		(see `binary_array`), generating binary cache files in
+		the .rows_bin subfolder if necessary.
 		(never truncates, may clear outdated cache)
 
 		Returns:
-			- The JSON serialised list of the rows
-			- A timestamp string of the last modification date of the layer
+			- The concatenated binary records of the rows
+			- A timestamp string of the last modification of the loom file
 		"""
 		if not self._closed:
-			row_dir = "%s.rows" % (self.file_path)
-			logging.debug("Expanding selected row numbers, if not previously expanded: (stored in %s.rows subfolder)" % self.filename)
-			logging.debug(",".join(str(row_nr) for row_nr in row_numbers))
+			row_dir = "%s.rows_bin" % (self.file_path)
+			logging.debug("Expanding selected binary rows, if not previously expanded: (stored in %s.rows_bin subfolder)" % self.filename)
 
-			row_mod_filename = "%s.rows.lastmod.gzip" % (self.file_path)
+			row_mod_filename = "%s.rows_bin.lastmod.gzip" % (self.file_path)
 			row_mod = load_gzipped_json_string(row_mod_filename)
-			last_mod = self.ds.layers.last_modified()
+			# the loom file as a whole, like LoomDatasets.last_mod that this is compared to
+			last_mod = self.last_modified()
 
 			# If cache is stale, remove previously expanded rows
 			if os.path.isdir(row_dir) and row_mod != last_mod:
-				self.clear_rows()
+				self.clear_binary_rows()
 
 			save_gzipped_json_string(row_mod_filename, last_mod)
 
@@ -344,44 +999,19 @@ class LoomExpand(object):
 				if exception.errno is not errno.EEXIST:
 					raise exception
 
-			# make sure all rows are included only once
-			row_numbers = list(set(row_numbers))
-
-			if len(row_numbers) is 0:
-				return ("[]", last_mod)
-
-			row_numbers.sort()
-
-			ds = self.ds
-			retRows = ["["]
-			comma = ","
-
-			rowMax = ds.shape[0]
-			newly_expanded = []
-			previously_expanded = []
-			for i in row_numbers:
-				# ignore out of bounds values
-				if isinstance(i, int) and i >= 0 and i < rowMax:
-					row_file_name = "%s/%06d.json.gzip" % (row_dir, i)
-					if os.path.exists(row_file_name):
-						retRows.append(load_gzipped_json_string(row_file_name))
-						previously_expanded.append(i)
-					else:
-						row = json.dumps({"idx": i, "data": metadata_array(ds[i, :])})
-						retRows.append(row)
-						save_gzipped_json_string(row_file_name, row)
-						newly_expanded.append(i)
-					retRows.append(comma)
-
-			logging.debug("loaded rows: %s", previously_expanded)
-			logging.debug("newly expanded rows: %s", newly_expanded)
-
-			if len(retRows) is 1:
-				return ("[]", last_mod)
-
-			# convert last "," to "]" to make it a valid JSON array
-			retRows[len(retRows) - 1] = "]"
-			return ("".join(retRows), last_mod)
+			retRows = []
+			# uncached rows are read per HDF5 chunk
+			for chunk in self.iter_row_chunks(row_numbers):
+				cached = {i: load_binary("%s/%06d.bin" % (row_dir, i)) for i in chunk}
+				rows = self.read_rows([i for i in chunk if len(cached[i]) == 0])
+				for i in chunk:
+					row = cached[i]
+					if len(row) == 0:
+						row = binary_array(i, rows[i])
+						save_binary("%s/%06d.bin" % (row_dir, i), row)
+					retRows.append(row)
+
+			return (b"".join(retRows), last_mod)
 		return None
 
 	def clear_columns(self) -> None:
@@ -401,7 +1031,8 @@ class LoomExpand(object):
 
 			col_mod_filename = "%s.cols.lastmod.gzip" % (self.file_path)
 			col_mod = load_gzipped_json_string(col_mod_filename)
-			last_mod = self.ds.layers.last_modified()
+			# the same timestamp as prepare_cache
+			last_mod = self.last_modified()
 
 			# If truncate is set, or cache is stale,
 			# remove previously expanded columns
@@ -448,28 +1079,39 @@ class LoomExpand(object):
 			return last_mod
 		return None
 
-	def selected_columns(self, column_numbers: List[int]) -> Tuple[str, str]:
+	def clear_binary_columns(self) -> None:
+		if not self._closed:
+			col_dir = "%s.cols_bin" % (self.file_path)
+			if os.path.isdir(col_dir):
+				logging.debug("  Removing previously expanded %s", col_dir)
+				rmtree(col_dir)
+			col_mod_filename = "%s.cols_bin.lastmod.gzip" % (self.file_path)
+			if os.path.isfile(col_mod_filename):
+				os.remove(col_mod_filename)
+
+	def selected_columns_binary(self, column_numbers: List[int]) -> Tuple[bytes, str]:
 		"""
-		Returns a JSON string with the selected columns, generating
-		gzipped JSON files from the loom file if necesary.
+		Returns the selected columns as concatenated binary records
+		(see `binary_array`), generating binary cache files in
+		the .cols_bin subfolder if necessary.
 		(never truncates, may clear outdated cache)
 
 		Returns:
-			- The JSON serialised list of the rows
-			- A timestamp string of the last modification date of the layer
+			- The concatenated binary records of the columns
+			- A timestamp string of the last modification of the loom file
 		"""
 		if not self._closed:
-			col_dir = "%s.cols" % (self.file_path)
-			logging.debug("Expanding selected column numbers, if not previously expanded: (stored in %s.cols subfolder)" % self.filename)
-			logging.debug(",".join(str(column_nr) for column_nr in column_numbers))
+			col_dir = "%s.cols_bin" % (self.file_path)
+			logging.debug("Expanding selected binary columns, if not previously expanded: (stored in %s.cols_bin subfolder)" % self.filename)
 
-			col_mod_filename = "%s.cols.lastmod.gzip" % (self.file_path)
+			col_mod_filename = "%s.cols_bin.lastmod.gzip" % (self.file_path)
 			col_mod = load_gzipped_json_string(col_mod_filename)
-			last_mod = self.ds.layers.last_modified()
+			# the loom file as a whole, like LoomDatasets.last_mod that this is compared to
+			last_mod = self.last_modified()
 
 			# If cache is stale, remove previously expanded columns
 			if os.path.isdir(col_dir) and col_mod != last_mod:
-				self.clear_columns()
+				self.clear_binary_columns()
 
 			save_gzipped_json_string(col_mod_filename, last_mod)
 
@@ -479,43 +1121,18 @@ class LoomExpand(object):
 				if exception.errno is not errno.EEXIST:
 					raise
 
-			# make sure all columns are included only once
-			column_numbers = list(set(column_numbers))
-
-			if len(column_numbers) is 0:
-				return ("[]", last_mod)
-
-			column_numbers.sort()
-
 			ds = self.ds
-			retCols = ["["]
-			comma = ","
-
 			colMax = ds.shape[1]
-			newly_expanded = []
-			previously_expanded = []
-			for i in column_numbers:
+			retCols = []
+			for i in sorted(set(column_numbers)):
 				# ignore out of bounds values
 				if isinstance(i, int) and i >= 0 and i < colMax:
-					col_file_name = "%s/%06d.json.gzip" % (col_dir, i)
-					if os.path.exists(col_file_name):
-						retCols.append(load_gzipped_json_string(col_file_name))
-						previously_expanded.append(i)
-					else:
-						data = metadata_array(ds[:, i].transpose())
-						column = json.dumps({"idx": i, "data": data})
-						retCols.append(column)
-						save_gzipped_json_string(col_file_name, column)
-						newly_expanded.append(i)
-					retCols.append(comma)
-
-			logging.debug("loaded columns: %s", previously_expanded)
-			logging.debug("newly expanded columns: %s", newly_expanded)
-
-			if len(retCols) is 1:
-				return ("[]", last_mod)
-
-			# convert last "," to "]" to make it a valid JSON array
-			retCols[len(retCols) - 1] = "]"
-			return ("".join(retCols), last_mod)
+					col_file_name = "%s/%06d.bin" % (col_dir, i)
+					column = load_binary(col_file_name)
+					if len(column) == 0:
+						column = binary_array(i, ds[:, i].transpose())
+						save_binary(col_file_name, column)
+					retCols.append(column)
+
+			return (b"".join(retCols), last_mod)
 		return None
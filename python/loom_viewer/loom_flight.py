@@ -0,0 +1,95 @@
+from typing import *
+
+import logging
+
+from gevent.event import AsyncResult
+
+
+class LoomSingleFlight(object):
+	"""
+	Coalesces identical concurrent work: while one greenlet computes
+	the result for a key, other greenlets asking for the same key wait
+	for that result instead of repeating the work (or queueing behind
+	the lock of the loom file to do so).
+
+	Keys should identify the result completely, including the
+	last_mod of the loom file it is derived from. Results are not
+	kept after the work is done; see LoomLRUCache for that.
+	"""
+	__slots__ = [
+		"calls",
+		"led",
+		"shared",
+	]
+
+	def __init__(self) -> None:
+		self.calls = {}  # type: Dict[Any, AsyncResult]
+		# number of computations, and of results handed to waiting greenlets
+		self.led = 0
+		self.shared = 0
+
+	def do(self, key: Any, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+		"""
+		Returns fn(*args, **kwargs), or the result of the call
+		for the same key that is already in progress.
+		Exceptions are raised in all waiting greenlets.
+		"""
+		result = self.calls.get(key)
+		if result is not None:
+			self.shared += 1
+			return result.get()
+		self.begin(key)
+		try:
+			value = fn(*args, **kwargs)
+		except BaseException as e:
+			self.fail(key, e)
+			raise
+		self.finish(key, value)
+		return value
+
+	def in_flight(self, key: Any) -> bool:
+		return key in self.calls
+
+	def begin(self, key: Any) -> bool:
+		"""
+		Start work for key, unless it is already in progress.
+		Returns True if the caller must do the work and then call
+		`finish` (or `fail`), False if it can `wait` for it instead.
+		"""
+		if key in self.calls:
+			return False
+		self.calls[key] = AsyncResult()
+		self.led += 1
+		return True
+
+	def finish(self, key: Any, value: Any) -> None:
+		result = self.calls.pop(key, None)
+		if result is not None:
+			result.set(value)
+
+	def fail(self, key: Any, exception: BaseException) -> None:
+		result = self.calls.pop(key, None)
+		if result is not None:
+			result.set_exception(exception)
+
+	def wait(self, key: Any) -> Any:
+		"""
+		Returns the result of the work in progress for key, or None
+		if there is none (any more), or if it failed.
+		"""
+		result = self.calls.get(key)
+		if result is None:
+			return None
+		self.shared += 1
+		try:
+			return result.get()
+		except Exception as e:
+			logging.debug("Shared work for %s failed: %s", key, e)
+			return None
+
+	def stats(self) -> Dict[str, int]:
+		return {
+			"in_flight": len(self.calls),
+			"led": self.led,
+			"shared": self.shared,
+		}
@@ -0,0 +1,367 @@
+from typing import *
+
+import os
+import time
+import json
+import hashlib
+import logging
+import itertools
+
+import gevent
+from gevent.queue import PriorityQueue
+
+from .loom_utils import save_atomic
+
+
+# Lower runs first: interactive requests for rows, columns and tiles,
+# then metadata, attributes, correlations and markers, then expanding whole loom files.
+JOB_PRIORITIES = {
+	"row": 0,
+	"col": 0,
+	"tile": 0,
+	"metadata": 1,
+	"attributes": 1,
+	"correlation": 1,
+	"markers": 1,
+	"rows": 2,
+	"cols": 2,
+	"tiles": 2,
+}
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class LoomJob(object):
+	"""
+	A unit of expansion work for a loom file, see LoomJobQueue
+	"""
+	__slots__ = [
+		"id",
+		"kind",
+		"project",
+		"filename",
+		"args",
+		"priority",
+		"state",
+		"progress",
+		"error",
+		"pid",
+		"created",
+		"started",
+		"finished",
+		"result_url",
+		"saved",
+	]
+
+	def __init__(self, job_id: str, kind: str, project: str, filename: str, args: List[Any], result_url: str = None) -> None:
+		self.id = job_id
+		self.kind = kind
+		self.project = project
+		self.filename = filename
+		self.args = args
+		self.priority = JOB_PRIORITIES[kind]
+		self.state = QUEUED
+		self.progress = 0.0
+		self.error = None  # type: str
+		self.pid = os.getpid()
+		self.created = time.time()
+		self.started = None  # type: float
+		self.finished = None  # type: float
+		# where the client can fetch the result once the job is done
+		self.result_url = result_url
+		self.saved = 0.0
+
+	@property
+	def active(self) -> bool:
+		return self.state == QUEUED or self.state == RUNNING
+
+	def to_dict(self) -> Dict[str, Any]:
+		return {key: getattr(self, key) for key in self.__slots__ if key != "saved"}
+
+	@classmethod
+	def from_dict(cls, data: Dict[str, Any]) -> "LoomJob":
+		job = cls(data["id"], data["kind"], data["project"], data["filename"], data["args"], data.get("result_url"))
+		for key in cls.__slots__:
+			if key in data and key != "saved":
+				setattr(job, key, data[key])
+		return job
+
+
+class LoomJobQueue(object):
+	"""
+	Runs expansion work in the background, so that requests for data
+	that is not expanded yet can be answered with `202 Accepted` and
+	a job to poll, instead of blocking until a proxy times out.
+
+	- Jobs are deduplicated: the id of a job is derived from what it
+	  expands, and submitting the same work again returns the queued
+	  or running job (also when it runs in another worker process).
+	- Jobs run in priority order (see JOB_PRIORITIES), at most
+	  `concurrency` at a time per server process, and at most
+	  `max_queued` jobs wait in the queue. One of the runners only
+	  takes interactive (priority 0) jobs, so that requests for rows,
+	  columns and tiles are not stuck behind expanding whole loom files.
+	- The state of each job is saved as JSON in state_dir, so that
+	  every worker process can report it, and jobs that were
+	  interrupted by a restart are run again.
+
+	Jobs call LoomDatasets, which does the blocking work in LoomWorkers.
+	"""
+	__slots__ = [
+		"datasets",
+		"state_dir",
+		"concurrency",
+		"max_queued",
+		"keep_finished",
+		"jobs",
+		"queue",
+		"interactive_queue",
+		"counter",
+		"runners",
+		"_pid",
+	]
+
+	def __init__(self, datasets: Any, state_dir: str, concurrency: int = 2, max_queued: int = 256, keep_finished: float = 3600) -> None:
+		"""
+		Args:
+			datasets (LoomDatasets):	Datasets to run the jobs on
+			state_dir (str):			Folder to save job states in
+			concurrency (int):			Maximum number of jobs running at the same time,
+										including the runner reserved for interactive jobs
+			max_queued (int):			Maximum number of queued jobs
+			keep_finished (float):		Seconds that finished jobs can still be polled
+		"""
+		self.datasets = datasets
+		self.state_dir = state_dir
+		self.concurrency = concurrency
+		self.max_queued = max_queued
+		self.keep_finished = keep_finished
+		self.jobs = {}  # type: Dict[str, LoomJob]
+		self.queue = None  # type: PriorityQueue
+		# interactive jobs are also queued here, for the reserved runner
+		self.interactive_queue = None  # type: PriorityQueue
+		# keeps jobs of equal priority in submission order
+		self.counter = itertools.count()
+		self.runners = []  # type: List[gevent.Greenlet]
+		self._pid = None  # type: int
+
+	def running(self) -> bool:
+		return self._pid == os.getpid()
+
+	def start(self) -> None:
+		"""
+		Start the runners of this process, and resume jobs that were
+		interrupted by a restart. Called on first use, so that
+		worker processes each start their own runners after forking.
+		"""
+		if self.running():
+			return
+		self._pid = os.getpid()
+		self.jobs = {}
+		self.queue = PriorityQueue()
+		self.interactive_queue = PriorityQueue()
+		self.runners = [gevent.spawn(self._run, self.queue) for _ in range(max(self.concurrency - 1, 1))]
+		self.runners.append(gevent.spawn(self._run, self.interactive_queue))
+		self.recover()
+
+	def job_id(self, kind: str, project: str, filename: str, args: List[Any]) -> str:
+		key = json.dumps([kind, project, filename, args])
+		return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+	def submit(self, kind: str, project: str, filename: str, args: List[Any] = None, result_url: str = None) -> LoomJob:
+		"""
+		Queue a job, unless the same job is already queued or running.
+
+		Args:
+			kind (str):			One of the keys of JOB_PRIORITIES
+			args (list):		Row or column numbers for "row" and "col" jobs, [z, x, y] for "tile" jobs,
+								[row, method] for "correlation" jobs, [attribute, group] for "markers" jobs
+
+		Returns:
+			The job, or None if the queue is full.
+		"""
+		self.start()
+		args = args or []
+		job_id = self.job_id(kind, project, filename, args)
+		job = self.get(job_id)
+		if job is not None and job.active and (job.pid == os.getpid() or pid_alive(job.pid)):
+			return job
+		if self.queue.qsize() >= self.max_queued:
+			logging.warning("Job queue is full, not queueing %s job for %s/%s", kind, project, filename)
+			return None
+		job = LoomJob(job_id, kind, project, filename, args, result_url)
+		self.enqueue(job)
+		return job
+
+	def enqueue(self, job: LoomJob) -> None:
+		job.pid = os.getpid()
+		job.state = QUEUED
+		self.jobs[job.id] = job
+		self.save(job)
+		entry = (job.priority, next(self.counter), job)
+		self.queue.put(entry)
+		if job.priority == 0:
+			self.interactive_queue.put(entry)
+
+	def get(self, job_id: str) -> LoomJob:
+		"""
+		Returns the job with the given id (also if it runs in another
+		worker process), or None if it does not exist (any more).
+		"""
+		job = self.jobs.get(job_id)
+		if job is None:
+			job = self.load(job_id)
+		return job
+
+	def _run(self, queue: PriorityQueue) -> None:
+		while True:
+			_, _, job = queue.get()
+			# interactive jobs are in both queues, whichever runner is first runs them
+			if self.jobs.get(job.id) is not job or job.state != QUEUED:
+				continue
+			job.state = RUNNING
+			job.started = time.time()
+			self.save(job)
+			try:
+				if self.run_job(job):
+					job.state = DONE
+					job.progress = 1.0
+				else:
+					job.state = FAILED
+					job.error = "Could not access %s/%s" % (job.project, job.filename)
+			except Exception as e:
+				logging.exception("Job %s (%s for %s/%s) failed", job.id, job.kind, job.project, job.filename)
+				job.state = FAILED
+				job.error = str(e)
+			job.finished = time.time()
+			self.save(job)
+			self.expire()
+
+	def run_job(self, job: LoomJob) -> bool:
+		"""
+		Does the work of a job. Returns False if the loom file could not be
+		accessed, or (for "tile" jobs) the tile could not be rendered.
+		"""
+		datasets = self.datasets
+		if job.kind == "row" or job.kind == "col":
+			if job.kind == "row":
+				stream = datasets.iter_rows(job.args, job.project, job.filename, True)
+			else:
+				stream = datasets.iter_columns(job.args, job.project, job.filename, True)
+			if stream is None:
+				return False
+			# the expanded rows end up in the cache
+			try:
+				for _ in stream:
+					pass
+			finally:
+				stream.close()
+			return True
+		elif job.kind == "tile":
+			z, x, y = job.args
+			return datasets.tile_png(job.project, job.filename, z, x, y) is not None
+		elif job.kind == "metadata":
+			return datasets.JSON_metadata(job.project, job.filename) is not None
+		elif job.kind == "attributes":
+			return datasets.JSON_attributes(job.project, job.filename) is not None
+		elif job.kind == "correlation":
+			row, method = job.args
+			return datasets.JSON_correlation(job.project, job.filename, row, method) is not None
+		elif job.kind == "markers":
+			attribute, group = job.args
+			return datasets.JSON_markers(job.project, job.filename, attribute, group) is not None
+		elif job.kind == "rows" or job.kind == "cols":
+			return datasets.expand_all(job.kind[:3], job.project, job.filename, lambda progress: self.report(job, progress))
+		elif job.kind == "tiles":
+			return datasets.tile_all(job.project, job.filename, lambda progress: self.report(job, progress))
+		raise ValueError("Unknown job kind %s" % job.kind)
+
+	def report(self, job: LoomJob, progress: float) -> None:
+		"""
+		Update the progress of a running job, saving it at most once per second.
+		"""
+		job.progress = min(progress, 1.0)
+		if time.time() - job.saved > 1.0:
+			self.save(job)
+
+	def job_path(self, job_id: str) -> str:
+		return os.path.join(self.state_dir, "%s.json" % job_id)
+
+	def save(self, job: LoomJob) -> None:
+		job.saved = time.time()
+		try:
+			os.makedirs(self.state_dir, exist_ok=True)
+			save_atomic(self.job_path(job.id), json.dumps(job.to_dict()).encode())
+		except OSError as e:
+			logging.warning("Could not save state of job %s: %s", job.id, e)
+
+	def load(self, job_id: str) -> LoomJob:
+		# job ids are hex digests, anything else cannot be a job
+		if len(job_id) != 20 or any(c not in "0123456789abcdef" for c in job_id):
+			return None
+		try:
+			with open(self.job_path(job_id)) as f:
+				return LoomJob.from_dict(json.load(f))
+		except (OSError, ValueError, KeyError):
+			return None
+
+	def recover(self) -> None:
+		"""
+		Requeue the jobs of processes that are no longer running,
+		and remove the state of jobs that finished long ago.
+		"""
+		if not os.path.isdir(self.state_dir):
+			return
+		now = time.time()
+		for name in os.listdir(self.state_dir):
+			if not name.endswith(".json"):
+				continue
+			job = self.load(name[:-5])
+			if job is None:
+				continue
+			if job.active and not pid_alive(job.pid):
+				# claim the job, so that only one worker process resumes it
+				claimed_path = "%s.%d" % (self.job_path(job.id), os.getpid())
+				try:
+					os.rename(self.job_path(job.id), claimed_path)
+				except OSError:
+					continue
+				logging.info("Resuming interrupted %s job for %s/%s", job.kind, job.project, job.filename)
+				self.enqueue(job)
+				os.remove(claimed_path)
+			elif not job.active and now - (job.finished or job.created) > self.keep_finished:
+				self.remove(job.id)
+
+	def expire(self) -> None:
+		"""
+		Forget finished jobs of this process after keep_finished seconds.
+		"""
+		now = time.time()
+		for job in list(self.jobs.values()):
+			if not job.active and now - job.finished > self.keep_finished:
+				self.remove(job.id)
+
+	def remove(self, job_id: str) -> None:
+		self.jobs.pop(job_id, None)
+		try:
+			os.remove(self.job_path(job_id))
+		except OSError:
+			pass
+
+
+def pid_alive(pid: int) -> bool:
+	if os.name == "nt":
+		# os.kill would terminate the process, and there
+		# are no worker processes on Windows anyway
+		return pid == os.getpid()
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except OSError:
+		# exists, but belongs to another user
+		return True
+	return True
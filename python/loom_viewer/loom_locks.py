@@ -0,0 +1,191 @@
+from typing import *
+
+import os
+import time
+import logging
+
+import gevent
+from gevent.event import Event
+
+try:
+	import fcntl
+except ImportError:
+	# Windows: locks only work within one process
+	fcntl = None
+
+
+class LoomFileLock(object):
+	"""
+	A reader/writer lock on a loom file that holds across processes,
+	for when the server runs with multiple worker processes (or when
+	`loom expand` runs next to the server).
+
+	Read-only access (`shared=True`) may be held by any number of
+	greenlets and processes at the same time. Exclusive access, for
+	writing to the loom file or removing its cache, excludes all
+	others. Waiting writers take precedence over new readers, so that
+	a steady stream of reads cannot starve them.
+
+	Within a process, greenlets wait on the state of this object.
+	Across processes, the first holder in a process takes an flock
+	on `<loom file>.lock` (LOCK_SH or LOCK_EX), which is polled without
+	blocking the gevent hub. If the lock file cannot be created
+	(read-only dataset folder, no fcntl on Windows), the lock falls
+	back to only excluding greenlets in the same process.
+	"""
+	__slots__ = [
+		"lock_path",
+		"readers",
+		"writer",
+		"writers_waiting",
+		"_pending",
+		"_changed",
+		"_fd",
+		"_pid",
+	]
+
+	def __init__(self, file_path: str) -> None:
+		"""
+		Args:
+			file_path (str):	Absolute path to the loom file
+		"""
+		self.lock_path = "%s.lock" % (file_path)
+		self.readers = 0
+		self.writer = False
+		self.writers_waiting = 0
+		# set while the first holder is waiting for the file lock
+		self._pending = False
+		self._changed = Event()
+		self._fd = None  # type: int
+		self._pid = None  # type: int
+
+	def _lock_fd(self) -> int:
+		"""
+		Returns the file descriptor of the lock file, or None if it cannot be used.
+		flock locks are shared between processes that share a file
+		descriptor, so forked processes must open their own.
+		"""
+		if fcntl is None:
+			return None
+		pid = os.getpid()
+		if self._pid != pid:
+			self._pid = pid
+			try:
+				self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+			except OSError as e:
+				logging.warning("Could not create lock file %s, locking within this process only: %s", self.lock_path, e)
+				self._fd = None
+		return self._fd
+
+	def _available(self, shared: bool) -> bool:
+		if self._pending or self.writer:
+			return False
+		if shared:
+			return self.writers_waiting == 0
+		return self.readers == 0
+
+	def _notify(self) -> None:
+		changed = self._changed
+		self._changed = Event()
+		changed.set()
+
+	def _wait(self, deadline: float) -> bool:
+		"""
+		Wait until the state of the lock changes, returns False on timeout
+		"""
+		if deadline is None:
+			return self._changed.wait()
+		remaining = deadline - time.monotonic()
+		return remaining > 0 and self._changed.wait(remaining)
+
+	def _flock(self, shared: bool, blocking: bool, deadline: float) -> bool:
+		fd = self._lock_fd()
+		if fd is None:
+			return True
+		operation = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB
+		delay = 0.005
+		while True:
+			try:
+				fcntl.flock(fd, operation)
+				return True
+			except BlockingIOError:
+				pass
+			if not blocking:
+				return False
+			if deadline is not None:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return False
+				delay = min(delay, remaining)
+			gevent.sleep(delay)
+			delay = min(delay * 2, 0.1)
+
+	def acquire(self, blocking: bool = True, timeout: float = None, shared: bool = False) -> bool:
+		"""
+		Acquire the lock for reading (shared) or writing (exclusive).
+
+		Args:
+			blocking (bool):	Whether to wait for the lock to become available
+			timeout (float):	Maximum time to wait in seconds, or None to wait indefinitely
+			shared (bool):		Whether to acquire the lock for reading only
+
+		Returns:
+			True if the lock was acquired, False if not.
+		"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		if not shared:
+			self.writers_waiting += 1
+		try:
+			while not self._available(shared):
+				if not (blocking and self._wait(deadline)):
+					return False
+			if shared and self.readers > 0:
+				# the file lock is already held by other readers in this process
+				self.readers += 1
+				return True
+			self._pending = True
+			try:
+				if not self._flock(shared, blocking, deadline):
+					return False
+			finally:
+				self._pending = False
+				self._notify()
+			if shared:
+				self.readers += 1
+			else:
+				self.writer = True
+			return True
+		finally:
+			if not shared:
+				self.writers_waiting -= 1
+				# readers may have been waiting for this writer
+				self._notify()
+
+	def release(self) -> None:
+		"""
+		Release the lock, whether it was acquired shared or exclusive.
+		"""
+		if self.writer:
+			self.writer = False
+		elif self.readers > 0:
+			self.readers -= 1
+		else:
+			raise ValueError("LoomFileLock released too many times")
+		if self.readers == 0:
+			fd = self._lock_fd()
+			if fd is not None:
+				fcntl.flock(fd, fcntl.LOCK_UN)
+		self._notify()
+
+	def locked(self) -> bool:
+		"""
+		Whether the lock is held (shared or exclusive) within this process
+		"""
+		return self.writer or self.readers > 0 or self._pending
+
+	def __enter__(self) -> Any:
+		self.acquire()
+		return self
+
+	def __exit__(self, type: Any, value: Any, traceback: Any) -> None:
+		self.release()
@@ -0,0 +1,241 @@
+from typing import *
+
+import os
+import time
+import bisect
+
+from contextlib import contextmanager
+
+try:
+	# Metrics are also updated from the threads of LoomWorkers,
+	# where the (monkeypatched) gevent locks must not be used
+	from gevent.monkey import get_original
+	allocate_lock = get_original("_thread", "allocate_lock")
+except ImportError:
+	from _thread import allocate_lock
+
+
+# Default histogram buckets in seconds, from 1 ms to 30 s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[Any, ...], extra: str = "") -> str:
+	labels = ['%s="%s"' % (name, escape_label(value)) for name, value in zip(names, values)]
+	if extra != "":
+		labels.append(extra)
+	if len(labels) == 0:
+		return ""
+	return "{%s}" % ",".join(labels)
+
+
+def escape_label(value: Any) -> str:
+	return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+	if value == float("inf"):
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class LoomCounter(object):
+	"""
+	A monotonically increasing counter, per combination of label values.
+	"""
+	__slots__ = [
+		"name",
+		"help",
+		"labels",
+		"values",
+		"_lock",
+	]
+
+	def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.values = {}  # type: Dict[Tuple[Any, ...], float]
+		self._lock = allocate_lock()
+
+	def inc(self, *label_values: Any, amount: float = 1) -> None:
+		with self._lock:
+			self.values[label_values] = self.values.get(label_values, 0) + amount
+
+	def get(self, *label_values: Any) -> float:
+		return self.values.get(label_values, 0)
+
+	def render(self) -> List[str]:
+		lines = [
+			"# HELP %s %s" % (self.name, self.help),
+			"# TYPE %s counter" % (self.name),
+		]
+		with self._lock:
+			values = list(self.values.items())
+		for label_values, value in sorted(values):
+			lines.append("%s%s %s" % (self.name, format_labels(self.labels, label_values), format_value(value)))
+		return lines
+
+
+class LoomHistogram(object):
+	"""
+	A histogram of observed values (typically durations in seconds),
+	per combination of label values.
+	"""
+	__slots__ = [
+		"name",
+		"help",
+		"labels",
+		"buckets",
+		"values",
+		"_lock",
+	]
+
+	def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.buckets = tuple(sorted(buckets))
+		# per label values: [count per bucket (non-cumulative, last one is +Inf), sum, count]
+		self.values = {}  # type: Dict[Tuple[Any, ...], List[Any]]
+		self._lock = allocate_lock()
+
+	def observe(self, value: float, *label_values: Any) -> None:
+		i = bisect.bisect_left(self.buckets, value)
+		with self._lock:
+			entry = self.values.get(label_values)
+			if entry is None:
+				entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+				self.values[label_values] = entry
+			entry[0][i] += 1
+			entry[1] += value
+			entry[2] += 1
+
+	@contextmanager
+	def time(self, *label_values: Any) -> Iterator[None]:
+		"""
+		Context manager that observes the duration of its block
+		"""
+		started_at = time.monotonic()
+		try:
+			yield
+		finally:
+			self.observe(time.monotonic() - started_at, *label_values)
+
+	def render(self) -> List[str]:
+		lines = [
+			"# HELP %s %s" % (self.name, self.help),
+			"# TYPE %s histogram" % (self.name),
+		]
+		with self._lock:
+			values = [(label_values, (list(entry[0]), entry[1], entry[2])) for label_values, entry in self.values.items()]
+		for label_values, (counts, total, count) in sorted(values):
+			cumulative = 0
+			for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+				cumulative += bucket_count
+				le = 'le="%s"' % format_value(bound)
+				lines.append("%s_bucket%s %d" % (self.name, format_labels(self.labels, label_values, le), cumulative))
+			labels = format_labels(self.labels, label_values)
+			lines.append("%s_sum%s %s" % (self.name, labels, format_value(total)))
+			lines.append("%s_count%s %d" % (self.name, labels, count))
+		return lines
+
+
+class LoomMetrics(object):
+	"""
+	Registry of the metrics of a server process, rendered in the
+	Prometheus text exposition format by `render`.
+
+	Every worker process (see start_server) keeps its own metrics,
+	and reports its pid in loom_process_info.
+	"""
+	__slots__ = [
+		"metrics",
+		"collectors",
+	]
+
+	def __init__(self) -> None:
+		self.metrics = []  # type: List[Union[LoomCounter, LoomHistogram]]
+		# functions returning additional lines, for values
+		# that are read when the metrics are rendered
+		self.collectors = []  # type: List[Callable[[], List[str]]]
+
+	def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> LoomCounter:
+		counter = LoomCounter(name, help, labels)
+		self.metrics.append(counter)
+		return counter
+
+	def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> LoomHistogram:
+		histogram = LoomHistogram(name, help, labels, buckets)
+		self.metrics.append(histogram)
+		return histogram
+
+	def render(self) -> str:
+		lines = [
+			"# HELP loom_process_info Server process the metrics were collected in",
+			"# TYPE loom_process_info gauge",
+			'loom_process_info{pid="%d"} 1' % os.getpid(),
+		]
+		for metric in self.metrics:
+			lines.extend(metric.render())
+		for collector in self.collectors:
+			lines.extend(collector())
+		lines.append("")
+		return "\n".join(lines)
+
+
+def gauge_lines(name: str, help: str, labels: Tuple[str, ...], values: Dict[Tuple[Any, ...], float]) -> List[str]:
+	"""
+	Renders gauges (values that can go up and down) for a collector.
+	"""
+	lines = [
+		"# HELP %s %s" % (name, help),
+		"# TYPE %s gauge" % (name),
+	]
+	for label_values, value in sorted(values.items()):
+		lines.append("%s%s %s" % (name, format_labels(labels, label_values), format_value(value)))
+	return lines
+
+
+metrics = LoomMetrics()
+
+request_seconds = metrics.histogram(
+	"loom_request_duration_seconds",
+	"Time from receiving a request until its response was fully sent, per route",
+	("endpoint", "method", "status"),
+)
+response_bytes = metrics.counter(
+	"loom_response_bytes_total",
+	"Bytes of response bodies sent (after compression), per route",
+	("endpoint",),
+)
+expansion_items = metrics.counter(
+	"loom_expansion_items_total",
+	"Rows, columns and other expanded data served, by where they came from: memory (cache), disk (cache files), expanded (read from the loom file) or shared (expanded for a concurrent request)",
+	("kind", "source"),
+)
+lock_wait_seconds = metrics.histogram(
+	"loom_lock_wait_seconds",
+	"Time spent waiting for the lock of a loom file",
+	("mode",),
+)
+lock_timeouts = metrics.counter(
+	"loom_lock_timeouts_total",
+	"Number of times the lock of a loom file could not be acquired in time",
+	("mode",),
+)
+hdf5_read_seconds = metrics.histogram(
+	"loom_hdf5_read_seconds",
+	"Duration of reads from the main matrix of loom files",
+	("operation",),
+)
+
+
+def record_request(environ: Dict[str, Any], status: Any, size: int, seconds: float) -> None:
+	"""
+	Records a handled request (see LoomWSGIHandler.log_request).
+	The route is the Flask endpoint, stored in the WSGI
+	environment under "loom.endpoint" by the application.
+	"""
+	endpoint = environ.get("loom.endpoint") or "none"
+	request_seconds.observe(seconds, endpoint, environ.get("REQUEST_METHOD", ""), status)
+	response_bytes.inc(endpoint, amount=size)
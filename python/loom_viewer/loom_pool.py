@@ -0,0 +1,206 @@
+from typing import *
+
+import os
+import time
+import logging
+
+from collections import OrderedDict
+
+import gevent
+
+from loompy import LoomConnection
+
+from .loom_workers import LoomWorkers
+
+
+class LoomPooledConnection(object):
+	"""
+	An open read-only connection to a loom file in LoomConnectionPool
+	"""
+	__slots__ = [
+		"file_path",
+		"ds",
+		"stat",
+		"users",
+		"last_used",
+		"stale",
+	]
+
+	def __init__(self, file_path: str, ds: LoomConnection, stat: Tuple[int, int]) -> None:
+		self.file_path = file_path
+		self.ds = ds
+		self.stat = stat
+		self.users = 0
+		self.last_used = time.monotonic()
+		# set when the loom file changed or the connection was evicted
+		# while in use, meaning it is closed as soon as it is released
+		self.stale = False
+
+
+class LoomConnectionPool(object):
+	"""
+	Keeps read-only loompy connections open between requests, so that
+	repeated reads of a loom file skip opening the HDF5 file and reuse
+	its chunk cache.
+
+	A connection may be handed out to multiple users at the same time
+	(h5py serialises access to the file). Connections are closed when
+	they have not been used for idle_timeout seconds, when the loom
+	file was changed on disk, or when more than max_open files are
+	open (least recently used first). Connections that are in use are
+	never closed; they are marked stale and closed once released.
+
+	Loom files are opened through the LoomWorkers of the dataset,
+	the bookkeeping itself happens in the gevent hub.
+	"""
+	__slots__ = [
+		"workers",
+		"max_open",
+		"idle_timeout",
+		"entries",
+		"stale",
+		"_reaper",
+		"_pid",
+	]
+
+	def __init__(self, workers: LoomWorkers, max_open: int = 32, idle_timeout: float = 300) -> None:
+		"""
+		Args:
+			workers (LoomWorkers):	Thread pool to open loom files in
+			max_open (int):			Maximum number of idle loom files to keep open
+			idle_timeout (float):	Seconds after which unused connections are closed
+		"""
+		self.workers = workers
+		self.max_open = max_open
+		self.idle_timeout = idle_timeout
+		self.entries = OrderedDict()  # type: OrderedDict
+		# connections that are still in use, but must not be handed out anymore
+		self.stale = {}  # type: Dict[int, LoomPooledConnection]
+		self._reaper = None  # type: gevent.Greenlet
+		self._pid = os.getpid()
+
+	def __len__(self) -> int:
+		return len(self.entries)
+
+	def acquire(self, file_path: str) -> LoomConnection:
+		"""
+		Returns a read-only connection to the loom file, opening it if
+		there is no (up-to-date) connection in the pool yet.
+		Must be returned with `release` after use, and not closed.
+		"""
+		if self._pid != os.getpid():
+			# HDF5 handles must not be shared with a forked
+			# process, so forget those of the parent process
+			self._pid = os.getpid()
+			self.entries = OrderedDict()
+			self.stale = {}
+			self._reaper = None
+		stat = self._stat(file_path)
+		entry = self.entries.get(file_path)
+		if entry is not None and entry.stat != stat:
+			logging.debug("  %s changed on disk, closing pooled connection", file_path)
+			self._discard(entry)
+			entry = None
+		if entry is None:
+			ds = self.workers.apply(file_path, LoomConnection, file_path, 'r')
+			# another greenlet may have opened the file while we waited
+			entry = self.entries.get(file_path)
+			if entry is not None and entry.stat == stat:
+				self._close(ds)
+			else:
+				if entry is not None:
+					self._discard(entry)
+				entry = LoomPooledConnection(file_path, ds, stat)
+				self.entries[file_path] = entry
+				logging.debug("  Added %s to connection pool", file_path)
+		entry.users += 1
+		entry.last_used = time.monotonic()
+		self.entries.move_to_end(file_path)
+		self._evict()
+		self._start_reaper()
+		return entry.ds
+
+	def release(self, file_path: str, ds: LoomConnection) -> None:
+		"""
+		Return a connection obtained with `acquire` to the pool.
+		"""
+		entry = self.entries.get(file_path)
+		if entry is None or entry.ds is not ds:
+			entry = self.stale.get(id(ds))
+			if entry is None:
+				logging.warning("Released a connection to %s that is not in the pool", file_path)
+				return
+		entry.users -= 1
+		entry.last_used = time.monotonic()
+		if entry.stale and entry.users == 0:
+			del self.stale[id(ds)]
+			self._close(ds)
+		else:
+			self._evict()
+
+	def close(self, file_path: str) -> None:
+		"""
+		Close the pooled connection to a loom file (once it is no
+		longer in use), for example before it is opened for writing.
+		"""
+		entry = self.entries.get(file_path)
+		if entry is not None:
+			self._discard(entry)
+
+	def close_all(self) -> None:
+		for entry in list(self.entries.values()):
+			self._discard(entry)
+
+	def expire(self) -> None:
+		"""
+		Close connections that have been idle for longer than idle_timeout.
+		"""
+		now = time.monotonic()
+		for entry in list(self.entries.values()):
+			if entry.users == 0 and now - entry.last_used > self.idle_timeout:
+				logging.debug("  Closing idle pooled connection to %s", entry.file_path)
+				self._discard(entry)
+
+	def _stat(self, file_path: str) -> Tuple[int, int]:
+		stat = os.stat(file_path)
+		return (stat.st_ino, stat.st_mtime_ns)
+
+	def _evict(self) -> None:
+		"""
+		Close least recently used idle connections while over max_open
+		"""
+		if len(self.entries) <= self.max_open:
+			return
+		for entry in list(self.entries.values()):
+			if len(self.entries) <= self.max_open:
+				break
+			if entry.users == 0:
+				logging.debug("  Evicting %s from connection pool", entry.file_path)
+				self._discard(entry)
+
+	def _discard(self, entry: LoomPooledConnection) -> None:
+		"""
+		Remove a connection from the pool, closing it if it is not in use.
+		"""
+		if self.entries.get(entry.file_path) is entry:
+			del self.entries[entry.file_path]
+		if entry.users == 0:
+			self._close(entry.ds)
+		else:
+			entry.stale = True
+			self.stale[id(entry.ds)] = entry
+
+	def _close(self, ds: LoomConnection) -> None:
+		try:
+			ds.close(True)
+		except Exception as e:
+			logging.warning("Could not close pooled connection: %s", e)
+
+	def _start_reaper(self) -> None:
+		if self._reaper is None or self._reaper.dead:
+			self._reaper = gevent.spawn(self._reap)
+
+	def _reap(self) -> None:
+		while len(self.entries) > 0:
+			gevent.sleep(min(self.idle_timeout, 60))
+			self.expire()
@@ -0,0 +1,164 @@
+from typing import *
+
+import os
+import time
+import logging
+import cProfile
+
+from contextlib import contextmanager
+from functools import wraps
+
+from gevent.local import local
+
+try:
+	# Phases are also recorded from the threads of LoomWorkers,
+	# where the (monkeypatched) gevent primitives must not be used
+	from gevent.monkey import get_original
+	allocate_lock = get_original("_thread", "allocate_lock")
+	thread_local = get_original("threading", "local")
+except ImportError:
+	from _thread import allocate_lock
+	from threading import local as thread_local
+
+
+class LoomProfile(object):
+	"""
+	Time spent per phase (auth, lock wait, HDF5 reads, JSON
+	serialisation, ...) while handling one profiled request,
+	optionally together with a cProfile of the request.
+
+	Phases can be nested and may overlap (for example a
+	hdf5_read inside a worker job), so they do not add up to the total.
+	"""
+	__slots__ = [
+		"started_at",
+		"phases",
+		"profiler",
+		"_lock",
+	]
+
+	def __init__(self, profiler: cProfile.Profile = None) -> None:
+		self.started_at = time.monotonic()
+		# name -> [total seconds, count]
+		self.phases = {}  # type: Dict[str, List[Any]]
+		self.profiler = profiler
+		self._lock = allocate_lock()
+
+	def add(self, name: str, seconds: float) -> None:
+		with self._lock:
+			entry = self.phases.get(name)
+			if entry is None:
+				self.phases[name] = [seconds, 1]
+			else:
+				entry[0] += seconds
+				entry[1] += 1
+
+	def server_timing(self) -> str:
+		"""
+		Returns the phases as the value of a Server-Timing header,
+		with durations in milliseconds.
+		"""
+		with self._lock:
+			phases = sorted(self.phases.items(), key=lambda item: -item[1][0])
+		metrics = ['%s;desc="%dx";dur=%.3f' % (name, count, seconds * 1000) for name, (seconds, count) in phases]
+		metrics.append("total;dur=%.3f" % ((time.monotonic() - self.started_at) * 1000))
+		return ", ".join(metrics)
+
+	def dump(self, profile_dir: str, name: str) -> str:
+		"""
+		Saves the cProfile of the request (in the pstats format read by
+		snakeviz, flameprof and gprof2dot) to the profile_dir folder.
+
+		Returns:
+			The path of the saved file, or None if there is nothing to save.
+		"""
+		if self.profiler is None:
+			return None
+		file_path = os.path.join(profile_dir, "%s-%d-%s.prof" % (time.strftime("%Y%m%dT%H%M%S"), os.getpid(), name))
+		try:
+			os.makedirs(profile_dir, exist_ok=True)
+			self.profiler.dump_stats(file_path)
+		except OSError as e:
+			logging.warning("Could not save profile to %s: %s", file_path, e)
+			return None
+		return file_path
+
+
+# the profile of the request handled by the current greenlet
+_greenlet_profile = local()
+# the profile of the request a job in a LoomWorkers thread runs for
+_thread_profile = thread_local()
+
+
+def current_profile() -> LoomProfile:
+	profile = getattr(_thread_profile, "profile", None)
+	if profile is None:
+		profile = getattr(_greenlet_profile, "profile", None)
+	return profile
+
+
+def start_profile(with_profiler: bool = False) -> LoomProfile:
+	"""
+	Start profiling the request handled by the current greenlet.
+	With with_profiler, the request is also run under cProfile. Note that
+	cProfile only sees the gevent hub thread, and that other requests
+	served while this one waits (for example for the lock of a loom
+	file) show up in it as well.
+	"""
+	profiler = None
+	if with_profiler:
+		profiler = cProfile.Profile()
+	profile = LoomProfile(profiler)
+	_greenlet_profile.profile = profile
+	if profiler is not None:
+		profiler.enable()
+	return profile
+
+
+def stop_profile() -> LoomProfile:
+	"""
+	Stop profiling the request handled by the current greenlet.
+	Returns its profile, or None if it was not profiled.
+	"""
+	profile = getattr(_greenlet_profile, "profile", None)
+	_greenlet_profile.profile = None
+	if profile is not None and profile.profiler is not None:
+		profile.profiler.disable()
+	return profile
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+	"""
+	Context manager that adds the duration of its block to the
+	given phase of the current profile, if the request is profiled.
+	"""
+	profile = current_profile()
+	if profile is None:
+		yield
+		return
+	started_at = time.monotonic()
+	try:
+		yield
+	finally:
+		profile.add(name, time.monotonic() - started_at)
+
+
+def bind_profile(fn: Callable) -> Callable:
+	"""
+	Returns fn, or, if the current request is profiled, a wrapper of
+	fn that records its phases in the profile of the current request
+	when it is called from another thread (see LoomWorkers.apply).
+	"""
+	profile = current_profile()
+	if profile is None:
+		return fn
+
+	@wraps(fn)
+	def profiled(*args: Any, **kwargs: Any) -> Any:
+		_thread_profile.profile = profile
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			_thread_profile.profile = None
+	return profiled
@@ -0,0 +1,136 @@
+from typing import *
+
+import math
+
+import numpy as np
+
+
+# The finest level of the pyramid has 2^MAX_LEVEL by 2^MAX_LEVEL bins
+MAX_LEVEL = 10
+MAX_BINS = 1 << MAX_LEVEL
+
+
+class LoomScatterPyramid(object):
+	"""
+	Cells binned into a 2D grid over two column attributes (typically
+	an embedding like _tSNE1/_tSNE2), so that scatterplots of millions
+	of cells can be drawn from the number of cells per bin instead of
+	from the coordinates of every cell.
+
+	The counts are precomputed for every power-of-two resolution up
+	to MAX_BINS by MAX_BINS bins (each level summing 2x2 bins of the
+	level above it), over the extent of all cells. Views of a part of
+	the embedding (a viewport) are binned from the coordinates directly.
+	"""
+	__slots__ = [
+		"x",
+		"y",
+		"valid",
+		"extent",
+		"bin_x",
+		"bin_y",
+		"levels",
+	]
+
+	def __init__(self, x: np.ndarray, y: np.ndarray) -> None:
+		x = np.asarray(x, dtype=np.float64)
+		y = np.asarray(y, dtype=np.float64)
+		# cells without coordinates are left out
+		self.valid = np.isfinite(x) & np.isfinite(y)
+		self.x = x.astype(np.float32)
+		self.y = y.astype(np.float32)
+		if self.valid.any():
+			xmin, xmax = float(x[self.valid].min()), float(x[self.valid].max())
+			ymin, ymax = float(y[self.valid].min()), float(y[self.valid].max())
+		else:
+			xmin, xmax, ymin, ymax = 0.0, 0.0, 0.0, 0.0
+		# avoid empty ranges, for embeddings with a single distinct value
+		if xmax <= xmin:
+			xmax = xmin + 1.0
+		if ymax <= ymin:
+			ymax = ymin + 1.0
+		self.extent = (xmin, ymin, xmax, ymax)
+
+		# bin of every valid cell at the finest level
+		self.bin_x = bin_numbers(x[self.valid], xmin, xmax, MAX_BINS)
+		self.bin_y = bin_numbers(y[self.valid], ymin, ymax, MAX_BINS)
+		counts = np.bincount(self.bin_y * MAX_BINS + self.bin_x, minlength=MAX_BINS * MAX_BINS)
+		counts = counts.astype(np.int32).reshape(MAX_BINS, MAX_BINS)
+		levels = [counts]
+		for _ in range(MAX_LEVEL):
+			size = counts.shape[0] // 2
+			counts = counts.reshape(size, 2, size, 2).sum(axis=(1, 3))
+			levels.append(counts)
+		# levels[k] has 2^k by 2^k bins
+		self.levels = levels[::-1]
+
+	@property
+	def nbytes(self) -> int:
+		return (
+			self.x.nbytes + self.y.nbytes + self.valid.nbytes +
+			self.bin_x.nbytes + self.bin_y.nbytes +
+			sum(counts.nbytes for counts in self.levels)
+		)
+
+	def aggregate(self, bins: int, viewport: Tuple[float, float, float, float] = None, values: np.ndarray = None) -> Dict[str, Any]:
+		"""
+		Bins the cells into a grid of bins by bins bins (at most
+		MAX_BINS), over the whole embedding or a viewport of it.
+
+		Args:
+			bins (int):				Requested number of bins per axis. Without a viewport,
+									this is rounded up to a power of two.
+			viewport (tuple):		(xmin, ymin, xmax, ymax) in the coordinates of the embedding,
+									or None for the whole embedding
+			values (array):			Optional value per cell (a row, or a numeric column attribute)
+									to compute the mean of per bin. Non-finite values are left out.
+
+		Returns:
+			A dictionary with the number of bins per axis ("bins"), the
+			area covered ("extent"), and for the non-empty bins only
+			their index (y * bins + x, with y = 0 at the minimum),
+			number of cells ("count"), and the mean value ("mean",
+			None for bins without finite values) if values were given.
+		"""
+		bins = max(1, min(bins, MAX_BINS))
+		if viewport is None:
+			level = min(MAX_LEVEL, int(math.ceil(math.log2(bins))))
+			bins = 1 << level
+			counts = self.levels[level].ravel()
+			shift = MAX_LEVEL - level
+			cells = self.valid
+			index = (self.bin_y >> shift) * bins + (self.bin_x >> shift)
+			extent = self.extent
+		else:
+			xmin, ymin, xmax, ymax = viewport
+			x = self.x[self.valid]
+			y = self.y[self.valid]
+			inside = (x >= xmin) & (x < xmax) & (y >= ymin) & (y < ymax)
+			cells = np.flatnonzero(self.valid)[inside]
+			index = bin_numbers(y[inside], ymin, ymax, bins) * bins + bin_numbers(x[inside], xmin, xmax, bins)
+			counts = np.bincount(index, minlength=bins * bins)
+			extent = (xmin, ymin, xmax, ymax)
+
+		nonempty = np.flatnonzero(counts)
+		result = {
+			"bins": bins,
+			"extent": list(extent),
+			"index": nonempty.tolist(),
+			"count": counts[nonempty].tolist(),
+		}  # type: Dict[str, Any]
+		if values is not None:
+			values = np.asarray(values, dtype=np.float64)[cells]
+			finite = np.isfinite(values)
+			sums = np.bincount(index[finite], weights=values[finite], minlength=bins * bins)[nonempty]
+			finite_counts = np.bincount(index[finite], minlength=bins * bins)[nonempty]
+			result["mean"] = [s / c if c > 0 else None for s, c in zip(sums.tolist(), finite_counts.tolist())]
+		return result
+
+
+def bin_numbers(values: np.ndarray, vmin: float, vmax: float, bins: int) -> np.ndarray:
+	"""
+	Returns the bin of each value, for bins equal-sized bins over
+	[vmin, vmax] (the maximum is included in the last bin).
+	"""
+	numbers = ((values - vmin) * (bins / (vmax - vmin))).astype(np.int64)
+	return np.clip(numbers, 0, bins - 1)
@@ -0,0 +1,206 @@
+from typing import *
+
+import bisect
+
+import numpy as np
+
+
+# Queries shorter than this are only matched by prefix, since
+# nearly every short term is within one typo of the query
+MIN_FUZZY_LENGTH = 3
+
+
+class LoomSearchIndex(object):
+	"""
+	Index of the values of the string row attributes of a loom file
+	(gene names, accessions, ...), for autocompletion.
+
+	- Prefix lookups use the sorted, lowercased distinct values
+	  ("terms"), searched with bisect.
+	- Typo-tolerant lookups find the terms within one edit (insertion,
+	  deletion, substitution or transposition) of the query, using a
+	  symmetric deletion index (as in SymSpell): every term is indexed
+	  under itself and each variant with one character deleted, so
+	  candidates are found by looking up the query and its own
+	  one-deletion variants. Variants are stored as sorted hashes,
+	  which is much smaller than a dictionary of strings.
+
+	The rows of every term are stored in `term_attrs`/`term_rows`,
+	from `offsets[i]` up to `offsets[i + 1]` for term i.
+	"""
+	__slots__ = [
+		"attributes",
+		"values",
+		"terms",
+		"offsets",
+		"term_attrs",
+		"term_rows",
+		"variant_hashes",
+		"variant_terms",
+	]
+
+	def __init__(self, attributes: List[str], values: List[List[str]], terms: List[str], offsets: Any, term_attrs: Any, term_rows: Any) -> None:
+		"""
+		Use `build` to index row attributes, and `from_dict` to load a saved index.
+		"""
+		self.attributes = attributes
+		self.values = values
+		self.terms = terms
+		self.offsets = np.asarray(offsets, dtype=np.int64)
+		self.term_attrs = np.asarray(term_attrs, dtype=np.int16)
+		self.term_rows = np.asarray(term_rows, dtype=np.int32)
+
+		# The deletion index is rebuilt rather than saved: it is quick to
+		# compute, and Python string hashes differ between processes.
+		hashes = []  # type: List[int]
+		term_ids = []  # type: List[int]
+		for i, term in enumerate(terms):
+			for variant in deletion_variants(term):
+				hashes.append(hash(variant))
+				term_ids.append(i)
+		variant_hashes = np.array(hashes, dtype=np.int64)
+		order = np.argsort(variant_hashes, kind="stable")
+		self.variant_hashes = variant_hashes[order]
+		self.variant_terms = np.array(term_ids, dtype=np.int32)[order]
+
+	@classmethod
+	def build(cls, row_attrs: Dict[str, List[str]]) -> "LoomSearchIndex":
+		"""
+		Args:
+			row_attrs (dict):	Values of every row, per row attribute
+		"""
+		attributes = sorted(row_attrs.keys())
+		values = [[str(value) for value in row_attrs[attribute]] for attribute in attributes]
+		entries = sorted(
+			(value.lower(), a, row)
+			for a, attribute_values in enumerate(values)
+			for row, value in enumerate(attribute_values)
+			if value != ""
+		)
+		terms = []  # type: List[str]
+		offsets = []  # type: List[int]
+		for i, (term, _, _) in enumerate(entries):
+			if len(terms) == 0 or terms[-1] != term:
+				terms.append(term)
+				offsets.append(i)
+		offsets.append(len(entries))
+		term_attrs = [a for _, a, _ in entries]
+		term_rows = [row for _, _, row in entries]
+		return cls(attributes, values, terms, offsets, term_attrs, term_rows)
+
+	def to_dict(self) -> Dict[str, Any]:
+		return {
+			"attributes": self.attributes,
+			"values": self.values,
+			"terms": self.terms,
+			"offsets": self.offsets.tolist(),
+			"termAttrs": self.term_attrs.tolist(),
+			"termRows": self.term_rows.tolist(),
+		}
+
+	@classmethod
+	def from_dict(cls, data: Dict[str, Any]) -> "LoomSearchIndex":
+		return cls(data["attributes"], data["values"], data["terms"], data["offsets"], data["termAttrs"], data["termRows"])
+
+	@property
+	def nbytes(self) -> int:
+		# rough estimate, Python strings take ~50 bytes plus their length
+		strings = sum(len(value) + 50 for attribute_values in self.values for value in attribute_values)
+		strings += sum(len(term) + 50 for term in self.terms)
+		return (
+			strings +
+			self.offsets.nbytes + self.term_attrs.nbytes + self.term_rows.nbytes +
+			self.variant_hashes.nbytes + self.variant_terms.nbytes
+		)
+
+	def search(self, query: str, limit: int = 20, attribute: str = None, fuzzy: bool = True) -> List[Dict[str, Any]]:
+		"""
+		Finds rows by the values of their attributes, case-insensitively.
+
+		Args:
+			query (str):		(Start of) the value to look for
+			limit (int):		Maximum number of rows to return
+			attribute (str):	Only search this row attribute, instead of all of them
+			fuzzy (bool):		Also return values that are one typo away from the query
+
+		Returns:
+			Up to limit matches, each row at most once: exact matches
+			first, then values starting with the query (shortest first),
+			then values within one typo of the query. For example:
+
+				{"row": 42, "attribute": "Gene", "value": "Actb", "match": "prefix"}
+		"""
+		query = query.strip().lower()
+		if query == "" or limit <= 0:
+			return []
+		attribute_number = None
+		if attribute is not None:
+			if attribute not in self.attributes:
+				return []
+			attribute_number = self.attributes.index(attribute)
+
+		start = bisect.bisect_left(self.terms, query)
+		end = start
+		while end < len(self.terms) and self.terms[end].startswith(query):
+			end += 1
+		# the exact match (if any) sorts first
+		matches = [(i, "exact" if self.terms[i] == query else "prefix") for i in sorted(range(start, end), key=lambda i: (len(self.terms[i]), i))]
+
+		if fuzzy and len(query) >= MIN_FUZZY_LENGTH:
+			candidates = set()  # type: Set[int]
+			for variant in deletion_variants(query):
+				h = hash(variant)
+				lo = np.searchsorted(self.variant_hashes, h, side="left")
+				hi = np.searchsorted(self.variant_hashes, h, side="right")
+				candidates.update(self.variant_terms[lo:hi].tolist())
+			for term in sorted(candidates):
+				if not (start <= term < end) and edit_distance(query, self.terms[term]) == 1:
+					matches.append((term, "fuzzy"))
+
+		results = []  # type: List[Dict[str, Any]]
+		seen = set()  # type: Set[int]
+		for term, match in matches:
+			for j in range(self.offsets[term], self.offsets[term + 1]):
+				a = int(self.term_attrs[j])
+				row = int(self.term_rows[j])
+				if row in seen or (attribute_number is not None and a != attribute_number):
+					continue
+				seen.add(row)
+				results.append({
+					"row": row,
+					"attribute": self.attributes[a],
+					"value": self.values[a][row],
+					"match": match,
+				})
+				if len(results) >= limit:
+					return results
+		return results
+
+
+def deletion_variants(term: str) -> Set[str]:
+	"""
+	Returns the term and every variant of it with one character deleted.
+	"""
+	variants = {term}
+	for i in range(len(term)):
+		variants.add(term[:i] + term[i + 1:])
+	return variants
+
+
+def edit_distance(a: str, b: str) -> int:
+	"""
+	Optimal string alignment distance: the number of insertions,
+	deletions, substitutions and transpositions of adjacent characters
+	needed to turn a into b.
+	"""
+	previous2 = None  # type: List[int]
+	previous = list(range(len(b) + 1))
+	for i in range(1, len(a) + 1):
+		current = [i] + [0] * len(b)
+		for j in range(1, len(b) + 1):
+			cost = 0 if a[i - 1] == b[j - 1] else 1
+			current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+			if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+				current[j] = min(current[j], previous2[j - 2] + 1)
+		previous2, previous = previous, current
+	return previous[len(b)]
@@ -16,6 +16,11 @@ import subprocess
 import logging
 import signal
 import time
+import gzip
+import calendar
+import struct
+import hmac
+import json
 
 import flask
 from flask import request
@@ -32,6 +37,11 @@ import gevent.socket
 import gevent.pywsgi as wsgi
 
 from .loom_datasets import LoomDatasets
+from .loom_jobs import LoomJobQueue, LoomJob
+from .loom_download import LoomWSGIHandler, send_file_range
+from .loom_utils import timestamp_to_epoch
+from .loom_metrics import metrics
+from .loom_profile import start_profile, stop_profile, current_profile, phase
 
 
 def cache(expires: int = None, round_to_minute: bool = False) -> Any:
@@ -75,6 +85,78 @@ def cache(expires: int = None, round_to_minute: bool = False) -> Any:
 	return cache_decorator
 
 
+def conditional(expires: int = None) -> Any:
+	"""
+	Add validators (ETag and Last-Modified) to responses that serve
+	content from a single loom file, derived from the last_modified
+	timestamp of that loom file, and answer If-None-Match and
+	If-Modified-Since with 304 Not Modified without calling the view.
+
+	Expects the view to take `project` and `filename` keyword arguments.
+
+	If expires is None, clients may store responses but must
+	revalidate them before every use. Otherwise they may reuse
+	responses for expires seconds without revalidating.
+
+	Views can opt out of validation for a response by setting
+	`Cache-Control: no-store` on it (used for failed requests).
+	"""
+	def conditional_decorator(view: Any) -> Any:
+		@wraps(view)
+		def conditional_func(*args: Any, **kwargs: Any) -> Any:
+			project = kwargs.get("project")
+			filename = kwargs.get("filename")
+			(u, p) = get_auth(request)
+			last_mod = None
+			if loom_server.datasets.authorize(project, u, p):
+				last_mod = loom_server.datasets.dataset_last_mod(project, filename)
+			last_modified = timestamp_to_epoch(last_mod)
+			if last_modified is None:
+				# Unknown, inaccessible or unauthorized loom
+				# file, so the view will reply with an error
+				return cache(expires=None)(view)(*args, **kwargs)
+
+			# The same URL can be served as JSON or binary, so the
+			# representation is part of the ETag. Weak ETags are used
+			# because the bytes differ with the Content-Encoding.
+			etag = "%s-%s" % (last_mod, "binary" if wants_binary(request) else "json")
+
+			if request.if_none_match:
+				not_modified = request.if_none_match.contains_weak(etag)
+			elif request.if_modified_since is not None:
+				since = calendar.timegm(request.if_modified_since.utctimetuple())
+				not_modified = int(last_modified) <= since
+			else:
+				not_modified = False
+
+			if not_modified:
+				response = flask.Response(status=304)
+			else:
+				response = make_response(view(*args, **kwargs))
+				if response.status_code != 200 or response.cache_control.no_store:
+					return response
+
+			response.set_etag(etag, weak=True)
+			response.headers['Last-Modified'] = format_date_time(last_modified)
+			if expires is None:
+				response.headers['Cache-Control'] = 'private, no-cache'
+			else:
+				response.headers['Cache-Control'] = 'private, max-age=%d' % expires
+			response.vary.add('Accept')
+			return response
+		return conditional_func
+	return conditional_decorator
+
+
+def uncacheable(response: Any) -> Any:
+	"""
+	Mark a response as not to be stored, to prevent
+	`conditional` from validating an error response.
+	"""
+	response.headers['Cache-Control'] = 'no-store'
+	return response
+
+
 # Advanced routing for fetching multiple rows/columns at once
 # creates list of integers based on a '+' separated string
 class IntDictConverter(BaseConverter):
@@ -103,6 +185,7 @@ class LoomServer(object):
 		"app",
 		"datasets",
 		"dataset_path",
+		"jobs",
 	]
 
 	def __init__(self, dataset_path: str = None) -> None:
@@ -111,21 +194,92 @@ class LoomServer(object):
 
 		app.url_map.converters['intdict'] = IntDictConverter
 
+		# after_request functions run in reverse order of registration,
+		# so this one runs after flask_compress
+		app.after_request(finish_profile)
+
 		# enable GZIP compression
 		compress = Compress()
+		# not application/octet-stream: binary rows and columns are gzipped
+		# explicitly (see binary_response), other binary downloads not at all
 		app.config['COMPRESS_MIMETYPES'] = ['text/plain', 'text/html', 'text/css', 'text/xml', 'application/json', 'text/javascript']
 		app.config['COMPRESS_LEVEL'] = 2
 		compress.init_app(app)
 
+		# and this one before flask_compress
+		app.after_request(buffer_profiled)
+
+		@app.before_request
+		def begin_request() -> None:
+			# label request metrics by route (see LoomWSGIHandler.log_request)
+			request.environ["loom.endpoint"] = request.endpoint
+			if profiling_requested(request):
+				start_profile(with_profiler=app.config.get('PROFILE_DIR') is not None)
+
+		@app.teardown_request
+		def end_request(exception: Exception = None) -> None:
+			# in case the request failed before finish_profile
+			stop_profile()
+
 		self.app = app
 		self.update_dataset(dataset_path)
+		metrics.collectors.append(lambda: self.datasets.metrics())
 
-	def update_dataset(self, dataset_path: str = None) -> None:
-		self.datasets = LoomDatasets(dataset_path)
+	def update_dataset(self, dataset_path: str = None, **options: Any) -> None:
+		"""
+		Options are passed on to LoomDatasets
+		"""
+		self.datasets = LoomDatasets(dataset_path, **options)
 		self.dataset_path = dataset_path
+		# job states are kept in a hidden folder, which is not mistaken for a project
+		self.jobs = LoomJobQueue(self.datasets, os.path.join(self.datasets.list.dataset_path, ".jobs"))
 
 
 
+def profiling_requested(request: Any) -> bool:
+	"""
+	Requests are profiled if the server profiles all requests
+	(--profile-all), or if their X-Loom-Profile header matches
+	the token set with --profile-token.
+	"""
+	config = loom_server.app.config
+	if config.get('PROFILE_ALL'):
+		return True
+	token = config.get('PROFILE_TOKEN')
+	header = request.headers.get("X-Loom-Profile")
+	return token is not None and header is not None and hmac.compare_digest(header.encode(), token.encode())
+
+
+def buffer_profiled(response: Any) -> Any:
+	"""
+	Profiled responses are not streamed: the body is generated here,
+	so that the phases of generating it end up in the Server-Timing
+	header (which is sent before the body).
+	"""
+	profile = current_profile()
+	if profile is not None:
+		if response.is_streamed and not response.direct_passthrough:
+			with phase("stream"):
+				response.get_data()
+		request.environ["loom.compress_start"] = time.monotonic()
+	return response
+
+
+def finish_profile(response: Any) -> Any:
+	profile = stop_profile()
+	if profile is not None:
+		compress_start = request.environ.get("loom.compress_start")
+		if compress_start is not None:
+			profile.add("compress", time.monotonic() - compress_start)
+		response.headers["Server-Timing"] = profile.server_timing()
+		profile_dir = loom_server.app.config.get('PROFILE_DIR')
+		if profile_dir is not None:
+			file_path = profile.dump(profile_dir, request.endpoint or "none")
+			if file_path is not None:
+				logging.info("Saved profile of %s to %s", request.path, file_path)
+	return response
+
+
 loom_server = LoomServer()
 
 
@@ -209,62 +363,444 @@ def get_auth(request: Any) -> Any:
 		return (None, None)
 
 
+def accepts_gzip(request: Any) -> bool:
+	return "gzip" in request.headers.get("Accept-Encoding", "").lower()
+
+
+def gzipped_response(data: Union[bytes, Iterable[bytes]], mimetype: str) -> Any:
+	"""
+	Serve already gzipped data (or a stream of it) as-is. Because the
+	Content-Encoding header is set, flask_compress will not compress
+	it a second time (which would also defeat streaming).
+	"""
+	response = flask.Response(data, mimetype=mimetype)
+	response.headers["Content-Encoding"] = "gzip"
+	response.headers["Vary"] = "Accept-Encoding"
+	return response
+
+
+def binary_response(data: bytes, request: Any) -> Any:
+	"""
+	Serve binary rows or columns (see wants_binary), gzipped if the
+	client accepts it, with the same settings as flask_compress.
+	"""
+	if accepts_gzip(request) and len(data) >= loom_server.app.config.get('COMPRESS_MIN_SIZE', 500):
+		return gzipped_response(gzip.compress(data, loom_server.app.config['COMPRESS_LEVEL']), "application/octet-stream")
+	return flask.Response(data, mimetype="application/octet-stream")
+
+
+def wants_async(request: Any) -> bool:
+	"""
+	Clients that send a `Prefer: respond-async` header (RFC 7240) get
+	`202 Accepted` and a job to poll at /jobs/<id> when the requested
+	data still has to be expanded, instead of waiting for it.
+	"""
+	return "respond-async" in request.headers.get("Prefer", "").lower()
+
+
+def accepted(job: LoomJob) -> Any:
+	"""
+	Response for a queued job, or 503 if the job queue is full.
+	"""
+	if job is None:
+		response = flask.Response(json.dumps({"error": "Too many queued jobs"}), status=503, mimetype="application/json")
+		response.headers["Retry-After"] = "10"
+		return uncacheable(response)
+	response = flask.Response(json.dumps(job.to_dict()), status=202, mimetype="application/json")
+	response.headers["Location"] = "/jobs/%s" % job.id
+	response.headers["Retry-After"] = "1"
+	response.headers["Preference-Applied"] = "respond-async"
+	return uncacheable(response)
+
+
+def wants_binary(request: Any) -> bool:
+	"""
+	Rows and columns are served in the binary format (see
+	`binary_array` in loom_utils) if the client asks for it
+	with `?format=binary` or an `Accept: application/octet-stream` header.
+	"""
+	if request.args.get("format") == "binary":
+		return True
+	return request.accept_mimetypes.best_match(["application/json", "application/octet-stream"]) == "application/octet-stream"
+
+
 # List of all datasets
 @loom_server.app.route('/loom', methods=['GET'])
-@cache(expires=None)
 def send_dataset_list() -> Any:
 	(u, p) = get_auth(request)
 	dataset_list = loom_server.datasets.JSON_metadata_list(u, p)
-	return flask.Response(dataset_list, mimetype="application/json")
+	response = flask.Response(dataset_list, mimetype="application/json")
+	# The list depends on the credentials and all loom files, so
+	# instead of deriving an ETag we hash the list itself. That
+	# does not save work on the server, but does save transfers.
+	response.add_etag()
+	response.headers['Cache-Control'] = 'private, no-cache'
+	return response.make_conditional(request)
 
 
 # Info for a single dataset
 @loom_server.app.route('/loom/<string:project>/<string:filename>', methods=['GET'])
-@cache(expires=None)
+@conditional(expires=None)
 def send_fileinfo(project: str, filename: str) -> Any:
 	(u, p) = get_auth(request)
 	if loom_server.datasets.authorize(project, u, p):
+		if wants_async(request) and not loom_server.datasets.is_expanded("attributes", project, filename):
+			return accepted(loom_server.jobs.submit("attributes", project, filename, result_url=request.path))
+		if accepts_gzip(request):
+			attributes = loom_server.datasets.gzipped_attributes(project, filename)
+			if attributes is not None and len(attributes) > 0:
+				return gzipped_response(attributes, "application/json")
+			return "", 404
 		attributes = loom_server.datasets.JSON_attributes(project, filename)
 		if attributes is not None and attributes is not "":
 			return flask.Response(attributes, mimetype="application/json")
 	return "", 404
 
 
-# Download a dataset to the client
+# Download a dataset to the client. Supports resuming
+# interrupted downloads through HTTP Range requests.
 @loom_server.app.route('/clone/<string:project>/<string:filename>', methods=['GET'])
-@cache(expires=None)
 def get_clone(project: str, filename: str) -> Any:
 	(u, p) = get_auth(request)
 	if loom_server.datasets.authorize(project, u, p):
 		file_path = loom_server.datasets.list.absolute_file_path(project, filename)
-		return flask.send_file(file_path, mimetype='application/octet-stream')
+		if file_path != "":
+			# streamed from disk, and never gzipped (application/x-hdf5 is not in COMPRESS_MIMETYPES)
+			rate_limit = loom_server.app.config.get('CLONE_RATE_LIMIT')
+			return send_file_range(file_path, request, 'application/x-hdf5', rate_limit)
 	return "", 404
 
 
 # Get one or more rows of data (i.e. all the expression values for a single gene)
 @loom_server.app.route('/loom/<string:project>/<string:filename>/row/<intdict:row_numbers>')
-@cache(expires=None)
+@conditional(expires=None)
 def send_row(project: str, filename: str, row_numbers: List[int]) -> Any:
 	# path to desired rows
+	(u, p) = get_auth(request)
+	binary = wants_binary(request)
+	if loom_server.datasets.authorize(project, u, p):
+		try:
+			selection = parse_column_selection(request.args)
+			# raises for unknown column attributes
+			column_numbers = loom_server.datasets.select_columns(project, filename, *selection)
+		except ValueError as e:
+			return uncacheable(flask.Response(str(e), status=400, mimetype="text/plain"))
+		if column_numbers is not None:
+			# only the selected columns of each row are sent
+			if binary:
+				rows = loom_server.datasets.binary_rows_columns(row_numbers, column_numbers, project, filename)
+				if rows is not None:
+					return binary_response(rows, request)
+			else:
+				gzipped = accepts_gzip(request)
+				rows = loom_server.datasets.iter_rows_columns(row_numbers, column_numbers, project, filename, gzipped)
+				if rows is not None:
+					if gzipped:
+						return gzipped_response(rows, "application/json")
+					return flask.Response(rows, mimetype="application/json")
+		elif binary:
+			rows = loom_server.datasets.binary_rows(row_numbers, project, filename)
+			if rows is not None:
+				return binary_response(rows, request)
+		else:
+			if wants_async(request) and not loom_server.datasets.is_expanded("row", project, filename, row_numbers):
+				return accepted(loom_server.jobs.submit("row", project, filename, sorted(set(row_numbers)), request.path))
+			gzipped = accepts_gzip(request)
+			rows = loom_server.datasets.iter_rows(row_numbers, project, filename, gzipped)
+			if rows is not None:
+				if gzipped:
+					return gzipped_response(rows, "application/json")
+				return flask.Response(rows, mimetype="application/json")
+	if binary:
+		return uncacheable(flask.Response(b"", mimetype="application/octet-stream"))
+	return uncacheable(flask.Response("[]", mimetype="application/json"))
+
+
+# Aggregate one or more rows per group of columns with the same value of
+# a column attribute (for example the mean expression of a gene per cluster).
+# Quantiles can be chosen with ?quantiles=0.1,0.5,0.9 (default 0.25,0.5,0.75).
+@loom_server.app.route('/loom/<string:project>/<string:filename>/row/<intdict:row_numbers>/groups/<string:attribute>')
+@conditional(expires=None)
+def send_row_groups(project: str, filename: str, row_numbers: List[int], attribute: str) -> Any:
 	(u, p) = get_auth(request)
 	if loom_server.datasets.authorize(project, u, p):
-		rows = loom_server.datasets.JSON_rows(row_numbers, project, filename)
-		if rows is not None:
-			return flask.Response(rows, mimetype="application/json")
-	return flask.Response("[]", mimetype="application/json")
+		quantiles = (0.25, 0.5, 0.75)
+		if "quantiles" in request.args:
+			try:
+				quantiles = tuple(float(q) for q in request.args.get("quantiles").split(",") if q != "")
+			except ValueError:
+				quantiles = None
+			if quantiles is None or not all(0 <= q <= 1 for q in quantiles):
+				return uncacheable(flask.Response("quantiles must be a comma-separated list of numbers between 0 and 1", status=400, mimetype="text/plain"))
+		groups = loom_server.datasets.JSON_row_groups(row_numbers, attribute, project, filename, quantiles)
+		if groups is not None:
+			return flask.Response(groups, mimetype="application/json")
+	return uncacheable(flask.Response("", status=404))
+
+
+# The rows most correlated with a row ("what correlates with gene X?").
+# Reads the whole matrix, so clients may want to send Prefer: respond-async.
+# Query parameters:
+#   method=pearson   or spearman
+#   n=100            number of rows to return (at most 1000)
+@loom_server.app.route('/loom/<string:project>/<string:filename>/row/<int:row>/correlated')
+@conditional(expires=None)
+def send_correlated(project: str, filename: str, row: int) -> Any:
+	(u, p) = get_auth(request)
+	if loom_server.datasets.authorize(project, u, p):
+		method = request.args.get("method", "pearson")
+		if method != "pearson" and method != "spearman":
+			return uncacheable(flask.Response("method must be pearson or spearman", status=400, mimetype="text/plain"))
+		try:
+			n = min(max(int(request.args.get("n", "100")), 1), 1000)
+		except ValueError:
+			return uncacheable(flask.Response("n must be an integer", status=400, mimetype="text/plain"))
+		if wants_async(request) and not loom_server.datasets.is_expanded("correlation", project, filename, [row, method]):
+			return accepted(loom_server.jobs.submit("correlation", project, filename, [row, method], request.full_path.rstrip("?")))
+		correlated = loom_server.datasets.JSON_correlation(project, filename, row, method, n)
+		if correlated is not None:
+			return flask.Response(correlated, mimetype="application/json")
+	return uncacheable(flask.Response("", status=404))
+
+
+# The rows (marker genes) that distinguish the columns with a value of
+# a categorical column attribute (e.g. one of the Clusters) from all other
+# columns, ranked by Welch's t statistic. The first query per attribute
+# reads the whole matrix, so clients may want to send Prefer: respond-async.
+# Query parameters:
+#   n=100    number of rows to return (at most 1000)
+@loom_server.app.route('/loom/<string:project>/<string:filename>/markers/<string:attribute>/<string:group>')
+@conditional(expires=None)
+def send_markers(project: str, filename: str, attribute: str, group: str) -> Any:
+	(u, p) = get_auth(request)
+	if loom_server.datasets.authorize(project, u, p):
+		try:
+			n = min(max(int(request.args.get("n", "100")), 1), 1000)
+		except ValueError:
+			return uncacheable(flask.Response("n must be an integer", status=400, mimetype="text/plain"))
+		if wants_async(request) and not loom_server.datasets.is_expanded("markers", project, filename, [attribute, group]):
+			return accepted(loom_server.jobs.submit("markers", project, filename, [attribute, group], request.full_path.rstrip("?")))
+		markers = loom_server.datasets.JSON_markers(project, filename, attribute, group, n)
+		if markers is not None:
+			return flask.Response(markers, mimetype="application/json")
+	return uncacheable(flask.Response("", status=404))
+
+
+# Autocompletion of row attributes (gene names, accessions, ...).
+# Query parameters:
+#   q=actb        (start of) the value to look for, case-insensitive
+#   limit=20      maximum number of rows to return (at most 1000)
+#   attr=Gene     only search this row attribute
+#   fuzzy=0       do not include values that are one typo away from q
+@loom_server.app.route('/loom/<string:project>/<string:filename>/search')
+@conditional(expires=None)
+def send_search(project: str, filename: str) -> Any:
+	(u, p) = get_auth(request)
+	if loom_server.datasets.authorize(project, u, p):
+		try:
+			limit = min(int(request.args.get("limit", "20")), 1000)
+		except ValueError:
+			return uncacheable(flask.Response("limit must be an integer", status=400, mimetype="text/plain"))
+		query = request.args.get("q", "")
+		attribute = request.args.get("attr")
+		fuzzy = request.args.get("fuzzy", "1") != "0"
+		results = loom_server.datasets.JSON_search(project, filename, query, limit, attribute, fuzzy)
+		if results is not None:
+			return flask.Response(results, mimetype="application/json")
+	return uncacheable(flask.Response("", status=404))
+
+
+# Cells binned over two column attributes (e.g. an embedding like
+# _tSNE1/_tSNE2), for drawing scatterplots of very large datasets.
+# Query parameters:
+#   bins=256                     bins per axis (at most 1024)
+#   viewport=xmin,ymin,xmax,ymax  only bin the cells in this area
+#   row=42 or attr=n_counts      also return the mean of a row or numeric attribute per bin
+@loom_server.app.route('/loom/<string:project>/<string:filename>/scatter/<string:x_attribute>/<string:y_attribute>')
+@conditional(expires=None)
+def send_scatter(project: str, filename: str, x_attribute: str, y_attribute: str) -> Any:
+	(u, p) = get_auth(request)
+	if loom_server.datasets.authorize(project, u, p):
+		try:
+			bins = int(request.args.get("bins", "256"))
+			viewport = None
+			if "viewport" in request.args:
+				viewport = tuple(float(v) for v in request.args.get("viewport").split(","))
+				if len(viewport) != 4 or not (viewport[0] < viewport[2] and viewport[1] < viewport[3]):
+					raise ValueError()
+			row = int(request.args["row"]) if "row" in request.args else None
+		except ValueError:
+			return uncacheable(flask.Response("bins and row must be integers, viewport must be xmin,ymin,xmax,ymax", status=400, mimetype="text/plain"))
+		attribute = request.args.get("attr")
+		scatter = loom_server.datasets.JSON_scatter(project, filename, x_attribute, y_attribute, bins, viewport, row, attribute)
+		if scatter is not None:
+			return flask.Response(scatter, mimetype="application/json")
+	return uncacheable(flask.Response("", status=404))
+
+
+def parse_column_selection(args: Any) -> Tuple[List[int], Tuple[int, int], Dict[str, List[str]]]:
+	"""
+	Parses the query parameters that restrict rows to a selection
+	of columns (see LoomDatasets.select_columns):
+
+		cols=1,5,9				column numbers
+		colrange=100:200		half-open range of column numbers
+		ca.Class=Neurons		column attribute value, may be repeated
+								(matching any of the values)
+
+	Responses to a column selection start with the selected columns,
+	as {"columns": [...]} in JSON, and as a binary record with idx
+	BINARY_COLUMNS_IDX (see loom_utils) in the binary format, so that
+	clients know which column every value of the rows belongs to.
+
+	Returns:
+		A tuple of column numbers, column range and column attribute
+		filters, each None if not given.
+
+	Raises:
+		ValueError if a parameter is malformed.
+	"""
+	column_numbers = None
+	column_range = None
+	filters = None
+	if "cols" in args:
+		try:
+			column_numbers = [int(i) for i in args.get("cols").split(",") if i != ""]
+		except ValueError:
+			raise ValueError("cols must be a comma-separated list of integers")
+	if "colrange" in args:
+		try:
+			start, end = args.get("colrange").split(":")
+			column_range = (int(start), int(end))
+		except ValueError:
+			raise ValueError("colrange must be formatted as start:end")
+	for key in args.keys():
+		if key.startswith("ca.") and len(key) > 3:
+			if filters is None:
+				filters = {}
+			filters[key[3:]] = args.getlist(key)
+	return (column_numbers, column_range, filters)
+
+
+def parse_rows_request(request: Any) -> Tuple[List[int], List[str], Tuple[List[int], Tuple[int, int], Dict[str, List[str]]]]:
+	"""
+	Parses the body of a POST request for rows. This is either
+	a JSON object (all fields optional):
+
+		{
+			"rows": [row numbers],
+			"genes": [gene names],
+			"cols": [column numbers],
+			"colrange": [start, end],
+			"where": {column attribute: value or [values]}
+		}
+
+	or an `application/octet-stream` body of little-endian
+	uint32 row numbers, with the column selection in the
+	query parameters (see parse_column_selection).
+
+	Returns:
+		A tuple of row numbers, gene names, and the column selection
+		(column numbers, column range and column attribute filters).
+
+	Raises:
+		ValueError if the body is malformed.
+	"""
+	if request.mimetype == "application/octet-stream":
+		data = request.get_data()
+		if len(data) % 4 != 0:
+			raise ValueError("Binary body is not an array of uint32 row numbers")
+		return (list(struct.unpack("<%dI" % (len(data) // 4), data)), [], parse_column_selection(request.args))
+
+	body = request.get_json(force=True, silent=True)
+	if not isinstance(body, dict):
+		raise ValueError("Body is not a JSON object")
+	row_numbers = body.get("rows", [])
+	genes = body.get("genes", [])
+	column_numbers = body.get("cols")
+	if not (isinstance(row_numbers, list) and all(type(i) is int for i in row_numbers)):
+		raise ValueError("rows must be a list of integers")
+	if not (isinstance(genes, list) and all(isinstance(gene, str) for gene in genes)):
+		raise ValueError("genes must be a list of strings")
+	if column_numbers is not None and not (isinstance(column_numbers, list) and all(type(i) is int for i in column_numbers)):
+		raise ValueError("cols must be a list of integers")
+	column_range = body.get("colrange")
+	if column_range is not None:
+		if not (isinstance(column_range, list) and len(column_range) == 2 and all(type(i) is int for i in column_range)):
+			raise ValueError("colrange must be a list of two integers")
+		column_range = tuple(column_range)
+	filters = body.get("where")
+	if filters is not None:
+		if not isinstance(filters, dict):
+			raise ValueError("where must be an object")
+		filters = {key: value if isinstance(value, list) else [value] for key, value in filters.items()}
+		if not all(isinstance(value, str) for values in filters.values() for value in values):
+			raise ValueError("where values must be strings")
+	return (row_numbers, genes, (column_numbers, column_range, filters))
+
+
+# Get many rows at once, selected by row number or gene name, optionally
+# restricted to a subset of columns. Unlike /row/, this is not limited
+# by the maximum length of URLs, and is streamed as a single response.
+@loom_server.app.route('/loom/<string:project>/<string:filename>/rows', methods=['POST'])
+def send_rows(project: str, filename: str) -> Any:
+	(u, p) = get_auth(request)
+	binary = wants_binary(request)
+	if loom_server.datasets.authorize(project, u, p):
+		try:
+			row_numbers, genes, selection = parse_rows_request(request)
+			# raises for unknown column attributes
+			column_numbers = loom_server.datasets.select_columns(project, filename, *selection)
+		except ValueError as e:
+			return uncacheable(flask.Response(str(e), status=400, mimetype="text/plain"))
+		if len(genes) > 0:
+			row_numbers = row_numbers + loom_server.datasets.gene_rows(genes, project, filename)
+		if binary:
+			if column_numbers is None:
+				rows = loom_server.datasets.binary_rows(row_numbers, project, filename)
+			else:
+				rows = loom_server.datasets.binary_rows_columns(row_numbers, column_numbers, project, filename)
+			if rows is not None:
+				return uncacheable(binary_response(rows, request))
+		else:
+			gzipped = accepts_gzip(request)
+			if column_numbers is None:
+				rows = loom_server.datasets.iter_rows(row_numbers, project, filename, gzipped)
+			else:
+				rows = loom_server.datasets.iter_rows_columns(row_numbers, column_numbers, project, filename, gzipped)
+			if rows is not None:
+				if gzipped:
+					return uncacheable(gzipped_response(rows, "application/json"))
+				return uncacheable(flask.Response(rows, mimetype="application/json"))
+	if binary:
+		return uncacheable(flask.Response(b"", mimetype="application/octet-stream"))
+	return uncacheable(flask.Response("[]", mimetype="application/json"))
 
 
 # Get one or more columns of data (i.e. all the expression values for a single cell)
 @loom_server.app.route('/loom/<string:project>/<string:filename>/col/<intdict:column_numbers>')
-@cache(expires=None)
+@conditional(expires=None)
 def send_col(project: str, filename: str, column_numbers: List[int]) -> Any:
 	# path to desired cols
 	(u, p) = get_auth(request)
+	binary = wants_binary(request)
 	if loom_server.datasets.authorize(project, u, p):
-		columns = loom_server.datasets.JSON_columns(column_numbers, project, filename)
-		if columns is not None:
-			return flask.Response(columns, mimetype="application/json")
-	return flask.Response("[]", mimetype="application/json")
+		if binary:
+			columns = loom_server.datasets.binary_columns(column_numbers, project, filename)
+			if columns is not None:
+				return binary_response(columns, request)
+		else:
+			if wants_async(request) and not loom_server.datasets.is_expanded("col", project, filename, column_numbers):
+				return accepted(loom_server.jobs.submit("col", project, filename, sorted(set(column_numbers)), request.path))
+			gzipped = accepts_gzip(request)
+			columns = loom_server.datasets.iter_columns(column_numbers, project, filename, gzipped)
+			if columns is not None:
+				if gzipped:
+					return gzipped_response(columns, "application/json")
+				return flask.Response(columns, mimetype="application/json")
+	if binary:
+		return uncacheable(flask.Response(b"", mimetype="application/octet-stream"))
+	return uncacheable(flask.Response("[]", mimetype="application/json"))
 
 
 #
@@ -273,19 +809,70 @@ def send_col(project: str, filename: str, column_numbers: List[int]) -> Any:
 
 
 @loom_server.app.route('/loom/<string:project>/<string:filename>/tiles/<int:z>/<int:x>_<int:y>.png')
-@cache(expires=60 * 24 * 30)
+@conditional(expires=60 * 24 * 30)
 def send_tile(project: str, filename: str, z: int, x: int, y: int) -> Any:
 	(u, p) = get_auth(request)
 	if loom_server.datasets.authorize(project, u, p):
-		# path to desired tile
+		# tiles generated with `loom tile` as one file per tile take
+		# precedence over packed tiles, which may have been rendered on demand
 		file_path = loom_server.datasets.list.absolute_file_path(project, filename)
 		# subfolder by zoom level to get more useful sorting order
 		tile_path = '%s.tiles/z%02d/x%03d_y%03d.png' % (file_path, z, x, y)
 
 		if os.path.isfile(tile_path):
 			return flask.send_file(tile_path, mimetype='image/png')
+		png = loom_server.datasets.packed_tile(project, filename, z, x, y)
+		if png is not None:
+			return flask.Response(png, mimetype='image/png')
+		# not pre-generated, so render it on demand
+		if wants_async(request) and not loom_server.datasets.is_expanded("tile", project, filename, [z, x, y]):
+			return accepted(loom_server.jobs.submit("tile", project, filename, [z, x, y], request.path))
+		png = loom_server.datasets.tile_png(project, filename, z, x, y)
+		if png is not None:
+			return flask.Response(png, mimetype='image/png')
 	return "", 404
 
+
+#
+# Background jobs
+#
+
+
+# Expand all rows or columns, or render all tiles, of a loom file in the background
+@loom_server.app.route('/loom/<string:project>/<string:filename>/expand/<string:kind>', methods=['POST'])
+def expand_file(project: str, filename: str, kind: str) -> Any:
+	(u, p) = get_auth(request)
+	if kind in ("rows", "cols", "tiles") and loom_server.datasets.authorize(project, u, p):
+		if loom_server.datasets.list.absolute_file_path(project, filename) != "":
+			return accepted(loom_server.jobs.submit(kind, project, filename))
+	return uncacheable(flask.Response("", status=404))
+
+
+# Poll the state of a background job. Once the state is "done",
+# the result can be fetched from the URL in "result_url".
+@loom_server.app.route('/jobs/<string:job_id>', methods=['GET'])
+def send_job(job_id: str) -> Any:
+	(u, p) = get_auth(request)
+	job = loom_server.jobs.get(job_id)
+	if job is None or not loom_server.datasets.authorize(job.project, u, p):
+		return uncacheable(flask.Response("", status=404))
+	response = flask.Response(json.dumps(job.to_dict()), mimetype="application/json")
+	if job.active:
+		response.headers["Retry-After"] = "1"
+	return uncacheable(response)
+
+
+# Prometheus metrics of this server process (see loom_metrics).
+# These include project and file names, so they are only served
+# to the local machine and the addresses passed with --metrics-allow.
+@loom_server.app.route('/metrics')
+def send_metrics() -> Any:
+	allowed = loom_server.app.config.get('METRICS_ALLOW') or ()
+	if request.remote_addr not in ("127.0.0.1", "::1") and request.remote_addr not in allowed:
+		return "", 404
+	response = flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+	return uncacheable(response)
+
 # Starting the server
 
 
@@ -297,7 +884,44 @@ def signal_handler(signal: int, frame: object) -> NoReturn:
 signal.signal(signal.SIGINT, signal_handler)
 
 
-def start_server(dataset_path: str=None, show_browser: bool=True, port: int=8003, debug: bool=False) -> Any:
+def start_server(dataset_path: str=None, show_browser: bool=True, port: int=8003, debug: bool=False, clone_rate_limit: float=0, threads: int=4, workers: int=1, cache_size: float=256, metrics_allow: List[str]=None, profile_token: str=None, profile_all: bool=False, profile_dir: str=None) -> Any:
+	"""
+	Start the loom server.
+
+	clone_rate_limit is the maximum bandwidth in MB/s of each individual
+	download of a loom file through /clone, or 0 for no limit.
+
+	threads is the number of threads used for reading loom files
+	(see LoomWorkers).
+
+	workers is the number of server processes. With more than one,
+	the listening socket is opened once and shared by forked worker
+	processes, so that requests are spread over multiple cores.
+
+	cache_size is the memory budget in MB of the in-memory cache
+	of each worker (see LoomDatasets).
+
+	metrics_allow is a list of client addresses that may read /metrics,
+	besides the local machine.
+
+	Requests with an X-Loom-Profile header matching profile_token (or
+	all requests, with profile_all) are profiled: the time spent per
+	phase is returned in a Server-Timing header. With profile_dir,
+	a cProfile of each profiled request is saved in that folder.
+
+	HDF5 file locking is disabled for the server process and its
+	workers (HDF5_USE_FILE_LOCKING, unless it is set explicitly).
+	Since HDF5 1.10, a read-only handle keeps the file locked, so an
+	idle pooled connection (see LoomConnectionPool) in one worker would
+	make opening the loom file in 'r+' mode fail in all others, even
+	once the writer holds the exclusive LoomFileLock. Within the server,
+	access is coordinated by LoomFileLock instead. Command line tools
+	(tile, expand) keep HDF5 locking, so they are still kept out of
+	loom files that another program is writing.
+	"""
+	# read by HDF5 every time a file is opened, so this must be set
+	# before the first loom file is opened and workers are forked
+	os.environ.setdefault("HDF5_USE_FILE_LOCKING", "FALSE")
 
 	if debug:
 		logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s - %(module)s, %(lineno)d: %(message)s')
@@ -310,23 +934,115 @@ def start_server(dataset_path: str=None, show_browser: bool=True, port: int=8003
 
 	logging.info("Starting LoomServer with %s", loom_server.dataset_path)
 
-	loom_server.update_dataset(dataset_path)
+	loom_server.update_dataset(dataset_path, threads=threads, cache_size=int(cache_size * 1024 * 1024), watch=True)
+	loom_server.app.config['CLONE_RATE_LIMIT'] = clone_rate_limit * 1024 * 1024 if clone_rate_limit else None
+	loom_server.app.config['METRICS_ALLOW'] = set(metrics_allow or [])
+	loom_server.app.config['PROFILE_TOKEN'] = profile_token
+	loom_server.app.config['PROFILE_ALL'] = profile_all
+	loom_server.app.config['PROFILE_DIR'] = profile_dir
+	if profile_all and profile_dir is not None:
+		logging.warning("Profiling all requests with cProfile, this slows down the server considerably")
+
+	if workers > 1 and not hasattr(os, "fork"):
+		logging.warning("Multiple worker processes are not supported on this platform, starting a single process")
+		workers = 1
 
-	if show_browser:
-		url = "http://localhost:" + str(port)
-		if sys.platform == "darwin":
-			subprocess.Popen(['open', url])
-		else:
-			webbrowser.open(url)
 	try:
 		# self.app.run(threaded=True, debug=debug, host="0.0.0.0", port=port)
 		## Monkey-patch if this has not happened yet
 		#if socket.socket is not gevent.socket.socket:
 		#	gevent.monkey.patch_all()
-		http_server = wsgi.WSGIServer(('', port), loom_server.app)
-
-		http_server.serve_forever()
+		if workers > 1:
+			listener = wsgi.WSGIServer.get_listener(('', port), family=socket.AF_INET)
 	except socket.error as serr:
 		if int(port) < 1024:
 			print("You may need to invoke the server with sudo: sudo python loom_server.py ...")
 		raise serr
+
+	if show_browser:
+		url = "http://localhost:" + str(port)
+		if sys.platform == "darwin":
+			subprocess.Popen(['open', url])
+		else:
+			webbrowser.open(url)
+
+	if workers > 1:
+		serve_workers(listener, workers)
+	else:
+		try:
+			loom_server.jobs.start()
+			http_server = wsgi.WSGIServer(('', port), loom_server.app, handler_class=LoomWSGIHandler)
+			http_server.serve_forever()
+		except socket.error as serr:
+			if int(port) < 1024:
+				print("You may need to invoke the server with sudo: sudo python loom_server.py ...")
+			raise serr
+
+
+def fork_worker(listener: Any) -> int:
+	"""
+	Fork a server process that accepts connections on the shared listener.
+	Returns the pid of the new process (in the parent only).
+	"""
+	pid = gevent.fork()
+	if pid == 0:
+		# replace the handlers of the supervising process
+		signal.signal(signal.SIGINT, signal_handler)
+		signal.signal(signal.SIGTERM, signal_handler)
+		logging.info("Worker process %d started", os.getpid())
+		status = 1
+		try:
+			# resume background jobs interrupted by a restart
+			loom_server.jobs.start()
+			http_server = wsgi.WSGIServer(listener, loom_server.app, handler_class=LoomWSGIHandler)
+			http_server.serve_forever()
+		except SystemExit as e:
+			# shutting down (see signal_handler)
+			status = e.code if isinstance(e.code, int) else 0
+		except BaseException:
+			logging.exception("Worker process %d failed", os.getpid())
+		finally:
+			# never return into the code of the supervising process, so
+			# the exit status tells serve_workers why the worker stopped
+			os._exit(status)
+	return pid
+
+
+def serve_workers(listener: Any, workers: int) -> NoReturn:
+	"""
+	Fork worker processes and supervise them: workers that exit
+	unexpectedly are replaced, and SIGINT/SIGTERM are forwarded
+	to all workers before shutting down.
+
+	The loompy thread pools are created lazily (see LoomWorkers),
+	so no threads are started before forking.
+	"""
+	children = set()  # type: Set[int]
+
+	def shutdown(signum: int, frame: object) -> NoReturn:
+		print('\nShutting down.')
+		for pid in children:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
+		for pid in children:
+			try:
+				os.waitpid(pid, 0)
+			except OSError:
+				pass
+		sys.exit(0)
+
+	for i in range(workers):
+		children.add(fork_worker(listener))
+
+	signal.signal(signal.SIGINT, shutdown)
+	signal.signal(signal.SIGTERM, shutdown)
+
+	while True:
+		pid, status = os.waitpid(-1, 0)
+		if pid in children:
+			children.remove(pid)
+			logging.warning("Worker process %d exited with status %d, starting a new one", pid, status)
+			time.sleep(1)
+			children.add(fork_worker(listener))
@@ -0,0 +1,265 @@
+from typing import *
+
+import os
+import re
+import mmap
+import struct
+import logging
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+
+class LoomTilePack(object):
+	"""
+	Stores all heatmap tiles of a loom file in a single append-only
+	pack file (`<loom file>.tiles.pack`), plus an index file
+	(`<loom file>.tiles.idx`) of fixed-size entries pointing into it.
+
+	This replaces the one-PNG-per-tile `.tiles/zZZ/xXXX_yYYY.png`
+	layout, which produces hundreds of thousands of tiny files for
+	large datasets. The PNG tree is still supported as a fallback,
+	and can be imported with `import_tile_dir`.
+
+	Tiles are always appended: writing a tile that is already in
+	the pack adds a new entry that supersedes the old one.
+	Data is written before its index entry, so an interrupted write
+	at worst leaves unreferenced bytes at the end of the pack file.
+
+	Both files start with a header holding the last_modified timestamp
+	of the loom file the tiles were rendered from, and tiles are only
+	returned for that version of the loom file. Writing a tile rendered
+	from a newer version replaces the pack with an empty one first,
+	tiles rendered from an older version are dropped.
+	"""
+	__slots__ = [
+		"pack_path",
+		"index_path",
+		"entries",
+		"_last_mod",
+		"_index_size",
+		"_index_stat",
+	]
+
+	# magic, last_mod of the loom file (ASCII, zero-padded)
+	header = struct.Struct("<8s40s")
+	magic = b"LOOMTPK1"
+	# z, x, y (uint32), offset (uint64), length (uint32)
+	index_entry = struct.Struct("<IIIQI")
+
+	def __init__(self, file_path: str) -> None:
+		"""
+		Args:
+			file_path (str):	Absolute path to the loom file
+		"""
+		self.pack_path = "%s.tiles.pack" % (file_path)
+		self.index_path = "%s.tiles.idx" % (file_path)
+		self.entries = {}  # type: Dict[Tuple[int, int, int], Tuple[int, int]]
+		self._last_mod = None  # type: str
+		self._index_size = 0
+		self._index_stat = None  # type: Tuple[int, int]
+
+	def exists(self) -> bool:
+		return os.path.isfile(self.index_path) and os.path.isfile(self.pack_path)
+
+	def last_mod(self) -> str:
+		"""
+		Returns the last_modified timestamp of the loom file the packed
+		tiles were rendered from, or None if there is no (valid) pack.
+		"""
+		self.refresh()
+		return self._last_mod
+
+	def refresh(self) -> None:
+		"""
+		Read index entries that were appended since the last refresh.
+		If the index was replaced or truncated in the meantime (for
+		example by `loom tile --truncate`, or because the loom file
+		changed), it is re-read from scratch.
+		"""
+		try:
+			stat = os.stat(self.index_path)
+		except OSError:
+			self.forget()
+			return
+
+		if self._index_stat is None or self._index_stat[0] != stat.st_ino or stat.st_size < self._index_size:
+			self.forget()
+		self._index_stat = (stat.st_ino, stat.st_size)
+
+		# ignore a partially written entry at the end of the index
+		entry_size = self.index_entry.size
+		if stat.st_size < self.header.size:
+			return
+		index_size = stat.st_size - (stat.st_size - self.header.size) % entry_size
+		if index_size <= self._index_size:
+			return
+
+		with open(self.index_path, "rb") as f:
+			if self._index_size == 0:
+				self._last_mod = read_header(f)
+				if self._last_mod is None:
+					logging.warning("Ignoring tile index without a valid header at %s", self.index_path)
+					return
+				self._index_size = self.header.size
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+				view = memoryview(index)[self._index_size:index_size]
+				for z, x, y, offset, length in self.index_entry.iter_unpack(view):
+					self.entries[(z, x, y)] = (offset, length)
+				view.release()
+		self._index_size = index_size
+
+	def forget(self) -> None:
+		"""
+		Drop the entries read by refresh, so the index is read from scratch next time.
+		"""
+		self.entries = {}
+		self._last_mod = None
+		self._index_size = 0
+		self._index_stat = None
+
+	def has(self, z: int, x: int, y: int, last_mod: str) -> bool:
+		self.refresh()
+		return self._last_mod == last_mod and (z, x, y) in self.entries
+
+	def get(self, z: int, x: int, y: int, last_mod: str) -> bytes:
+		"""
+		Returns the PNG bytes of the tile, or None if it is not in the
+		pack, or the pack holds tiles of another version of the loom file.
+		"""
+		self.refresh()
+		if self._last_mod != last_mod:
+			return None
+		entry = self.entries.get((z, x, y))
+		if entry is None:
+			return None
+		offset, length = entry
+		try:
+			with open(self.pack_path, "rb") as f:
+				# the pack may have been replaced since the index was read
+				if read_header(f) != last_mod:
+					return None
+				if hasattr(os, "pread"):
+					return os.pread(f.fileno(), length, offset)
+				f.seek(offset)
+				return f.read(length)
+		except OSError:
+			return None
+
+	def put(self, z: int, x: int, y: int, png: bytes, last_mod: str) -> bool:
+		"""
+		Append the PNG bytes of a tile, rendered from the version of the
+		loom file with the given last_mod, to the pack.
+
+		The pack is locked while appending, so that server worker
+		processes writing tiles at the same time do not interleave
+		their data or record the wrong offsets.
+
+		Returns:
+			False if the tile was dropped, because the pack already holds
+			tiles of a newer version of the loom file.
+		"""
+		if last_mod is None or last_mod == "":
+			return False
+		while True:
+			with open(self.pack_path, "ab") as pack:
+				if fcntl is not None:
+					fcntl.flock(pack.fileno(), fcntl.LOCK_EX)
+				try:
+					# another process may have replaced the pack while we waited for the lock
+					if not os.path.isfile(self.pack_path) or os.fstat(pack.fileno()).st_ino != os.stat(self.pack_path).st_ino:
+						continue
+					with open(self.index_path, "ab+") as index:
+						packed_mod = read_header(index)
+					if packed_mod is not None and packed_mod > last_mod:
+						return False
+					if packed_mod != last_mod:
+						# replaces the files, so the lock has to be taken on the new pack
+						self.reset(last_mod)
+						continue
+					offset = pack.seek(0, os.SEEK_END)
+					pack.write(png)
+					pack.flush()
+					with open(self.index_path, "ab") as index:
+						index.write(self.index_entry.pack(z, x, y, offset, len(png)))
+					return True
+				finally:
+					if fcntl is not None:
+						fcntl.flock(pack.fileno(), fcntl.LOCK_UN)
+
+	def reset(self, last_mod: str) -> None:
+		"""
+		Replace the pack and its index with empty ones for the version of
+		the loom file with the given last_mod. Only called by put, with the
+		pack locked. The files are replaced rather than truncated, so
+		readers that still have the old pack open are not affected.
+		"""
+		if self.exists():
+			logging.info("  Replacing tile pack %s of an older version of the loom file", self.pack_path)
+		header = self.header.pack(self.magic, last_mod.encode("ascii"))
+		for path in (self.index_path, self.pack_path):
+			temp_path = "%s.%d.tmp" % (path, os.getpid())
+			with open(temp_path, "wb") as f:
+				f.write(header)
+			os.replace(temp_path, path)
+
+	def truncate(self) -> None:
+		"""
+		Remove the pack and its index.
+		"""
+		for path in (self.index_path, self.pack_path):
+			if os.path.isfile(path):
+				os.remove(path)
+		self.forget()
+
+	def import_tile_dir(self, tile_dir: str, last_mod: str) -> int:
+		"""
+		Append all tiles from a `.tiles/zZZ/xXXX_yYYY.png` folder
+		to the pack, skipping tiles that are already packed.
+
+		Args:
+			last_mod (str):		last_modified timestamp of the loom file the tiles were rendered from
+
+		Returns:
+			The number of imported tiles.
+		"""
+		imported = 0
+		if not os.path.isdir(tile_dir):
+			return imported
+		tile_name = re.compile(r"x(\d+)_y(\d+)\.png$")
+		for zoom_dir in sorted(os.listdir(tile_dir)):
+			if not (zoom_dir.startswith("z") and zoom_dir[1:].isdigit()):
+				continue
+			z = int(zoom_dir[1:])
+			zoom_path = os.path.join(tile_dir, zoom_dir)
+			for name in sorted(os.listdir(zoom_path)):
+				match = tile_name.match(name)
+				if match is None:
+					continue
+				x, y = int(match.group(1)), int(match.group(2))
+				if self.has(z, x, y, last_mod):
+					continue
+				with open(os.path.join(zoom_path, name), "rb") as f:
+					if not self.put(z, x, y, f.read(), last_mod):
+						logging.warning("  Tile pack %s holds tiles of a newer version of the loom file", self.pack_path)
+						return imported
+				imported += 1
+		logging.info("  Imported %d tiles from %s into %s", imported, tile_dir, self.pack_path)
+		return imported
+
+
+def read_header(f: IO[bytes]) -> str:
+	"""
+	Returns the last_mod in the header of an open pack or index
+	file, or None if the file is empty or has no valid header.
+	"""
+	f.seek(0)
+	data = f.read(LoomTilePack.header.size)
+	if len(data) < LoomTilePack.header.size:
+		return None
+	magic, last_mod = LoomTilePack.header.unpack(data)
+	if magic != LoomTilePack.magic:
+		return None
+	return last_mod.rstrip(b"\0").decode("ascii")
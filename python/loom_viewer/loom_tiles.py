@@ -1,4 +1,5 @@
 import os
+import io
 import errno
 import h5py
 import numpy as np
@@ -9,6 +10,8 @@ from typing import *
 
 from loompy import LoomConnection
 
+from .loom_tile_pack import LoomTilePack
+
 
 class LoomTiles(object):
 	#############
@@ -16,14 +19,36 @@ class LoomTiles(object):
 	#############
 	__slots__ = [
 		'ds',
+		'tile_pack',
+		'last_mod',
+		'verbose',
 		'_maxes',
 		'_mins'
 	]
 
-	def __init__(self, ds: LoomConnection) -> None:
+	def __init__(self, ds: LoomConnection, mins: np.ndarray = None, maxes: np.ndarray = None, tile_pack: LoomTilePack = None, last_mod: str = None, verbose: bool = False) -> None:
+		"""
+		If tile_pack is passed, tiles are saved to it instead
+		of as individual PNG files in the .tiles folder, marked
+		as rendered from the loom file as of last_mod (by default
+		the current last_modified timestamp of ds).
+
+		With verbose, progress is printed to stdout (for the command
+		line). Otherwise it is only logged, since tiles are also
+		rendered by the server.
+		"""
 		self.ds = ds
-		self._maxes = None  # type: np.ndarray
-		self._mins = None
+		self.tile_pack = tile_pack
+		if last_mod is None and tile_pack is not None:
+			last_mod = ds.last_modified()
+		self.last_mod = last_mod
+		self.verbose = verbose
+		self._maxes = maxes  # type: np.ndarray
+		self._mins = mins
+
+	def progress(self, text: str) -> None:
+		if self.verbose:
+			print(text, end='', flush=True)
 
 	def maxes(self) -> Any:
 		if self._maxes is None:
@@ -45,9 +70,9 @@ class LoomTiles(object):
 				chunk = self.ds[ix:ix + rows_per_chunk, :]
 				_maxes[ix:ix + rows_per_chunk] = np.nanmax(chunk, axis=1)
 				ix += rows_per_chunk
-				print('.', end='', flush=True)
+				self.progress('.')
 			self._maxes = _maxes
-			print(' done\n\n')
+			self.progress(' done\n\n')
 		return self._maxes
 
 	def mins(self) -> Any:
@@ -62,14 +87,26 @@ class LoomTiles(object):
 				chunk = self.ds[ix:ix + rows_per_chunk, :]
 				_mins[ix:ix + rows_per_chunk] = np.nanmin(chunk, axis=1)
 				ix += rows_per_chunk
-				print('.', end='', flush=True)
+				self.progress('.')
 			self._mins = _mins
-			print(' done\n\n')
+			self.progress(' done\n\n')
 		return self._mins
 
 	def prepare_heatmap(self, truncate: bool = False) -> None:
 		tile_dir = "%s.tiles/" % (self.ds.filename)
-		if os.path.isdir(tile_dir):
+		if self.tile_pack is not None:
+			# a pack of another version of the loom file is replaced by the first new tile
+			if self.tile_pack.last_mod() == self.last_mod:
+				logging.info("  Previous tile pack found at %s", self.tile_pack.pack_path)
+				if truncate:
+					logging.info("    Truncate set, removing old tile pack")
+					self.tile_pack.truncate()
+				elif self.tile_pack.has(8, 0, 0, self.last_mod):
+					logging.info("    All tiles are packed, call prepare_heatmap(truncate=True) to overwrite")
+					return
+				else:
+					logging.info("    Skipping tiles that are already packed")
+		elif os.path.isdir(tile_dir):
 			logging.info("  Previous tile folder found at %s)", tile_dir)
 			if truncate:
 				logging.info("    Truncate set, removing old tile folder")
@@ -85,7 +122,7 @@ class LoomTiles(object):
 		logging.info('  Generating and saving tiles')
 
 		self.dz_get_zoom_tile(0, 0, 8, truncate)
-		print(" done\n\n")
+		self.progress(" done\n\n")
 
 	def dz_zoom_range(self) -> Tuple[int, int, int]:
 		"""
@@ -94,7 +131,7 @@ class LoomTiles(object):
 		Returns:
 			Tuple (middle, min_zoom, max_zoom) of integer zoom levels.
 		"""
-		return (8, int(max(np.ceil(np.log2(self.ds.shape)))), int(max(np.ceil(np.log2(self.ds.shape))) + 8))
+		return dz_zoom_range(self.ds.shape)
 
 	def dz_dimensions(self) -> Tuple[int, int]:
 		"""
@@ -120,17 +157,77 @@ class LoomTiles(object):
 			tile[max_y + 1:256, :] = 255
 		return scipy.misc.toimage(tile, cmin=0, cmax=255, pal=_viridis)
 
+	def dz_tile_in_bounds(self, x: int, y: int, z: int) -> bool:
+		"""
+		Whether the tile at x, y and z is one of the tiles
+		that are stored as images (see dz_save_tile).
+		"""
+		return dz_tile_in_bounds(self.ds.shape, x, y, z)
+
+	def dz_tile_png(self, x: int, y: int, z: int) -> bytes:
+		"""
+		Render the tile at x, y and z to PNG bytes, without saving
+		it or any of the tiles it is composed of to the .tiles folder.
+
+		Zoomed out tiles are computed from the full resolution tiles they
+		cover, so below the middle zoom level prefer dz_merge_tile_png
+		with previously rendered tiles.
+
+		Returns:
+			The PNG image as bytes, or None if the tile is out of bounds.
+		"""
+		if not self.dz_tile_in_bounds(x, y, z):
+			return None
+		tile = self.dz_get_zoom_tile(x, y, z, save=False)
+		return self.dz_tile_to_png(x, y, z, tile)
+
+	def dz_merge_tile_png(self, x: int, y: int, z: int, children: List[bytes]) -> bytes:
+		"""
+		Render the zoomed out tile at x, y and z (below the middle zoom
+		level) to PNG bytes, from the PNG images of the four tiles at
+		z + 1 it is composed of. The merged values are those stored in
+		the images, so they are rounded to whole numbers, like the tiles
+		loaded from the .tiles folder in dz_save_tile.
+
+		Args:
+			children (list):	PNG bytes of the top left, top right, bottom left
+								and bottom right tile, or None for tiles out of bounds
+
+		Returns:
+			The PNG image as bytes, or None if the tile is out of bounds.
+		"""
+		if not self.dz_tile_in_bounds(x, y, z):
+			return None
+		tiles = [
+			np.zeros((256, 256), dtype='float32') if png is None else self.dz_png_to_tile(png)
+			for png in children
+		]
+		tile = self.dz_merge_tile(*tiles)
+		return self.dz_tile_to_png(x, y, z, tile)
+
+	def dz_png_to_tile(self, png: bytes) -> Any:
+		return scipy.misc.imread(io.BytesIO(png), mode='P').astype('float32')
+
+	def dz_tile_to_png(self, x: int, y: int, z: int, tile: Any) -> bytes:
+		img = self.dz_tile_to_image(x, y, z, tile)
+		img_io = io.BytesIO()
+		img.save(img_io, 'PNG', compress_level=4)
+		return img_io.getvalue()
+
 	def dz_save_tile(self, x: int, y: int, z: int, tile: Any, truncate: bool = False) -> Any:
-		(zmin, zmid, zmax) = self.dz_zoom_range()
-		if (
-			z < zmin or z > zmid or
-			x < 0 or y < 0 or
-			x * 256 * 2**(zmid - z) > self.ds.shape[1] or
-			y * 256 * 2**(zmid - z) > self.ds.shape[0]
-		):
+		if not self.dz_tile_in_bounds(x, y, z):
 			# logging.info("Trying to save out of bound tile: x: %02d y: %02d z: %02d" % (x, y, z))
 			return
 
+		if self.tile_pack is not None:
+			# the pack is append-only, truncation
+			# is handled once in prepare_heatmap
+			if self.tile_pack.has(z, x, y, self.last_mod):
+				return
+			self.progress('.')
+			self.tile_pack.put(z, x, y, self.dz_tile_to_png(x, y, z, tile), self.last_mod)
+			return
+
 		tile_dir = '%s.tiles/z%02d/' % (self.ds.filename, z)
 		tile_path = '%sx%03d_y%03d.png' % (tile_dir, x, y)
 
@@ -159,7 +256,7 @@ class LoomTiles(object):
 		# save to file
 		with open(tile_path, 'wb') as img_io:
 			# logging.info("saving %s" % tile_path)
-			print('.', end='', flush=True)
+			self.progress('.')
 			img.save(img_io, 'PNG', compress_level=4)
 		return img
 
@@ -236,7 +333,7 @@ class LoomTiles(object):
 		return tmax
 
 	# Returns a submatrix scaled to 0-255 range
-	def dz_get_zoom_tile(self, x: int, y: int, z: int, truncate: bool = False) -> Any:
+	def dz_get_zoom_tile(self, x: int, y: int, z: int, truncate: bool = False, save: bool = True) -> Any:
 		"""
 		Create a 256x256 pixel matrix corresponding to the tile at x,y and z.
 
@@ -247,6 +344,8 @@ class LoomTiles(object):
 
 			z (int): 	Zoom level (8 is 'middle' where pixels correspond to data values)
 
+			save (bool):	Whether to save this tile and the tiles it is composed of as images
+
 		Returns:
 			Numpy ndarray of shape (256,256)
 		"""
@@ -264,6 +363,13 @@ class LoomTiles(object):
 		if x * 256 * 2**(zmid - z) > self.ds.shape[1] or y * 256 * 2**(zmid - z) > self.ds.shape[0]:
 			return np.zeros((256, 256), dtype='float32')
 
+		if save and self.tile_pack is not None:
+			# packed tiles (and the tiles they are composed of) are
+			# not rendered again, so that tiling can be resumed
+			png = self.tile_pack.get(z, x, y, self.last_mod)
+			if png is not None:
+				return self.dz_png_to_tile(png)
+
 		if z == zmid:
 			tile = self.ds._file['matrix'][y * 256:y * 256 + 256, x * 256:x * 256 + 256]
 			# Pad if needed to make it 256x256
@@ -301,21 +407,44 @@ class LoomTiles(object):
 			tile /= maxes
 			tile = tile.transpose()
 
-			self.dz_save_tile(x, y, z, tile, truncate)
+			if save:
+				self.dz_save_tile(x, y, z, tile, truncate)
 			return tile
 
 		if z < zmid:
 			# Get the four less zoomed-out tiles required to make this tile
-			tl = self.dz_get_zoom_tile(x * 2, y * 2, z + 1, truncate)
-			tr = self.dz_get_zoom_tile(x * 2 + 1, y * 2, z + 1, truncate)
-			bl = self.dz_get_zoom_tile(x * 2, y * 2 + 1, z + 1, truncate)
-			br = self.dz_get_zoom_tile(x * 2 + 1, y * 2 + 1, z + 1, truncate)
+			tl = self.dz_get_zoom_tile(x * 2, y * 2, z + 1, truncate, save)
+			tr = self.dz_get_zoom_tile(x * 2 + 1, y * 2, z + 1, truncate, save)
+			bl = self.dz_get_zoom_tile(x * 2, y * 2 + 1, z + 1, truncate, save)
+			br = self.dz_get_zoom_tile(x * 2 + 1, y * 2 + 1, z + 1, truncate, save)
 			# merge into zoomed out tiles
 			tile = self.dz_merge_tile(tl, tr, bl, br)
-			self.dz_save_tile(x, y, z, tile, truncate)
+			if save:
+				self.dz_save_tile(x, y, z, tile, truncate)
 			return tile
 
 
+def dz_zoom_range(shape: Tuple[int, int]) -> Tuple[int, int, int]:
+	"""
+	Zoom limits for a matrix of the given shape, see LoomTiles.dz_zoom_range
+	"""
+	return (8, int(max(np.ceil(np.log2(shape)))), int(max(np.ceil(np.log2(shape))) + 8))
+
+
+def dz_tile_in_bounds(shape: Tuple[int, int], x: int, y: int, z: int) -> bool:
+	"""
+	Whether the tile at x, y and z of a matrix of the given shape is
+	one of the tiles that are stored as images, see LoomTiles.dz_tile_in_bounds
+	"""
+	(zmin, zmid, zmax) = dz_zoom_range(shape)
+	return not (
+		z < zmin or z > zmid or
+		x < 0 or y < 0 or
+		x * 256 * 2**(zmid - z) > shape[1] or
+		y * 256 * 2**(zmid - z) > shape[0]
+	)
+
+
 _viridis = np.array([
 	[68, 1, 84],
 	[68, 2, 86],
@@ -5,7 +5,9 @@ import os
 
 import time
 import gzip
-import json
+import tempfile
+from datetime import datetime, timezone
+import struct
 
 import numpy as np
 from operator import itemgetter
@@ -29,6 +31,74 @@ def load_gzipped_json_string(file_path: str) -> str:
 		return ""
 
 
+def gzip_string(string: str, compresslevel: int = 6) -> bytes:
+	"""
+	Compresses a string to a single gzip member
+	"""
+	return gzip.compress(string.encode("utf-8"), compresslevel)
+
+
+def gunzip_string(data: bytes) -> str:
+	"""
+	Decompresses gzipped bytes (of one or more members) to a string
+	"""
+	return gzip.decompress(data).decode("utf-8")
+
+
+# A gzip stream may consist of multiple members, which decompress
+# to their concatenated content (RFC 1952). This lets us join
+# previously gzipped JSON files into a JSON array without
+# decompressing them, using these precompressed separators.
+gzipped_open_bracket = gzip_string("[")
+gzipped_comma = gzip_string(",")
+gzipped_close_bracket = gzip_string("]")
+
+
+def iter_json_array(values: Iterable[AnyStr], gzipped: bool = False) -> Iterator[AnyStr]:
+	"""
+	Wraps serialised JSON values in brackets and commas,
+	yielding the chunks of one JSON array.
+
+	If gzipped is True, values are expected to be gzipped
+	JSON, and the result is a gzip stream of concatenated members.
+	"""
+	if gzipped:
+		open_bracket, comma, close_bracket = gzipped_open_bracket, gzipped_comma, gzipped_close_bracket
+	else:
+		open_bracket, comma, close_bracket = "[", ",", "]"
+	yield open_bracket
+	separator = None
+	for value in values:
+		if separator is not None:
+			yield separator
+		separator = comma
+		yield value
+	yield close_bracket
+
+
+class LoomStream(object):
+	"""
+	Wraps an iterator (typically a response body), closing
+	it when the stream is closed.
+	"""
+	__slots__ = [
+		"iterator",
+	]
+
+	def __init__(self, iterator: Iterator[Any]) -> None:
+		self.iterator = iterator
+
+	def __iter__(self) -> Iterator[Any]:
+		return self.iterator
+
+	def __next__(self) -> Any:
+		return next(self.iterator)
+
+	def close(self) -> None:
+		if hasattr(self.iterator, "close"):
+			self.iterator.close()
+
+
 def load_gzipped_json(file_path: str) -> Any:
 	"""
 	Deserializes a gzipped JSON file.
@@ -43,10 +113,7 @@ def save_gzipped_json(json_filename: str, data: Any, truncate: bool = False) ->
 	"""
 		Save data as a gzipped JSON text file
 	"""
-	if truncate and os.path.isfile(json_filename):
-		os.remove(json_filename)
-	with gzip.open(filename=json_filename, mode="wt", compresslevel=6) as f:
-		json.dump(data, f)
+	save_gzipped_json_string(json_filename, json.dumps(data), truncate)
 
 
 def save_gzipped_json_string(json_filename: str, json_string: str, truncate: bool = False) -> None:
@@ -55,8 +122,27 @@ def save_gzipped_json_string(json_filename: str, json_string: str, truncate: boo
 	"""
 	if truncate and os.path.isfile(json_filename):
 		os.remove(json_filename)
-	with gzip.open(filename=json_filename, mode="wt", compresslevel=6) as f:
-		f.write(json_string)
+	save_atomic(json_filename, gzip_string(json_string))
+
+
+def save_atomic(file_path: str, data: bytes) -> None:
+	"""
+	Writes bytes to a temporary file next to file_path, then renames
+	it to file_path. Readers of the cache never see a partially written
+	file, and concurrent writers of the same file (expanders sharing
+	a loom file, or server worker processes) do not corrupt it.
+	"""
+	directory, basename = os.path.split(file_path)
+	fd, temp_path = tempfile.mkstemp(prefix=".%s." % basename, suffix=".tmp", dir=directory)
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		os.chmod(temp_path, 0o644)
+		os.replace(temp_path, file_path)
+	except BaseException:
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+		raise
 
 
 #
@@ -76,6 +162,19 @@ def format_mtime(file_path: str) -> str:
 		return ""
 
 
+def timestamp_to_epoch(timestamp: str) -> float:
+	"""
+	Converts a compact ISO8601 timestamp as used by loompy
+	(e.g. "20180124T100436.901000Z") to seconds since the epoch.
+	Returns None if the timestamp could not be parsed.
+	"""
+	try:
+		parsed = datetime.strptime(timestamp, "%Y%m%dT%H%M%S.%fZ")
+	except (TypeError, ValueError):
+		return None
+	return parsed.replace(tzinfo=timezone.utc).timestamp()
+
+
 def np_to_list(vals: Any) -> Tuple[List[Any], str]:
 	"""
 	Convert a numpy array to a python list, ready for JSON conversion.
@@ -127,6 +226,36 @@ def np_to_list(vals: Any) -> Tuple[List[Any], str]:
 		return (vals.tolist(), "string")
 
 
+def int_array_type(_min: Union[int, float], _max: Union[int, float]) -> str:
+	"""
+	Returns the narrowest integer array type (as used by the
+	typed arrays on the client side) that fits the given range.
+	"""
+	if _min >= 0:
+		if _max < 256:
+			return "uint8"
+		elif _max < 65535:
+			return "uint16"
+		else:
+			return "uint32"
+	elif _min > -128 and _max < 128:
+		return "int8"
+	elif _min > -32769 and _max < 32768:
+		return "int16"
+	return "int32"
+
+
+# What metadata_array returns for an empty numeric array (which np.nanmin
+# cannot handle), for rows restricted to an empty selection of columns
+EMPTY_METADATA_ARRAY = {
+	"arrayType": "uint8",
+	"data": [],
+	"uniques": [],
+	"min": 0,
+	"max": 0
+}  # type: Dict[str, Any]
+
+
 def metadata_array(array: Any) -> Dict[str, Any]:
 	"""
 	Takes a Numpy array and produces an object wrapping
@@ -174,19 +303,7 @@ def metadata_array(array: Any) -> Dict[str, Any]:
 		_max = int(_max) if int(_max) == _max else float(_max)
 
 		if array_type is "int":
-			if _min >= 0:
-				if _max < 256:
-					array_type = "uint8"
-				elif _max < 65535:
-					array_type = "uint16"
-				else:
-					array_type = "uint32"
-			elif _min > -128 and _max < 128:
-				array_type = "int8"
-			elif _min > -32769 and _max < 32768:
-				array_type = "int16"
-			else:
-				array_type = "int32"
+			array_type = int_array_type(_min, _max)
 
 	uniques = []  # type: List[Dict[str, Any]]
 	if len(_un) < len(_data):
@@ -207,3 +324,84 @@ def metadata_array(array: Any) -> Dict[str, Any]:
 		retVal["indexedVal"] = indexed_val
 
 	return retVal
+
+
+#
+#  Binary serialisation of numeric arrays
+#
+
+# Maps the array types picked by metadata_array to a code stored in
+# the binary header, and the little-endian numpy dtype of the buffer.
+binary_array_types = {
+	"uint8": (1, "<u1"),
+	"uint16": (2, "<u2"),
+	"uint32": (3, "<u4"),
+	"int8": (4, "<i1"),
+	"int16": (5, "<i2"),
+	"int32": (6, "<i4"),
+	"float32": (7, "<f4"),
+}  # type: Dict[str, Tuple[int, str]]
+
+# idx (uint32), arrayType code (uint8), min (float64), max (float64)
+# and length (uint32), padded to 32 bytes. Together with padding the
+# buffer to a multiple of four bytes, this keeps every buffer aligned
+# so that the client can wrap it in a typed array without copying.
+binary_header = struct.Struct("<IB3xddI4x")
+
+# idx of the record with the selected column numbers, that responses
+# for rows restricted to a selection of columns start with
+BINARY_COLUMNS_IDX = 0xFFFFFFFF
+
+
+def binary_array(idx: int, array: Any) -> bytes:
+	"""
+	Serialises a numeric Numpy array to a binary record: a small
+	header (see `binary_header`) followed by the raw little-endian
+	buffer, using the same narrow array type as metadata_array.
+
+	Args:
+		idx (int):		Row or column index the array belongs to
+		array:			Numeric numpy array
+
+	Returns:
+		the bytes of the binary record.
+	"""
+	vals = np.asarray(array)
+	if not np.issubdtype(vals.dtype, np.number):
+		raise ValueError("Can only serialise numeric arrays to binary, got %s" % vals.dtype)
+
+	# NaNs and Infinities are replaced with zero, like np_to_list does
+	vals = vals.astype(np.float64)
+	vals[~np.isfinite(vals)] = 0
+
+	_min = float(vals.min()) if len(vals) > 0 else 0.0
+	_max = float(vals.max()) if len(vals) > 0 else 0.0
+
+	if np.all(np.mod(vals, 1) == 0):
+		array_type = int_array_type(_min, _max)
+	else:
+		array_type = "float32"
+	type_code, dtype = binary_array_types[array_type]
+
+	buffer = vals.astype(dtype).tobytes()
+	padding = b"\0" * (-len(buffer) % 4)
+	header = binary_header.pack(idx, type_code, _min, _max, len(vals))
+	return b"".join((header, buffer, padding))
+
+
+def load_binary(file_path: str) -> bytes:
+	"""
+	Reads a binary cache file (or a gzipped file, without
+	decompressing it), returns empty bytes if it does not exist
+	"""
+	if os.path.isfile(file_path):
+		with open(file_path, "rb") as f:
+			return f.read()
+	return b""
+
+
+def save_binary(file_path: str, data: bytes) -> None:
+	"""
+	Saves bytes to a binary cache file
+	"""
+	save_atomic(file_path, data)
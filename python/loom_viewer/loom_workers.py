@@ -0,0 +1,111 @@
+from typing import *
+
+import time
+
+from gevent.lock import BoundedSemaphore
+from gevent.threadpool import ThreadPool
+
+from .loom_profile import current_profile, bind_profile
+
+
+class LoomWorkerStats(object):
+	"""
+	Counters for the jobs of one dataset in LoomWorkers
+	"""
+	__slots__ = [
+		"queued",
+		"running",
+		"completed",
+		"failed",
+		"wait_time",
+		"run_time",
+	]
+
+	def __init__(self) -> None:
+		self.queued = 0
+		self.running = 0
+		self.completed = 0
+		self.failed = 0
+		self.wait_time = 0.0
+		self.run_time = 0.0
+
+	def to_dict(self) -> Dict[str, Union[int, float]]:
+		return {key: getattr(self, key) for key in self.__slots__}
+
+
+class LoomWorkers(object):
+	"""
+	Runs blocking loompy/h5py calls in a bounded pool of OS threads
+	and bounds how many of them run per dataset.
+
+	Every dataset has its own queue: at most max_per_dataset jobs of
+	one dataset run at the same time, so that slow expansions of one
+	dataset cannot occupy all threads. Jobs wait for their turn in
+	their queue without blocking the hub.
+
+	Functions passed to `apply` must not use gevent primitives (locks,
+	sleeping, sockets), since they are run outside of the hub.
+	"""
+	__slots__ = [
+		"size",
+		"max_per_dataset",
+		"pool",
+		"queues",
+		"stats",
+	]
+
+	def __init__(self, size: int = 4, max_per_dataset: int = 2) -> None:
+		self.size = size
+		self.max_per_dataset = min(max_per_dataset, size)
+		# created on first use, so that the threads
+		# are not started before forking worker processes
+		self.pool = None  # type: ThreadPool
+		self.queues = {}  # type: Dict[str, BoundedSemaphore]
+		self.stats = {}  # type: Dict[str, LoomWorkerStats]
+
+	def apply(self, dataset: str, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+		"""
+		Run fn(*args, **kwargs) in the thread pool, queued behind other
+		jobs for the same dataset, and return its result (or raise its
+		exception). Blocks the calling greenlet.
+
+		Args:
+			dataset (str):		Key of the queue to use (typically the absolute path of the loom file)
+			fn:					The blocking function to call
+		"""
+		if self.pool is None:
+			self.pool = ThreadPool(self.size)
+		queue = self.queues.get(dataset)
+		if queue is None:
+			queue = BoundedSemaphore(self.max_per_dataset)
+			self.queues[dataset] = queue
+			self.stats[dataset] = LoomWorkerStats()
+		stats = self.stats[dataset]
+
+		profile = current_profile()
+		stats.queued += 1
+		queued_at = time.monotonic()
+		with queue:
+			started_at = time.monotonic()
+			stats.queued -= 1
+			stats.running += 1
+			stats.wait_time += started_at - queued_at
+			try:
+				result = self.pool.apply(bind_profile(fn), args, kwargs)
+				stats.completed += 1
+				return result
+			except Exception:
+				stats.failed += 1
+				raise
+			finally:
+				stats.running -= 1
+				stats.run_time += time.monotonic() - started_at
+				if profile is not None:
+					profile.add("queue", started_at - queued_at)
+					profile.add("worker", time.monotonic() - started_at)
+
+	def dataset_stats(self) -> Dict[str, Dict[str, Union[int, float]]]:
+		"""
+		Returns the job counters per dataset
+		"""
+		return {dataset: stats.to_dict() for (dataset, stats) in self.stats.items()}
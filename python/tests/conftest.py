@@ -0,0 +1,47 @@
+from typing import *
+
+import os
+
+import numpy as np
+import pytest
+
+from loom_viewer.loom_datasets import LoomDatasets
+
+
+class ColumnsDatasets(LoomDatasets):
+	"""
+	A dataset folder with a single, 100 by 10 loom file "Midbrain/a.loom",
+	whose last_mod, dimensions and column attributes are given instead of read from it
+	"""
+
+	column_indices = {
+		"Class": {
+			"Neurons": np.array([1, 3, 5], dtype=np.int64),
+			"Glia": np.array([0, 2], dtype=np.int64),
+		},
+		"Tissue": {
+			"Cortex": np.array([0, 1, 2, 3], dtype=np.int64),
+		},
+	}
+
+	def last_mod(self, file_path: str) -> str:
+		return "20170101T000000.000000Z"
+
+	def dimensions(self, project: str, filename: str) -> Tuple[int, int]:
+		if self.list.absolute_file_path(project, filename) == "":
+			return None
+		return (100, 10)
+
+	def column_index(self, project: str, filename: str, attribute: str) -> Dict[str, Any]:
+		if self.list.absolute_file_path(project, filename) == "":
+			return None
+		return self.column_indices.get(attribute)
+
+
+@pytest.fixture
+def datasets(tmpdir: Any) -> LoomDatasets:
+	dataset_path = str(tmpdir)
+	os.makedirs(os.path.join(dataset_path, "Midbrain"))
+	with open(os.path.join(dataset_path, "Midbrain", "a.loom"), "wb"):
+		pass
+	return ColumnsDatasets(dataset_path)
@@ -0,0 +1,71 @@
+from loom_viewer.loom_cache import LoomLRUCache
+
+
+def test_put_and_get() -> None:
+	cache = LoomLRUCache(100)
+	cache.put(("/a.loom", "row", 0), b"abc")
+	assert cache.get(("/a.loom", "row", 0)) == b"abc"
+	assert cache.get(("/a.loom", "row", 1)) is None
+	assert cache.size == 3
+	assert cache.stats()["hits"] == 1
+	assert cache.stats()["misses"] == 1
+
+
+def test_evicts_least_recently_used() -> None:
+	cache = LoomLRUCache(10)
+	cache.put("a", b"1234")
+	cache.put("b", b"1234")
+	# "a" becomes the most recently used entry
+	cache.get("a")
+	cache.put("c", b"1234")
+	assert "a" in cache
+	assert "b" not in cache
+	assert "c" in cache
+	assert cache.size == 8
+	assert cache.evictions == 1
+
+
+def test_stays_within_budget() -> None:
+	cache = LoomLRUCache(10)
+	for i in range(100):
+		cache.put(i, b"123")
+		assert cache.size <= 10
+	assert len(cache) == 3
+	assert cache.size == 9
+
+
+def test_value_larger_than_budget_is_not_cached() -> None:
+	cache = LoomLRUCache(10)
+	cache.put("small", b"12345")
+	cache.put("large", b"12345678901")
+	assert "large" not in cache
+	assert "small" in cache
+	assert cache.size == 5
+
+
+def test_replacing_a_value_updates_the_size() -> None:
+	cache = LoomLRUCache(10)
+	cache.put("a", b"12345678")
+	cache.put("a", b"12")
+	assert cache.size == 2
+	assert cache.get("a") == b"12"
+
+
+def test_explicit_size() -> None:
+	cache = LoomLRUCache(100)
+	cache.put("dimensions", (10, 20), 100)
+	assert cache.get("dimensions") == (10, 20)
+	cache.put("other", b"1")
+	assert "dimensions" not in cache
+	assert cache.size == 1
+
+
+def test_invalidate_drops_entries_of_one_file() -> None:
+	cache = LoomLRUCache(100)
+	cache.put(("/a.loom", "row", 0), b"123")
+	cache.put(("/a.loom", "col", 0), b"123")
+	cache.put(("/b.loom", "row", 0), b"123")
+	cache.invalidate("/a.loom")
+	assert len(cache) == 1
+	assert ("/b.loom", "row", 0) in cache
+	assert cache.size == 3
@@ -0,0 +1,86 @@
+from typing import *
+
+import os
+import shutil
+
+import pytest
+
+from loom_viewer.loom_catalog import LoomCatalog
+
+
+@pytest.fixture
+def dataset_path(tmpdir: Any) -> str:
+	path = str(tmpdir)
+	os.makedirs(os.path.join(path, "Midbrain"))
+	touch(os.path.join(path, "Midbrain", "a.loom"))
+	touch(os.path.join(path, "Midbrain", "notes.txt"))
+	return path
+
+
+def touch(path: str) -> None:
+	with open(path, "wb"):
+		pass
+
+
+def test_scan(dataset_path: str) -> None:
+	catalog = LoomCatalog(dataset_path)
+	catalog.rescan(force=True)
+	assert catalog.project_names() == {"Midbrain"}
+	assert catalog.files() == {("Midbrain", "a.loom", os.path.join(dataset_path, "Midbrain", "a.loom"))}
+
+
+def test_add_and_remove_files(dataset_path: str) -> None:
+	removed = []
+	catalog = LoomCatalog(dataset_path, on_removed=removed.append)
+	catalog.rescan(force=True)
+
+	version = catalog.version
+	touch(os.path.join(dataset_path, "Midbrain", "b.loom"))
+	catalog.rescan(force=True)
+	assert {filename for project, filename, file_path in catalog.files()} == {"a.loom", "b.loom"}
+	assert catalog.version > version
+
+	version = catalog.version
+	os.remove(os.path.join(dataset_path, "Midbrain", "a.loom"))
+	catalog.rescan(force=True)
+	assert {filename for project, filename, file_path in catalog.files()} == {"b.loom"}
+	assert removed == [os.path.join(dataset_path, "Midbrain", "a.loom")]
+	assert catalog.version > version
+
+
+def test_add_and_remove_projects(dataset_path: str) -> None:
+	removed = []
+	catalog = LoomCatalog(dataset_path, on_removed=removed.append)
+	catalog.rescan(force=True)
+
+	os.makedirs(os.path.join(dataset_path, "Cortex"))
+	touch(os.path.join(dataset_path, "Cortex", "c.loom"))
+	# hidden folders (like the job states) are not projects
+	os.makedirs(os.path.join(dataset_path, ".jobs"))
+	catalog.rescan(force=True)
+	assert catalog.project_names() == {"Midbrain", "Cortex"}
+
+	shutil.rmtree(os.path.join(dataset_path, "Midbrain"))
+	catalog.rescan(force=True)
+	assert catalog.project_names() == {"Cortex"}
+	assert removed == [os.path.join(dataset_path, "Midbrain", "a.loom")]
+
+
+def test_metadata_list(dataset_path: str) -> None:
+	catalog = LoomCatalog(dataset_path)
+	catalog.rescan(force=True)
+	calls = []
+
+	def metadata(project: str, filename: str) -> str:
+		calls.append(filename)
+		return "{\"filename\": \"%s\"}" % filename
+
+	assert catalog.metadata_list({"Midbrain"}, metadata) == "[{\"filename\": \"a.loom\"}]"
+	assert catalog.metadata_list({"Midbrain"}, metadata) == "[{\"filename\": \"a.loom\"}]"
+	assert calls == ["a.loom"]
+	assert catalog.metadata_list({"Cortex"}, metadata) == "[]"
+
+	touch(os.path.join(dataset_path, "Midbrain", "b.loom"))
+	catalog.rescan(force=True)
+	assert catalog.metadata_list({"Midbrain"}, metadata) == "[{\"filename\": \"a.loom\"},{\"filename\": \"b.loom\"}]"
+	assert calls == ["a.loom", "b.loom"]
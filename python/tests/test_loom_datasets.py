@@ -0,0 +1,60 @@
+from typing import *
+
+import json
+
+import numpy as np
+import pytest
+
+from loom_viewer.loom_datasets import LoomDatasets
+from loom_viewer.loom_datasets import valid_columns
+from loom_viewer.loom_utils import binary_header
+from loom_viewer.loom_utils import BINARY_COLUMNS_IDX
+from loom_viewer.loom_utils import EMPTY_METADATA_ARRAY
+
+
+def test_valid_columns() -> None:
+	assert valid_columns([5, -1, 3, 5, 10, 0], (100, 10)) == [0, 3, 5]
+
+
+def test_select_all_columns(datasets: LoomDatasets) -> None:
+	assert datasets.select_columns("Midbrain", "a.loom") is None
+
+
+def test_select_columns(datasets: LoomDatasets) -> None:
+	assert datasets.select_columns("Midbrain", "a.loom", column_numbers=[5, 1, 5]) == [1, 5]
+	assert datasets.select_columns("Midbrain", "a.loom", column_range=(8, 20)) == [8, 9]
+	assert datasets.select_columns("Midbrain", "a.loom", filters={"Class": ["Neurons", "Glia"]}) == [0, 1, 2, 3, 5]
+	assert datasets.select_columns("Midbrain", "a.loom", filters={"Class": ["Neurons"], "Tissue": ["Cortex"]}) == [1, 3]
+	assert datasets.select_columns("Midbrain", "a.loom", column_numbers=[0, 1, 2, 3], column_range=(1, 3), filters={"Class": ["Neurons"]}) == [1]
+
+
+def test_select_no_columns(datasets: LoomDatasets) -> None:
+	assert datasets.select_columns("Midbrain", "a.loom", column_numbers=[]) == []
+	assert datasets.select_columns("Midbrain", "a.loom", filters={"Class": ["Unknown"]}) == []
+
+
+def test_select_unknown_column_attribute(datasets: LoomDatasets) -> None:
+	with pytest.raises(ValueError):
+		datasets.select_columns("Midbrain", "a.loom", filters={"Unknown": ["Neurons"]})
+
+
+def test_select_columns_of_missing_file(datasets: LoomDatasets) -> None:
+	assert datasets.select_columns("Midbrain", "missing.loom", filters={"Class": ["Neurons"]}) == []
+
+
+def test_rows_of_empty_column_selection(datasets: LoomDatasets) -> None:
+	# answered without reading the loom file
+	stream = datasets.iter_rows_columns([3, 1, 200], [], "Midbrain", "a.loom")
+	rows = json.loads("".join(stream))
+	assert rows == [
+		{"columns": []},
+		{"idx": 1, "data": EMPTY_METADATA_ARRAY},
+		{"idx": 3, "data": EMPTY_METADATA_ARRAY},
+	]
+
+
+def test_binary_rows_of_empty_column_selection(datasets: LoomDatasets) -> None:
+	data = datasets.binary_rows_columns([3, 1, 200], [], "Midbrain", "a.loom")
+	headers = [binary_header.unpack_from(data, offset) for offset in range(0, len(data), binary_header.size)]
+	# idx and length of every record
+	assert [(header[0], header[4]) for header in headers] == [(BINARY_COLUMNS_IDX, 0), (1, 0), (3, 0)]
@@ -0,0 +1,94 @@
+from typing import *
+
+import os
+from wsgiref.handlers import format_date_time
+
+import flask
+import pytest
+
+from loom_viewer.loom_download import send_file_range
+
+app = flask.Flask(__name__)
+
+CONTENT = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def file_path(tmpdir: Any) -> str:
+	path = str(tmpdir.join("test.loom"))
+	with open(path, "wb") as f:
+		f.write(CONTENT)
+	return path
+
+
+def get(file_path: str, headers: Dict[str, str] = None) -> Tuple[Any, bytes]:
+	with app.test_request_context(headers=headers or {}):
+		response = send_file_range(file_path, flask.request, "application/octet-stream")
+		try:
+			body = b"".join(response.response) if response.status_code != 416 else b""
+		finally:
+			response.close()
+	return (response, body)
+
+
+def test_whole_file(file_path: str) -> None:
+	response, body = get(file_path)
+	assert response.status_code == 200
+	assert body == CONTENT
+	assert response.headers["Content-Length"] == str(len(CONTENT))
+	assert response.headers["Accept-Ranges"] == "bytes"
+	assert response.headers["Content-Disposition"] == "attachment; filename=\"test.loom\""
+
+
+def test_range(file_path: str) -> None:
+	response, body = get(file_path, {"Range": "bytes=10-19"})
+	assert response.status_code == 206
+	assert body == CONTENT[10:20]
+	assert response.headers["Content-Length"] == "10"
+	assert response.headers["Content-Range"] == "bytes 10-19/%d" % len(CONTENT)
+
+
+def test_open_ended_range(file_path: str) -> None:
+	response, body = get(file_path, {"Range": "bytes=1000-"})
+	assert response.status_code == 206
+	assert body == CONTENT[1000:]
+
+
+def test_suffix_range(file_path: str) -> None:
+	response, body = get(file_path, {"Range": "bytes=-24"})
+	assert response.status_code == 206
+	assert body == CONTENT[-24:]
+
+
+def test_unsatisfiable_range(file_path: str) -> None:
+	response, body = get(file_path, {"Range": "bytes=5000-6000"})
+	assert response.status_code == 416
+	assert response.headers["Content-Range"] == "bytes */%d" % len(CONTENT)
+
+
+def test_multiple_ranges_get_the_whole_file(file_path: str) -> None:
+	response, body = get(file_path, {"Range": "bytes=0-1,5-6"})
+	assert response.status_code == 200
+	assert body == CONTENT
+
+
+def test_if_range_with_current_etag(file_path: str) -> None:
+	etag = get(file_path)[0].get_etag()[0]
+	response, body = get(file_path, {"Range": "bytes=10-19", "If-Range": "\"%s\"" % etag})
+	assert response.status_code == 206
+	assert body == CONTENT[10:20]
+
+
+def test_if_range_with_outdated_etag(file_path: str) -> None:
+	response, body = get(file_path, {"Range": "bytes=10-19", "If-Range": "\"outdated\""})
+	assert response.status_code == 200
+	assert body == CONTENT
+
+
+def test_if_range_with_date(file_path: str) -> None:
+	last_modified = int(os.stat(file_path).st_mtime)
+	response, body = get(file_path, {"Range": "bytes=10-19", "If-Range": format_date_time(last_modified)})
+	assert response.status_code == 206
+	response, body = get(file_path, {"Range": "bytes=10-19", "If-Range": format_date_time(last_modified - 3600)})
+	assert response.status_code == 200
+	assert body == CONTENT
@@ -0,0 +1,42 @@
+from typing import *
+
+import os
+
+from loom_viewer.loom_expand import correlations_path
+from loom_viewer.loom_expand import iter_chunks
+from loom_viewer.loom_expand import load_correlations
+from loom_viewer.loom_utils import save_gzipped_json
+
+
+def save_correlations(file_path: str, row: int, last_mod: str, n: int, results: List[Tuple[int, float]]) -> None:
+	path = correlations_path(file_path, "pearson", row)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	save_gzipped_json(path, {"lastMod": last_mod, "n": n, "results": results})
+
+
+def test_load_correlations(tmpdir: Any) -> None:
+	file_path = str(tmpdir.join("test.loom"))
+	save_correlations(file_path, 3, "2017-01-01", 1000, [[5, 0.9], [1, 0.5]])
+	assert load_correlations(file_path, "pearson", 3, "2017-01-01", 1000) == [(5, 0.9), (1, 0.5)]
+	# fewer rows are answered from the same results
+	assert load_correlations(file_path, "pearson", 3, "2017-01-01", 10) == [(5, 0.9), (1, 0.5)]
+
+
+def test_load_correlations_needs_enough_rows(tmpdir: Any) -> None:
+	file_path = str(tmpdir.join("test.loom"))
+	save_correlations(file_path, 3, "2017-01-01", 10, [[5, 0.9]])
+	assert load_correlations(file_path, "pearson", 3, "2017-01-01", 1000) is None
+
+
+def test_load_correlations_of_other_version(tmpdir: Any) -> None:
+	file_path = str(tmpdir.join("test.loom"))
+	save_correlations(file_path, 3, "2017-01-01", 1000, [[5, 0.9]])
+	assert load_correlations(file_path, "pearson", 3, "2017-01-02", 1000) is None
+	assert load_correlations(file_path, "spearman", 3, "2017-01-01", 1000) is None
+	assert load_correlations(file_path, "pearson", 4, "2017-01-01", 1000) is None
+
+
+def test_iter_chunks() -> None:
+	numbers = [130, 1, 0, 64, 1, -1, 500, 63]
+	assert list(iter_chunks(numbers, 200)) == [[0, 1, 63], [64], [130]]
+	assert list(iter_chunks([], 200)) == []
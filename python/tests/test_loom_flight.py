@@ -0,0 +1,74 @@
+import gevent
+import pytest
+
+from loom_viewer.loom_flight import LoomSingleFlight
+
+
+def test_concurrent_calls_share_one_result() -> None:
+	flights = LoomSingleFlight()
+	calls = []
+
+	def work() -> str:
+		calls.append(1)
+		gevent.sleep(0.01)
+		return "result"
+
+	greenlets = [gevent.spawn(flights.do, "key", work) for i in range(5)]
+	gevent.joinall(greenlets, raise_error=True)
+	assert [greenlet.value for greenlet in greenlets] == ["result"] * 5
+	assert len(calls) == 1
+	assert flights.stats() == {"in_flight": 0, "led": 1, "shared": 4}
+
+
+def test_results_are_not_kept() -> None:
+	flights = LoomSingleFlight()
+	assert flights.do("key", lambda: 1) == 1
+	assert flights.do("key", lambda: 2) == 2
+	assert not flights.in_flight("key")
+
+
+def test_exception_is_raised_in_all_callers() -> None:
+	flights = LoomSingleFlight()
+
+	def work() -> None:
+		gevent.sleep(0.01)
+		raise KeyError("missing")
+
+	greenlets = [gevent.spawn(flights.do, "key", work) for i in range(3)]
+	gevent.joinall(greenlets)
+	for greenlet in greenlets:
+		assert isinstance(greenlet.exception, KeyError)
+	assert not flights.in_flight("key")
+	# a failed flight does not keep failing later calls
+	assert flights.do("key", lambda: "retried") == "retried"
+
+
+def test_exception_is_raised_in_leader() -> None:
+	flights = LoomSingleFlight()
+
+	def work() -> None:
+		raise ValueError("failed")
+
+	with pytest.raises(ValueError):
+		flights.do("key", work)
+	assert not flights.in_flight("key")
+
+
+def test_begin_finish_and_wait() -> None:
+	flights = LoomSingleFlight()
+	assert flights.wait("key") is None
+	assert flights.begin("key")
+	assert not flights.begin("key")
+	waiter = gevent.spawn(flights.wait, "key")
+	gevent.sleep(0)
+	flights.finish("key", "value")
+	assert waiter.get() == "value"
+
+
+def test_wait_returns_none_if_the_work_failed() -> None:
+	flights = LoomSingleFlight()
+	flights.begin("key")
+	waiter = gevent.spawn(flights.wait, "key")
+	gevent.sleep(0)
+	flights.fail("key", OSError("failed"))
+	assert waiter.get() is None
@@ -0,0 +1,121 @@
+from typing import *
+
+import json
+import struct
+
+import flask
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from loom_viewer.loom_datasets import LoomDatasets
+from loom_viewer.loom_server import loom_server
+from loom_viewer.loom_server import parse_column_selection
+from loom_viewer.loom_server import parse_rows_request
+from loom_viewer.loom_utils import binary_header
+from loom_viewer.loom_utils import BINARY_COLUMNS_IDX
+from loom_viewer.loom_utils import EMPTY_METADATA_ARRAY
+
+
+@pytest.fixture
+def client(datasets: LoomDatasets, monkeypatch: Any) -> Any:
+	monkeypatch.setattr(loom_server, "datasets", datasets)
+	return loom_server.app.test_client()
+
+
+def parse_rows(data: bytes, content_type: str, query_string: str = "") -> Any:
+	with loom_server.app.test_request_context("/?" + query_string, method="POST", data=data, content_type=content_type):
+		return parse_rows_request(flask.request)
+
+
+def test_no_column_selection() -> None:
+	assert parse_column_selection(MultiDict()) == (None, None, None)
+
+
+def test_column_selection() -> None:
+	args = MultiDict([("cols", "1,5,9"), ("colrange", "100:200"), ("ca.Class", "Neurons"), ("ca.Class", "Glia"), ("ca.Tissue", "Cortex")])
+	assert parse_column_selection(args) == ([1, 5, 9], (100, 200), {"Class": ["Neurons", "Glia"], "Tissue": ["Cortex"]})
+
+
+def test_empty_column_selection() -> None:
+	assert parse_column_selection(MultiDict([("cols", "")])) == ([], None, None)
+
+
+@pytest.mark.parametrize("args", [
+	[("cols", "1,a")],
+	[("colrange", "100")],
+	[("colrange", "a:b")],
+	[("colrange", "1:2:3")],
+])
+def test_malformed_column_selection(args: List[Tuple[str, str]]) -> None:
+	with pytest.raises(ValueError):
+		parse_column_selection(MultiDict(args))
+
+
+def test_json_rows_request() -> None:
+	body = {"rows": [1, 2], "genes": ["Actb"], "cols": [3], "colrange": [0, 10], "where": {"Class": "Neurons", "Tissue": ["Cortex", "Hippocampus"]}}
+	assert parse_rows(json.dumps(body).encode(), "application/json") == (
+		[1, 2],
+		["Actb"],
+		([3], (0, 10), {"Class": ["Neurons"], "Tissue": ["Cortex", "Hippocampus"]}),
+	)
+
+
+def test_empty_json_rows_request() -> None:
+	assert parse_rows(b"{}", "application/json") == ([], [], (None, None, None))
+
+
+def test_binary_rows_request() -> None:
+	data = struct.pack("<3I", 7, 0, 4294967295)
+	assert parse_rows(data, "application/octet-stream", "ca.Class=Neurons") == ([7, 0, 4294967295], [], (None, None, {"Class": ["Neurons"]}))
+
+
+@pytest.mark.parametrize("data, content_type", [
+	(b"\x01\x00\x00", "application/octet-stream"),
+	(b"not json", "application/json"),
+	(b"[1, 2]", "application/json"),
+	(b"{\"rows\": [1, \"2\"]}", "application/json"),
+	(b"{\"rows\": [true]}", "application/json"),
+	(b"{\"genes\": \"Actb\"}", "application/json"),
+	(b"{\"cols\": [1.5]}", "application/json"),
+	(b"{\"colrange\": [1]}", "application/json"),
+	(b"{\"where\": [\"Class\"]}", "application/json"),
+	(b"{\"where\": {\"Class\": 1}}", "application/json"),
+])
+def test_malformed_rows_request(data: bytes, content_type: str) -> None:
+	with pytest.raises(ValueError):
+		parse_rows(data, content_type)
+
+
+def test_rows_with_unknown_column_attribute(client: Any) -> None:
+	response = client.post("/loom/Midbrain/a.loom/rows", data=json.dumps({"rows": [1], "where": {"Unknown": "Neurons"}}), content_type="application/json")
+	assert response.status_code == 400
+	assert response.headers["Cache-Control"] == "no-store"
+
+
+def test_row_with_unknown_column_attribute(client: Any) -> None:
+	response = client.get("/loom/Midbrain/a.loom/row/1+3?ca.Unknown=Neurons")
+	assert response.status_code == 400
+
+
+def test_row_with_malformed_column_selection(client: Any) -> None:
+	response = client.get("/loom/Midbrain/a.loom/row/1?colrange=1")
+	assert response.status_code == 400
+
+
+def test_rows_of_empty_column_selection(client: Any) -> None:
+	response = client.post("/loom/Midbrain/a.loom/rows", data=json.dumps({"rows": [1, 3], "where": {"Class": "Unknown"}}), content_type="application/json")
+	assert response.status_code == 200
+	assert json.loads(response.get_data(as_text=True)) == [
+		{"columns": []},
+		{"idx": 1, "data": EMPTY_METADATA_ARRAY},
+		{"idx": 3, "data": EMPTY_METADATA_ARRAY},
+	]
+
+
+def test_binary_row_of_empty_column_selection(client: Any) -> None:
+	response = client.get("/loom/Midbrain/a.loom/row/1+3?format=binary&cols=")
+	assert response.status_code == 200
+	assert response.mimetype == "application/octet-stream"
+	data = response.get_data()
+	headers = [binary_header.unpack_from(data, offset) for offset in range(0, len(data), binary_header.size)]
+	assert [(header[0], header[4]) for header in headers] == [(BINARY_COLUMNS_IDX, 0), (1, 0), (3, 0)]
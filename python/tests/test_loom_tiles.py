@@ -0,0 +1,23 @@
+from loom_viewer.loom_tiles import dz_zoom_range
+from loom_viewer.loom_tiles import dz_tile_in_bounds
+
+
+def test_zoom_range() -> None:
+	# the middle zoom level is the one where a pixel is a value
+	assert dz_zoom_range((256, 256)) == (8, 8, 16)
+	assert dz_zoom_range((257, 100)) == (8, 9, 17)
+	assert dz_zoom_range((1000, 30000)) == (8, 15, 23)
+	assert dz_zoom_range((20000, 1000)) == (8, 15, 23)
+
+
+def test_tile_in_bounds() -> None:
+	shape = (1000, 3000)
+	(zmin, zmid, zmax) = dz_zoom_range(shape)
+	assert dz_tile_in_bounds(shape, 0, 0, zmin)
+	assert dz_tile_in_bounds(shape, 0, 0, zmid)
+	assert dz_tile_in_bounds(shape, 3000 // 256, 1000 // 256, zmid)
+	assert not dz_tile_in_bounds(shape, 3000 // 256 + 1, 0, zmid)
+	assert not dz_tile_in_bounds(shape, 0, 1000 // 256 + 1, zmid)
+	assert not dz_tile_in_bounds(shape, -1, 0, zmid)
+	assert not dz_tile_in_bounds(shape, 0, 0, zmin - 1)
+	assert not dz_tile_in_bounds(shape, 0, 0, zmid + 1)
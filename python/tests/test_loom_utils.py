@@ -0,0 +1,84 @@
+from typing import *
+
+import numpy as np
+import pytest
+
+from loom_viewer.loom_utils import binary_array
+from loom_viewer.loom_utils import binary_array_types
+from loom_viewer.loom_utils import binary_header
+from loom_viewer.loom_utils import BINARY_COLUMNS_IDX
+
+
+def read_records(data: bytes) -> List[Tuple[int, str, float, float, Any]]:
+	"""
+	Parses concatenated binary records the way the client does
+	"""
+	array_types = {code: (name, dtype) for name, (code, dtype) in binary_array_types.items()}
+	records = []
+	offset = 0
+	while offset < len(data):
+		idx, type_code, _min, _max, length = binary_header.unpack_from(data, offset)
+		offset += binary_header.size
+		# buffers must be aligned to be wrapped in typed arrays
+		assert offset % 4 == 0
+		name, dtype = array_types[type_code]
+		values = np.frombuffer(data, dtype=dtype, count=length, offset=offset)
+		offset += values.nbytes + (-values.nbytes % 4)
+		records.append((idx, name, _min, _max, values))
+	return records
+
+
+def test_header_size() -> None:
+	assert binary_header.size == 32
+
+
+@pytest.mark.parametrize("values, array_type", [
+	([0, 1, 255], "uint8"),
+	([0, 256, 1000], "uint16"),
+	([0, 70000], "uint32"),
+	([-3, 0, 127], "int8"),
+	([-300, 300], "int16"),
+	([-70000, 5], "int32"),
+	([0.5, 1.25, -2], "float32"),
+])
+def test_round_trip(values: List[float], array_type: str) -> None:
+	[(idx, name, _min, _max, decoded)] = read_records(binary_array(42, np.array(values)))
+	assert idx == 42
+	assert name == array_type
+	assert _min == min(values)
+	assert _max == max(values)
+	assert decoded.tolist() == values
+
+
+def test_concatenated_records_stay_aligned() -> None:
+	# odd lengths of one and two byte values need padding
+	data = binary_array(0, np.array([1, 2, 3])) + binary_array(1, np.array([300, 2, 1])) + binary_array(2, np.array([1.5]))
+	records = read_records(data)
+	assert [record[0] for record in records] == [0, 1, 2]
+	assert [record[4].tolist() for record in records] == [[1, 2, 3], [300, 2, 1], [1.5]]
+
+
+def test_non_finite_values_become_zero() -> None:
+	[(idx, name, _min, _max, decoded)] = read_records(binary_array(0, np.array([np.nan, 2, np.inf])))
+	assert decoded.tolist() == [0, 2, 0]
+	assert (_min, _max) == (0, 2)
+
+
+def test_empty_array() -> None:
+	data = binary_array(7, np.empty(0))
+	assert len(data) == binary_header.size
+	[(idx, name, _min, _max, decoded)] = read_records(data)
+	assert idx == 7
+	assert len(decoded) == 0
+
+
+def test_column_numbers_record() -> None:
+	columns = [0, 5, 100000]
+	[(idx, name, _min, _max, decoded)] = read_records(binary_array(BINARY_COLUMNS_IDX, np.array(columns, dtype=np.int64)))
+	assert idx == BINARY_COLUMNS_IDX
+	assert decoded.tolist() == columns
+
+
+def test_non_numeric_array_is_rejected() -> None:
+	with pytest.raises(ValueError):
+		binary_array(0, np.array(["a", "b"]))